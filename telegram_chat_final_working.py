@@ -5,13 +5,36 @@ Telegram Chat Final Working Viewer
 Упрощенная и гарантированно рабочая версия с экспортом изображений
 """
 
-import tkinter as tk
-from tkinter import ttk, filedialog, messagebox
+import argparse
 import json
+import logging
+import logging.handlers
 import os
-from datetime import datetime
+import sys
+import time
+import re
+import codecs
+import hashlib
+import mmap
+import queue
+import random
+import shutil
+import struct
+import tempfile
+import zlib
+from datetime import datetime, date
+from array import array
+from functools import lru_cache
+from itertools import compress
+from contextlib import closing
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+import bisect
+import operator
 import threading
 import math
+import unicodedata
 
 # Импорт для создания изображений
 try:
@@ -20,6 +43,3202 @@ try:
 except ImportError:
     PIL_AVAILABLE = False
 
+# Кэш разобранных экспортов (в некоторых сборках Python нет sqlite3)
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+# tkinter импортируется только для окна (load_tk), чтобы командный
+# режим работал на серверах без графики
+tk = ttk = filedialog = messagebox = tkfont = ImageTk = None
+
+def load_tk():
+    """Импорт tkinter для графического режима"""
+    global tk, ttk, filedialog, messagebox, tkfont, ImageTk
+    import tkinter as tk
+    import tkinter.font as tkfont
+    from tkinter import ttk, filedialog, messagebox
+    # Миниатюры фото в ленте показываются, только если есть Pillow
+    try:
+        from PIL import ImageTk
+    except ImportError:
+        ImageTk = None
+
+_JSON_WS = re.compile(r'[ \t\n\r]*')
+
+# Текст сообщения с форматированием - список кусков, а не строка
+# Приведение строк поиска: ё -> е, апострофы, кавычки и тире к одному виду
+SEARCH_FOLD = {
+    'ё': 'е', 'Ё': 'Е',
+    '’': "'", '‘': "'", 'ʼ': "'", '`': "'", '´': "'",
+    '«': '"', '»': '"', '“': '"', '”': '"', '„': '"',
+    '–': '-', '—': '-'
+}
+# Замена через re.sub заметно быстрее str.translate с таблицей-словарем
+_SEARCH_FOLD_CHARS = re.compile('[' + re.escape(''.join(SEARCH_FOLD)) + ']')
+# Диакритика, снимаемая после NFKD; краткая (U+0306) остается, чтобы й не стала и
+_COMBINING_MARKS = re.compile('[\u0300-\u0305\u0307-\u036f\u1ab0-\u1aff\u1dc0-\u1dff\u20d0-\u20ff\ufe20-\ufe2f]')
+
+# Режимы поиска и их подписи в окне
+SEARCH_MODES = {
+    'text': "Текст",
+    'word': "Слово",
+    'regex': "Regex"
+}
+
+_JSON_LIST_TEXT = re.compile(r'"text"[ \t\n\r]*:[ \t\n\r]*\[')
+
+# Время сообщения, дату которого не удалось разобрать
+MISSING_TIMESTAMP = -(1 << 63)
+
+# Коды типов сообщений в MessageStore
+KIND_MESSAGE = 0
+KIND_SERVICE = 1
+
+# Коды медиа в MessageStore
+MEDIA_NONE = 0
+MEDIA_PHOTO = 1
+MEDIA_STICKER = 2
+MEDIA_VIDEO_MESSAGE = 3
+MEDIA_VIDEO_FILE = 4
+MEDIA_AUDIO_FILE = 5
+MEDIA_VOICE_MESSAGE = 6
+MEDIA_ANIMATION = 7
+MEDIA_FILE = 8
+
+MEDIA_TYPE_CODES = {
+    'sticker': MEDIA_STICKER,
+    'video_message': MEDIA_VIDEO_MESSAGE,
+    'video_file': MEDIA_VIDEO_FILE,
+    'audio_file': MEDIA_AUDIO_FILE,
+    'voice_message': MEDIA_VOICE_MESSAGE,
+    'animation': MEDIA_ANIMATION
+}
+
+# Подписи служебных действий
+ACTION_TEXTS = {
+    'joined_telegram': 'присоединился к Telegram',
+    'left_chat': 'покинул чат',
+    'joined_chat': 'присоединился к чату',
+    'created_chat': 'создал чат'
+}
+
+def flatten_text(text):
+    """Склейка текста из списка сущностей Telegram в одну строку"""
+    if isinstance(text, list):
+        return ''.join(item.get('text', '') if isinstance(item, dict) else str(item) for item in text)
+    return text if isinstance(text, str) else str(text or '')
+
+# Подписи времени для каждой минуты суток
+MINUTES_PER_DAY = 24 * 60
+TIME_LABELS = [f"{minute // 60:02d}:{minute % 60:02d}" for minute in range(MINUTES_PER_DAY)]
+UNKNOWN_TIME_LABEL = "--:--"
+
+# Календарь активности в окне перехода к дате
+MONTH_NAMES = ['Январь', 'Февраль', 'Март', 'Апрель', 'Май', 'Июнь',
+               'Июль', 'Август', 'Сентябрь', 'Октябрь', 'Ноябрь', 'Декабрь']
+WEEKDAY_NAMES = ['Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс']
+ACTIVITY_COLORS = ['#1f3a56', '#2b5278', '#3a75a8', '#5bb3f0']
+JUMP_DATE_FORMATS = ('%d.%m.%Y %H:%M', '%d.%m.%Y', '%Y-%m-%d %H:%M', '%Y-%m-%d', '%m.%Y', '%Y')
+
+def parse_message_date(message):
+    """Разбор даты сообщения: (секунды Unix, номер дня, минута суток).
+    
+    Секунды берутся из date_unixtime, если он есть, а день и минута -
+    из date, то есть по часам того, кто делал экспорт. Если не удалось
+    разобрать ни одно из полей, возвращается (MISSING_TIMESTAMP, -1, -1).
+    """
+    wall = None
+    date_str = message.get('date')
+    if isinstance(date_str, str):
+        try:
+            wall = datetime.fromisoformat(date_str.replace('T', ' ').replace('Z', ''))
+        except ValueError:
+            pass
+    
+    timestamp = MISSING_TIMESTAMP
+    unixtime = message.get('date_unixtime')
+    if unixtime is not None:
+        try:
+            timestamp = int(unixtime)
+        except (TypeError, ValueError):
+            pass
+    
+    try:
+        if timestamp == MISSING_TIMESTAMP and wall is not None:
+            timestamp = int(wall.timestamp())
+        elif wall is None and timestamp != MISSING_TIMESTAMP:
+            wall = datetime.fromtimestamp(timestamp)
+    except (OverflowError, OSError, ValueError):
+        return MISSING_TIMESTAMP, -1, -1
+    
+    if wall is None:
+        return MISSING_TIMESTAMP, -1, -1
+    return timestamp, wall.toordinal(), wall.hour * 60 + wall.minute
+
+def normalize_search_text(text, lower=True):
+    """Строка в виде колонки поиска: нижний регистр, ё -> е, единые
+    апострофы, кавычки и тире, совместимые формы (NFKD) без диакритики"""
+    if lower:
+        text = text.lower()
+    text = _SEARCH_FOLD_CHARS.sub(lambda match: SEARCH_FOLD[match.group()], text)
+    if text.isascii():
+        return text
+    text = _COMBINING_MARKS.sub('', unicodedata.normalize('NFKD', text))
+    if '\u0306' in text:
+        text = unicodedata.normalize('NFC', text)
+    return text
+
+class SearchPattern:
+    """Запрос поиска: подстрока, целое слово или регулярное выражение.
+    
+    Запрос приводится к виду колонки поиска (normalize_search_text),
+    поэтому ё/е, разные апострофы и диакритика не мешают совпадению.
+    Регулярное выражение компилируется один раз, без учета регистра;
+    ^ и $ совпадают с началом и концом строк текста, имени и имени
+    файла. Ошибка в выражении - re.error из конструктора.
+    """
+    
+    def __init__(self, query, mode='text'):
+        self.query = query
+        self.mode = mode
+        self.needle = None
+        self.regex = None
+        self.word = None
+        if mode == 'regex':
+            self.regex = re.compile(normalize_search_text(query, lower=False), re.IGNORECASE | re.MULTILINE)
+            return
+        self.needle = normalize_search_text(query)
+        if mode == 'word':
+            self.word = re.compile(r'(?<!\w)' + re.escape(self.needle) + r'(?!\w)')
+    
+    @property
+    def key(self):
+        return (self.mode, self.query)
+    
+    def matches(self, search_text):
+        """Есть ли совпадение в строке поиска сообщения"""
+        if self.regex is not None:
+            return self.regex.search(search_text.replace('\x01', '\n')) is not None
+        if self.word is not None:
+            return self.word.search(search_text) is not None
+        return self.needle in search_text
+    
+    def bounded(self, data, start, end):
+        """Для режима слова: вхождение data[start:end] (UTF-8) не соседствует с буквами и цифрами"""
+        if self.word is None:
+            return True
+        # Соседний байт ASCII (пробел, знак препинания) проверяется без декодирования
+        if start:
+            byte = data[start - 1]
+            char = chr(byte) if byte < 0x80 else data[max(start - 4, 0):start].decode('utf-8', 'ignore')[-1:]
+            if char.isalnum() or char == '_':
+                return False
+        byte = data[end]
+        char = chr(byte) if byte < 0x80 else data[end:end + 4].decode('utf-8', 'ignore')[:1]
+        return not (char.isalnum() or char == '_')
+    
+    def narrows(self, other):
+        """Все совпадения этого запроса есть среди совпадений other (тот же запрос или уточненная подстрока)"""
+        if other is None:
+            return False
+        return self.key == other.key or (self.mode == other.mode == 'text' and other.needle in self.needle)
+    
+    def spans(self, text):
+        """Совпадения в показываемом тексте: список (начало, конец) в позициях text.
+        
+        Текст приводится к виду колонки поиска по кластерам (символ и
+        следующие за ним комбинируемые знаки), и для каждого символа
+        приведенной строки запоминается, из какого кластера он получен,
+        поэтому ё, диакритика и лигатуры подсвечиваются целиком.
+        """
+        if text.isascii():
+            # ASCII не меняет длину при приведении (` -> '), позиции совпадают
+            normalized = normalize_search_text(text)
+            starts = ends = None
+        else:
+            parts = []
+            starts = []
+            ends = []
+            cluster_start = 0
+            for i in range(1, len(text) + 1):
+                if i < len(text) and unicodedata.combining(text[i]):
+                    continue
+                part = normalize_search_text(text[cluster_start:i])
+                parts.append(part)
+                starts.extend([cluster_start] * len(part))
+                ends.extend([i] * len(part))
+                cluster_start = i
+            normalized = ''.join(parts)
+        
+        if self.needle is not None and self.word is None:
+            found = []
+            pos = normalized.find(self.needle) if self.needle else -1
+            while pos >= 0:
+                found.append((pos, pos + len(self.needle)))
+                pos = normalized.find(self.needle, pos + len(self.needle))
+        else:
+            regex = self.regex if self.regex is not None else self.word
+            found = [match.span() for match in regex.finditer(normalized) if match.end() > match.start()]
+        
+        if starts is None:
+            return found
+        return [(starts[start], ends[end - 1]) for start, end in found]
+
+def parse_jump_date(text):
+    """Дата из поля перехода (ДД.ММ.ГГГГ [ЧЧ:ММ], ГГГГ-ММ-ДД, ММ.ГГГГ, ГГГГ):
+    (номер дня, минута суток) или None"""
+    text = ' '.join(text.split())
+    for date_format in JUMP_DATE_FORMATS:
+        try:
+            moment = datetime.strptime(text, date_format)
+        except ValueError:
+            continue
+        return moment.toordinal(), moment.hour * 60 + moment.minute
+    return None
+
+@lru_cache(maxsize=4096)
+def format_day(day_key):
+    """Подпись дня по его номеру (date.toordinal)"""
+    if day_key < 0:
+        return "Неизвестная дата"
+    return date.fromordinal(day_key).strftime('%d.%m.%Y')
+
+@lru_cache(maxsize=None)
+def rounded_corner_offsets(radius):
+    """Смещения точек дуг скругления (шаг 10°) от центров углов; считаются один раз на радиус"""
+    return tuple(
+        (radius * math.cos(math.radians(angle)), radius * math.sin(math.radians(angle)))
+        for angle in range(0, 360, 10)
+    )
+
+@lru_cache(maxsize=512)
+def rounded_rectangle_template(width, height, radius):
+    """Точки скругленного прямоугольника width x height с левым верхним углом в (0, 0).
+    
+    Возвращает отдельно координаты x и y, чтобы сдвиг шаблона в нужное
+    место делался двумя проходами по готовым кортежам.
+    """
+    centers = (
+        (radius, radius),
+        (width - radius, radius),
+        (width - radius, height - radius),
+        (radius, height - radius)
+    )
+    offsets = rounded_corner_offsets(radius)
+    xs = []
+    ys = []
+    for corner, (center_x, center_y) in enumerate(centers):
+        for dx, dy in offsets[corner * 9:corner * 9 + 9]:
+            xs.append(center_x - dx)
+            ys.append(center_y - dy)
+    return tuple(xs), tuple(ys)
+
+class TextMeasurer:
+    """Ширина текста в пикселях и перенос строк по ширине для одного шрифта.
+    
+    measure - функция ширины строки: Font.measure у Tk или
+    ImageFont.getlength у Pillow. Ширины слов и отдельных символов
+    кэшируются (LRU), а ширина строки считается суммой ширин слов и
+    пробелов, поэтому перенос по пикселям почти не дороже переноса по
+    числу символов.
+    """
+    
+    def __init__(self, measure, line_height=0, word_cache_size=50000):
+        self.word_width = lru_cache(maxsize=word_cache_size)(measure)
+        self.char_width = lru_cache(maxsize=4096)(measure)
+        self.space_width = measure(' ')
+        self.line_height = line_height
+    
+    def width(self, text):
+        """Ширина строки"""
+        words = text.split(' ')
+        word_width = self.word_width
+        return sum(word_width(word) for word in words if word) + self.space_width * (len(words) - 1)
+    
+    def wrap(self, text, max_width):
+        """Разбивка текста на строки не шире max_width.
+        
+        Слова длиннее строки режутся по символам. Возвращает строки и
+        ширину самой широкой из них.
+        """
+        word_width = self.word_width
+        space_width = self.space_width
+        lines = []
+        current_line = []
+        current_width = 0
+        widest = 0
+        
+        for word in text.split():
+            width = word_width(word)
+            if current_line and current_width + space_width + width <= max_width:
+                current_line.append(word)
+                current_width += space_width + width
+                continue
+            
+            if current_line:
+                lines.append(' '.join(current_line))
+                widest = max(widest, current_width)
+            if width > max_width:
+                pieces = self.split_word(word, max_width)
+                lines.extend(pieces[:-1])
+                widest = max_width
+                word = pieces[-1]
+                width = word_width(word)
+            current_line = [word]
+            current_width = width
+        
+        if current_line:
+            lines.append(' '.join(current_line))
+            widest = max(widest, current_width)
+        
+        return (lines, widest) if lines else ([""], 0)
+    
+    def split_word(self, word, max_width):
+        """Нарезка слова на куски не шире max_width"""
+        char_width = self.char_width
+        pieces = []
+        start = 0
+        width = 0
+        for i, char in enumerate(word):
+            char_w = char_width(char)
+            if width + char_w > max_width and i > start:
+                pieces.append(word[start:i])
+                start = i
+                width = 0
+            width += char_w
+        pieces.append(word[start:])
+        return pieces
+
+# Фасеты фильтра: колонка хранилища и заголовок в панели фильтров
+FACET_COLUMNS = {
+    'kind': 'kind_codes',
+    'media': 'media_codes',
+    'action': 'action_codes',
+    'sender': 'sender_codes'
+}
+FACET_TITLES = {
+    'kind': "Тип",
+    'media': "Медиа",
+    'action': "Действие",
+    'sender': "Отправитель"
+}
+KIND_FACET_LABELS = {
+    KIND_MESSAGE: "💬 Сообщения",
+    KIND_SERVICE: "⚙️ Служебные"
+}
+MEDIA_FACET_LABELS = {
+    MEDIA_NONE: "Без медиа",
+    MEDIA_PHOTO: "📷 Фото",
+    MEDIA_STICKER: "🎭 Стикеры",
+    MEDIA_VIDEO_MESSAGE: "🎥 Видеосообщения",
+    MEDIA_VIDEO_FILE: "🎥 Видео",
+    MEDIA_AUDIO_FILE: "🎵 Аудио",
+    MEDIA_VOICE_MESSAGE: "🎤 Голосовые",
+    MEDIA_ANIMATION: "🎬 GIF",
+    MEDIA_FILE: "📎 Файлы"
+}
+
+# Файлы, из которых делаются миниатюры (фото, превью видео и стикеров)
+THUMBNAIL_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.gif', '.bmp')
+
+def get_media_path(message):
+    """Путь к картинке сообщения относительно папки экспорта: фото, превью
+    видео или стикера, файл-картинка; '' - картинки нет или она не выгружена"""
+    for key in ('photo', 'thumbnail', 'file'):
+        value = message.get(key)
+        if isinstance(value, str) and value.lower().endswith(THUMBNAIL_EXTENSIONS):
+            return value
+    return ''
+
+def get_media_code(message):
+    """Код медиа в том же порядке проверок, что и в подписи к сообщению"""
+    if 'photo' in message:
+        return MEDIA_PHOTO
+    code = MEDIA_TYPE_CODES.get(message.get('media_type'))
+    if code is not None:
+        return code
+    if 'file' in message:
+        return MEDIA_FILE
+    return MEDIA_NONE
+
+# Фазы для замеров времени: ключ и подпись в строке состояния
+PROFILE_PHASES = [
+    ('read', "чтение"),
+    ('parse', "разбор"),
+    ('cache', "кэш"),
+    ('index', "индекс"),
+    ('search', "поиск"),
+    ('redraw', "отрисовка"),
+    ('layout', "раскладка"),
+    ('export_layout', "экспорт: раскладка"),
+    ('export_render', "экспорт: отрисовка")
+]
+
+def peak_memory_mb():
+    """Пиковый объем памяти процесса в МБ или None, где это не узнать (Windows)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдает килобайты, macOS - байты
+    return round(peak / (1048576 if sys.platform == 'darwin' else 1024), 1)
+
+def format_duration(seconds):
+    """Длительность для строки состояния: мкс, мс или с"""
+    if seconds < 0.001:
+        return f"{seconds * 1e6:.0f} мкс"
+    if seconds < 1:
+        return f"{seconds * 1000:.1f} мс"
+    return f"{seconds:.2f} с"
+
+class PhaseStats:
+    """Накопленные замеры одной фазы"""
+    
+    __slots__ = ('calls', 'seconds', 'max_seconds', 'items', 'last_seconds', 'last_items', 'logged')
+    
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.items = 0
+        self.last_seconds = 0.0
+        self.last_items = 0
+        self.logged = False
+    
+    def as_dict(self):
+        return {'calls': self.calls, 'seconds': round(self.seconds, 6),
+                'max_seconds': round(self.max_seconds, 6), 'items': self.items}
+
+class Measure:
+    """Замер одного вызова фазы: with PROFILER.measure(...) as measure; measure.items = n"""
+    
+    __slots__ = ('profiler', 'phase', 'items', 'log', 'started')
+    
+    def __init__(self, profiler, phase, items, log):
+        self.profiler = profiler
+        self.phase = phase
+        self.items = items
+        self.log = log
+    
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.profiler.record(self.phase, time.perf_counter() - self.started, self.items, self.log)
+        return False
+
+class NullMeasure:
+    """Замер выключенного профилировщика: ничего не делает"""
+    
+    items = 0
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        return False
+    
+    def __setattr__(self, name, value):
+        pass
+
+NULL_MEASURE = NullMeasure()
+
+class Profiler:
+    """Замеры горячих мест: длительность, число элементов и пик памяти.
+    
+    Пока профилировщик выключен, measure() возвращает общий пустой
+    замер, а ручные замеры проверяют только флаг enabled, так что цена
+    инструментовки - один вызов или одна проверка. Включенный копит
+    счетчики по фазам (для строки состояния и итога) и, если задан файл,
+    пишет каждый замер строкой JSON в журнал с ротацией по размеру.
+    Частые фазы (чтение куска файла, раскладка сообщения) пишутся в
+    журнал только итогом при flush().
+    """
+    
+    trace_max_bytes = 5 << 20
+    trace_backups = 3
+    
+    def __init__(self):
+        self.enabled = False
+        self.phases = {}
+        self.logger = None
+        self.lock = threading.Lock()
+    
+    def enable(self, trace_path=None):
+        """Включение замеров; trace_path - файл журнала JSON Lines"""
+        if trace_path and self.logger is None:
+            handler = logging.handlers.RotatingFileHandler(
+                trace_path, maxBytes=self.trace_max_bytes, backupCount=self.trace_backups, encoding='utf-8'
+            )
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self.logger = logging.getLogger('telegram_viewer.profile')
+            self.logger.propagate = False
+            self.logger.setLevel(logging.INFO)
+            self.logger.addHandler(handler)
+        self.enabled = True
+    
+    def disable(self):
+        """Выключение замеров; журнал, если он есть, остается открытым"""
+        self.enabled = False
+    
+    def measure(self, phase, items=0, log=True):
+        """Контекст замера фазы; items можно задать внутри блока"""
+        if not self.enabled:
+            return NULL_MEASURE
+        return Measure(self, phase, items, log)
+    
+    def record(self, phase, seconds, items=0, log=True):
+        """Учет одного замера фазы"""
+        with self.lock:
+            stats = self.phases.get(phase)
+            if stats is None:
+                stats = self.phases[phase] = PhaseStats()
+            stats.calls += 1
+            stats.seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+            stats.items += items
+            stats.last_seconds = seconds
+            stats.last_items = items
+            stats.logged = stats.logged or log
+        
+        if log and self.logger is not None:
+            self.logger.info(json.dumps({
+                'time': datetime.now().isoformat(timespec='milliseconds'),
+                'phase': phase,
+                'seconds': round(seconds, 6),
+                'items': items,
+                'peak_memory_mb': peak_memory_mb()
+            }, ensure_ascii=False))
+    
+    def total_seconds(self, phase):
+        """Сколько всего времени ушло на фазу"""
+        stats = self.phases.get(phase)
+        return stats.seconds if stats is not None else 0.0
+    
+    def summary(self):
+        """Итог по всем фазам для JSON"""
+        with self.lock:
+            return {phase: stats.as_dict() for phase, stats in self.phases.items()}
+    
+    def flush(self):
+        """Запись итога по фазам в журнал"""
+        if self.logger is not None and self.phases:
+            self.logger.info(json.dumps({
+                'time': datetime.now().isoformat(timespec='milliseconds'),
+                'phase': 'summary',
+                'phases': self.summary(),
+                'peak_memory_mb': peak_memory_mb()
+            }, ensure_ascii=False))
+    
+    def status_text(self):
+        """Строка для строки состояния: последние замеры фаз и пик памяти.
+        
+        Для частых фаз показывается среднее на вызов и число вызовов.
+        """
+        parts = []
+        with self.lock:
+            for phase, label in PROFILE_PHASES:
+                stats = self.phases.get(phase)
+                if stats is None:
+                    continue
+                if stats.logged:
+                    text = f"{label} {format_duration(stats.last_seconds)}"
+                    if stats.last_items:
+                        text += f" ({stats.last_items})"
+                else:
+                    text = f"{label} ⌀{format_duration(stats.seconds / stats.calls)} ×{stats.calls}"
+                parts.append(text)
+        peak = peak_memory_mb()
+        if peak is not None:
+            parts.append(f"память {peak:.0f} МБ")
+        return " · ".join(parts) if parts else "Замеры: пока нет данных"
+
+# Общий профилировщик; включается через TELEGRAM_VIEWER_PROFILE, --profile или F12 в окне
+PROFILER = Profiler()
+
+class ChatStats:
+    """Счетчики по всему чату или по результатам поиска.
+    
+    Для всего чата заполняется по ходу загрузки, для результатов поиска
+    считается в потоке поиска только по найденным строкам, поэтому
+    обновление строки статистики при листании ничего не пересчитывает.
+    """
+    
+    def __init__(self):
+        self.total = 0
+        self.service = 0
+        self.sender_counts = Counter()
+    
+    def add(self, kind, sender_code):
+        """Учет одного сообщения"""
+        self.total += 1
+        if kind == KIND_SERVICE:
+            self.service += 1
+        elif sender_code >= 0:
+            self.sender_counts[sender_code] += 1
+    
+    @classmethod
+    def from_rows(cls, store, rows):
+        """Статистика по подмножеству строк хранилища"""
+        stats = cls()
+        kinds = store.kind_codes
+        senders = store.sender_codes
+        for row in rows:
+            stats.add(kinds[row], senders[row])
+        return stats
+    
+    def snapshot(self):
+        """Счетчики в виде, пригодном для JSON"""
+        return {'total': self.total, 'service': self.service,
+                'sender_counts': list(self.sender_counts.items())}
+    
+    @classmethod
+    def restore(cls, data):
+        """Статистика из snapshot()"""
+        stats = cls()
+        stats.total = data['total']
+        stats.service = data['service']
+        stats.sender_counts = Counter(dict(data['sender_counts']))
+        return stats
+    
+    def participants(self, store):
+        """Число участников: разные имена отправителей обычных сообщений"""
+        return len(set(store.senders[code][1] for code in self.sender_counts))
+
+class MessageStore:
+    """Колоночное хранилище сообщений чата.
+    
+    Вместо списка словарей каждое поле лежит в своем массиве, имена
+    отправителей интернированы, а тексты всех сообщений записаны подряд
+    в один буфер UTF-8. Сообщение адресуется номером строки (row),
+    отфильтрованные представления - это массивы номеров строк.
+    
+    Для поиска при загрузке один раз строится колонка search_data:
+    текст, имя отправителя и имя файла в нижнем регистре и без
+    диакритики (normalize_search_text, UTF-8), разделенные байтом 0x01,
+    с байтом 0x00 в конце каждого сообщения.
+    """
+    
+    # Размер блока колонки поиска и шаг по кандидатам между проверками отмены
+    search_block = 1 << 22
+    search_check_every = 4096
+    
+    # Поиск можно ускорить TrigramIndex по колонке search_data
+    trigram_search = True
+    
+    def __init__(self):
+        self.ids = array('q')
+        self.timestamps = array('q')
+        self.day_keys = array('i')
+        self.minutes = array('h')
+        self.sender_codes = array('i')
+        self.kind_codes = array('B')
+        self.media_codes = array('B')
+        self.action_codes = array('H')
+        self.text_offsets = array('Q', [0])
+        self.text_data = bytearray()
+        self.search_offsets = array('Q', [0])
+        self.search_data = bytearray()
+        
+        # Отправители (from_id, имя) и служебные действия хранятся один раз
+        self.senders = []
+        self.sender_index = {}
+        self.actions = ['']
+        self.action_index = {'': 0}
+        
+        # Редкие поля есть только у части сообщений
+        self.file_names = {}
+        self.sticker_emojis = {}
+        self.media_paths = {}
+        
+        # Сколько сообщений пришло с неразборчивой датой
+        self.bad_dates = 0
+        
+        self.stats = ChatStats()
+    
+    def __len__(self):
+        return len(self.ids)
+    
+    def intern_sender(self, from_id, name):
+        """Код отправителя"""
+        key = (from_id or '', name or '')
+        code = self.sender_index.get(key)
+        if code is None:
+            code = self.sender_index[key] = len(self.senders)
+            self.senders.append(key)
+        return code
+    
+    def intern_action(self, action):
+        """Код служебного действия"""
+        action = action or ''
+        code = self.action_index.get(action)
+        if code is None:
+            code = self.action_index[action] = len(self.actions)
+            self.actions.append(action)
+        return code
+    
+    def append(self, message, span=None):
+        """Добавление сообщения из словаря экспорта.
+        
+        span - байтовый диапазон сообщения в файле; он нужен только
+        MappedMessageStore, который не хранит тексты.
+        """
+        self.append_columns(message)
+        text = flatten_text(message.get('text', ''))
+        self.text_data += text.encode('utf-8', 'surrogatepass')
+        self.text_offsets.append(len(self.text_data))
+        self.search_data += (self.search_text_of(message, text) + '\x00').encode('utf-8', 'surrogatepass')
+        self.search_offsets.append(len(self.search_data))
+    
+    @staticmethod
+    def search_text_of(message, text):
+        """Строка поиска сообщения: текст, имя и имя файла через 0x01, каждое
+        в виде normalize_search_text.
+        
+        Служебные сообщения ищутся только по тексту и имени файла.
+        """
+        from_user = '' if message.get('type') == 'service' else (message.get('from') or '')
+        file_name = message.get('file_name') or ''
+        return normalize_search_text(f"{text}\x01{from_user}\x01{file_name}")
+    
+    def append_columns(self, message):
+        """Числовые колонки, отправитель, статистика и редкие поля сообщения; номер строки"""
+        row = len(self.ids)
+        is_service = message.get('type') == 'service'
+        self.ids.append(int(message.get('id') or 0))
+        
+        timestamp, day_key, minute = parse_message_date(message)
+        if day_key < 0:
+            self.bad_dates += 1
+        self.timestamps.append(timestamp)
+        self.day_keys.append(day_key)
+        self.minutes.append(minute)
+        
+        if is_service:
+            self.kind_codes.append(KIND_SERVICE)
+            self.sender_codes.append(self.intern_sender(message.get('actor_id'), message.get('actor')))
+            self.action_codes.append(self.intern_action(message.get('action')))
+        else:
+            self.kind_codes.append(KIND_MESSAGE)
+            if 'from' in message or 'from_id' in message:
+                self.sender_codes.append(self.intern_sender(message.get('from_id'), message.get('from')))
+            else:
+                self.sender_codes.append(-1)
+            self.action_codes.append(0)
+        
+        self.stats.add(self.kind_codes[row], self.sender_codes[row])
+        
+        self.media_codes.append(get_media_code(message))
+        if 'file_name' in message:
+            self.file_names[row] = message.get('file_name') or ''
+        if 'sticker_emoji' in message:
+            self.sticker_emojis[row] = message['sticker_emoji']
+        media_path = get_media_path(message)
+        if media_path:
+            self.media_paths[row] = media_path
+        return row
+    
+    def text(self, row):
+        """Текст сообщения"""
+        start, end = self.text_offsets[row], self.text_offsets[row + 1]
+        return self.text_data[start:end].decode('utf-8', 'surrogatepass')
+    
+    def search_text(self, row):
+        """Строка поиска сообщения (см. search_text_of)"""
+        start, end = self.search_offsets[row], self.search_offsets[row + 1] - 1
+        return self.search_data[start:end].decode('utf-8', 'surrogatepass')
+    
+    def snapshot(self):
+        """Словари хранилища (без колонок) для записи в кэш в виде JSON"""
+        return {
+            'senders': self.senders,
+            'actions': self.actions,
+            'file_names': self.file_names,
+            'sticker_emojis': self.sticker_emojis,
+            'media_paths': self.media_paths,
+            'bad_dates': self.bad_dates,
+            'stats': self.stats.snapshot()
+        }
+    
+    def is_service(self, row):
+        return self.kind_codes[row] == KIND_SERVICE
+    
+    def sender_name(self, row):
+        """Имя отправителя (для служебных сообщений - автор действия)"""
+        code = self.sender_codes[row]
+        return self.senders[code][1] if code >= 0 else ''
+    
+    def sender_id(self, row):
+        code = self.sender_codes[row]
+        return self.senders[code][0] if code >= 0 else ''
+    
+    def action(self, row):
+        return self.actions[self.action_codes[row]]
+    
+    def file_name(self, row, default=''):
+        return self.file_names.get(row) or default
+    
+    def media_path(self, row):
+        """Картинка сообщения относительно папки экспорта (см. get_media_path) или ''"""
+        return self.media_paths.get(row, '')
+    
+    def time_label(self, row):
+        """Время сообщения в виде ЧЧ:ММ"""
+        minute = self.minutes[row]
+        return TIME_LABELS[minute] if minute >= 0 else UNKNOWN_TIME_LABEL
+    
+    def media_text(self, row):
+        """Подпись медиа сообщения"""
+        media = self.media_codes[row]
+        if media == MEDIA_PHOTO:
+            return "📷 Фото"
+        elif media == MEDIA_STICKER:
+            emoji = self.sticker_emojis.get(row, '🎭')
+            return f"{emoji} Стикер"
+        elif media == MEDIA_VIDEO_MESSAGE:
+            return "🎥 Видеосообщение"
+        elif media == MEDIA_VIDEO_FILE:
+            return "🎥 Видео"
+        elif media == MEDIA_AUDIO_FILE:
+            return f"🎵 {self.file_name(row, 'Аудиофайл')}"
+        elif media == MEDIA_VOICE_MESSAGE:
+            return "🎤 Голосовое сообщение"
+        elif media == MEDIA_ANIMATION:
+            return "🎬 GIF анимация"
+        elif media == MEDIA_FILE:
+            return f"📎 {self.file_name(row, 'Файл')}"
+        else:
+            return "Сообщение"
+    
+    def display_text(self, row, max_length):
+        """Текст для пузырька: подпись медиа вместо пустого текста, обрезка по длине"""
+        text = self.text(row)
+        
+        if not text.strip():
+            text = self.media_text(row)
+        
+        if len(text) > max_length:
+            text = text[:max_length] + "..."
+        
+        return text
+    
+    def service_text(self, row):
+        """Строка служебного сообщения: автор, действие и время"""
+        action = self.action(row)
+        return f"{self.sender_name(row)} {ACTION_TEXTS.get(action, action)} • {self.time_label(row)}"
+    
+    def search(self, pattern, index=None, rows=None, cancelled=None):
+        """Номера строк, где есть совпадение с pattern (SearchPattern) в тексте, имени или имени файла.
+        
+        Без индекса это проход bytes.find по колонке search_data: после
+        каждого совпадения поиск продолжается со следующего сообщения.
+        С триграммным индексом проверяются только строки-кандидаты, а rows
+        сужает поиск до уже найденных строк, когда запрос уточняется.
+        Целое слово ищется так же, только у вхождения проверяются соседние
+        символы; регулярное выражение - см. search_regex. Колонка
+        просматривается блоками, между которыми проверяется cancelled;
+        отмененный поиск возвращает None.
+        """
+        if pattern.regex is not None:
+            return self.search_regex(pattern, rows, cancelled)
+        
+        result = array('l')
+        needle = pattern.needle.encode('utf-8', 'surrogatepass')
+        if not needle or b'\x00' in needle or b'\x01' in needle:
+            return result
+        
+        data = self.search_data
+        offsets = self.search_offsets
+        
+        candidates = index.candidates(pattern.needle) if index is not None else None
+        if rows is not None and (candidates is None or len(rows) < len(candidates)):
+            candidates = rows
+        if candidates is not None:
+            for i, row in enumerate(candidates):
+                if i % self.search_check_every == 0 and cancelled is not None and cancelled.is_set():
+                    return None
+                end = offsets[row + 1]
+                hit = data.find(needle, offsets[row], end)
+                while hit != -1 and not pattern.bounded(data, hit, hit + len(needle)):
+                    hit = data.find(needle, hit + 1, end)
+                if hit != -1:
+                    result.append(row)
+            return result
+        
+        pos = 0
+        end = len(data)
+        while pos < end:
+            if cancelled is not None and cancelled.is_set():
+                return None
+            block_end = min(pos + self.search_block, end)
+            # Совпадение может начаться в блоке и закончиться за его границей
+            limit = block_end + len(needle) - 1
+            hit = data.find(needle, pos, limit)
+            while hit != -1:
+                row = bisect.bisect_right(offsets, hit) - 1
+                if pattern.bounded(data, hit, hit + len(needle)):
+                    result.append(row)
+                    pos = offsets[row + 1]
+                else:
+                    pos = hit + 1
+                if pos >= block_end:
+                    break
+                hit = data.find(needle, pos, limit)
+            else:
+                pos = block_end
+        return result
+    
+    def search_regex(self, pattern, rows=None, cancelled=None):
+        """Поиск регулярным выражением по колонке search_data.
+        
+        Колонка декодируется блоками из целых сообщений, в которых
+        разделители 0x00 и 0x01 заменены переводом строки (так ^ и $
+        работают на границах сообщений и полей, как в SearchPattern.matches),
+        и выражение ищется по блоку целиком. Совпадение, захватившее
+        соседнее сообщение, перепроверяется в пределах своего.
+        """
+        result = array('l')
+        if rows is not None:
+            for i, row in enumerate(rows):
+                if i % self.search_check_every == 0 and cancelled is not None and cancelled.is_set():
+                    return None
+                if pattern.matches(self.search_text(row)):
+                    result.append(row)
+            return result
+        
+        data = self.search_data
+        offsets = self.search_offsets
+        row = 0
+        count = len(self)
+        while row < count:
+            if cancelled is not None and cancelled.is_set():
+                return None
+            block_rows = bisect.bisect_left(offsets, offsets[row] + self.search_block, row + 1)
+            block_rows = min(max(block_rows, row + 1), count)
+            block = data[offsets[row]:offsets[block_rows]].decode('utf-8', 'surrogatepass')
+            scan = block.replace('\x00', '\n').replace('\x01', '\n')
+            
+            regex = pattern.regex
+            pos = 0
+            current = row
+            match = regex.search(scan, pos)
+            # Пустое совпадение после последнего сообщения блока не считается
+            while match is not None and match.start() < len(block):
+                current += block.count('\x00', pos, match.start())
+                pos = block.rfind('\x00', 0, match.start()) + 1
+                stop = block.index('\x00', match.start())
+                if match.end() <= stop or regex.search(scan, pos, stop):
+                    result.append(current)
+                pos = stop + 1
+                current += 1
+                match = regex.search(scan, pos)
+            row = block_rows
+        return result
+
+class MappedMessageStore(MessageStore):
+    """MessageStore без текстов для очень больших файлов.
+    
+    Файл отображается в память (mmap), и при загрузке у сообщения кроме
+    колонок запоминается только байтовый диапазон в файле. Текст и строка
+    поиска получаются разбором сообщения из отображения по требованию, а
+    последние record_cache_size разобранных записей держатся в LRU: в
+    памяти остаются колонки и видимое окно, страницами файла управляет
+    система.
+    """
+    
+    trigram_search = False
+    record_cache_size = 4096
+    
+    def __init__(self, mm):
+        super().__init__()
+        self.mm = mm
+        self.starts = array('Q')
+        self.ends = array('Q')
+        self.records = OrderedDict()
+        # Записи запрашивают и окно, и потоки поиска и экспорта
+        self.records_lock = threading.Lock()
+    
+    def append(self, message, span=None):
+        """Колонки сообщения и его диапазон в файле; текст не сохраняется"""
+        self.append_columns(message)
+        self.starts.append(span[0])
+        self.ends.append(span[1])
+    
+    def parse(self, row):
+        """(текст, строка поиска) разбором сообщения из файла, без LRU"""
+        message = json.loads(self.mm[self.starts[row]:self.ends[row]])
+        text = flatten_text(message.get('text', ''))
+        return text, self.search_text_of(message, text)
+    
+    def record(self, row):
+        """(текст, строка поиска) сообщения через LRU разобранных записей"""
+        with self.records_lock:
+            record = self.records.get(row)
+            if record is not None:
+                self.records.move_to_end(row)
+                return record
+        record = self.parse(row)
+        with self.records_lock:
+            self.records[row] = record
+            if len(self.records) > self.record_cache_size:
+                self.records.popitem(last=False)
+        return record
+    
+    def text(self, row):
+        return self.record(row)[0]
+    
+    def search_text(self, row):
+        return self.record(row)[1]
+    
+    def search(self, pattern, index=None, rows=None, cancelled=None):
+        """Номера строк с совпадением pattern проходом по сообщениям в файле; index не нужен.
+        
+        Для подстроки и слова сырые байты сообщения, приведенные как
+        колонка поиска, проверяются без разбора JSON, а разбирается
+        сообщение только при совпадении, если в нем есть экранирование
+        \\u или текст из кусков (совпадение может идти через их границу).
+        Запрос с символами, которые JSON экранирует, и регулярное выражение
+        проверяются разбором каждого сообщения.
+        """
+        result = array('l')
+        query = pattern.needle
+        if query is not None and (not query or '\x00' in query or '\x01' in query):
+            return result
+        
+        raw_check = (query is not None and query.isprintable()
+                     and '"' not in query and '\\' not in query and '/' not in query)
+        mm = self.mm
+        starts = self.starts
+        ends = self.ends
+        for i, row in enumerate(rows if rows is not None else range(len(self))):
+            if i % self.search_check_every == 0 and cancelled is not None and cancelled.is_set():
+                return None
+            if raw_check:
+                raw = normalize_search_text(mm[starts[row]:ends[row]].decode('utf-8', 'replace'))
+                if query not in raw and '\\u' not in raw and not _JSON_LIST_TEXT.search(raw):
+                    continue
+            if pattern.matches(self.parse(row)[1]):
+                result.append(row)
+        return result
+
+class DateIndex:
+    """Индекс дат представления для перехода к дате и календаря активности.
+    
+    keys - отсортированные ключи времени сообщений (номер дня * 1440 +
+    минута суток, по тем же часам, что и разделители дней в ленте),
+    order - позиции сообщений в представлении в том же порядке или None,
+    если представление уже идет по времени (так почти всегда и бывает).
+    days и day_starts - дни, в которых есть сообщения, и номер первого
+    сообщения каждого дня в keys: поиск даты - это bisect по keys, а
+    число сообщений за день - разность соседних day_starts. Сообщения
+    без даты получают ключ -1 и в календарь не попадают.
+    """
+    
+    def __init__(self, store, rows):
+        day_keys = store.day_keys
+        minutes = store.minutes
+        keys = array('q', [
+            day_keys[row] * MINUTES_PER_DAY + minutes[row] if day_keys[row] >= 0 else -1
+            for row in rows
+        ])
+        
+        self.order = None
+        if not all(map(operator.le, keys, keys[1:])):
+            # Сортировка устойчивая: сообщения одной минуты остаются в порядке ленты
+            order = sorted(range(len(keys)), key=keys.__getitem__)
+            self.order = array('l', order)
+            keys = array('q', [keys[index] for index in order])
+        self.keys = keys
+        
+        # Начала дней: от начала каждого дня прыжок бинарным поиском к следующему
+        self.first_dated = bisect.bisect_left(keys, 0)
+        self.days = array('i')
+        self.day_starts = array('l')
+        index = self.first_dated
+        while index < len(keys):
+            day = keys[index] // MINUTES_PER_DAY
+            self.days.append(day)
+            self.day_starts.append(index)
+            index = bisect.bisect_left(keys, (day + 1) * MINUTES_PER_DAY, index)
+        self.day_starts.append(len(keys))
+    
+    def position(self, index):
+        """Позиция в представлении сообщения с номером index в keys"""
+        return self.order[index] if self.order is not None else index
+    
+    def find(self, day, minute=0):
+        """Позиция первого сообщения не раньше дня day и минуты minute.
+        
+        Дата позже последнего сообщения дает последнее сообщение, None -
+        в представлении нет сообщений с датой.
+        """
+        if not self.days:
+            return None
+        index = bisect.bisect_left(self.keys, day * MINUTES_PER_DAY + minute, self.first_dated)
+        return self.position(min(index, len(self.keys) - 1))
+    
+    def day_count(self, day):
+        """Число сообщений за день day"""
+        index = bisect.bisect_left(self.days, day)
+        if index < len(self.days) and self.days[index] == day:
+            return self.day_starts[index + 1] - self.day_starts[index]
+        return 0
+    
+    def month_days(self, year, month):
+        """Сообщения по дням месяца: {число месяца: сообщений}"""
+        first = date(year, month, 1).toordinal()
+        end = date(year + month // 12, month % 12 + 1, 1).toordinal()
+        starts = self.day_starts
+        return {
+            self.days[index] - first + 1: starts[index + 1] - starts[index]
+            for index in range(bisect.bisect_left(self.days, first), bisect.bisect_left(self.days, end))
+        }
+    
+    def months(self):
+        """Месяцы с сообщениями по порядку: [((год, месяц), сообщений)]"""
+        counts = {}
+        starts = self.day_starts
+        for index, day in enumerate(self.days):
+            moment = date.fromordinal(day)
+            key = (moment.year, moment.month)
+            counts[key] = counts.get(key, 0) + starts[index + 1] - starts[index]
+        return list(counts.items())
+
+class FacetIndex:
+    """Фильтр по фасетам (тип, медиа, действие, отправитель) и датам.
+    
+    Значение фасета - код колонки хранилища, для действия - его строка,
+    для отправителя - from_id (под одним from_id может быть несколько
+    кодов, если человек менял имя). Маска значения - байт 0/1 на каждое
+    сообщение, записанный в большое целое; она строится из колонки кодов
+    через bytes.translate, без прохода по сообщениям в Python. Значения
+    одного фасета объединяются (ИЛИ), разные фасеты, даты и текстовый
+    поиск пересекаются (И) - это операции над целыми; строки результата
+    достаются через itertools.compress. Маска текстового поиска
+    запоминается для последнего результата, так что смена фасетов при
+    том же запросе ее не пересобирает. Счетчики значений фасета
+    считаются по маске остальных условий, как принято в фасетном поиске.
+    """
+    
+    # Маски отдельных значений держатся в LRU: каждая - байт на сообщение
+    mask_cache_size = 16
+    
+    def __init__(self, store):
+        self.store = store
+        self.size = len(store)
+        self.sender_values = [from_id or name for from_id, name in store.senders]
+        self.masks = OrderedDict()
+        self.text_mask = None
+        self.dates = None
+        self.lock = threading.Lock()
+    
+    def value_of(self, facet, code):
+        """Значение фасета по коду колонки; None - у сообщения такого значения нет"""
+        if facet == 'sender':
+            return self.sender_values[code] if code >= 0 else None
+        if facet == 'action':
+            return self.store.actions[code] or None
+        return code
+    
+    def values(self, facet):
+        """Значения фасета для панели: [(значение, подпись)] в порядке показа"""
+        if facet == 'kind':
+            return list(KIND_FACET_LABELS.items())
+        if facet == 'media':
+            return list(MEDIA_FACET_LABELS.items())
+        if facet == 'action':
+            return [(action, ACTION_TEXTS.get(action, action)) for action in self.store.actions[1:]]
+        
+        # Отправители - по убыванию числа сообщений, с последним именем
+        names = {}
+        totals = Counter()
+        for code, (from_id, name) in enumerate(self.store.senders):
+            value = self.sender_values[code]
+            names[value] = name or from_id
+            totals[value] += self.store.stats.sender_counts.get(code, 0)
+        return [(value, names[value]) for value in sorted(names, key=lambda value: -totals[value])]
+    
+    def value_codes(self, facet, value):
+        """Коды колонки, которым соответствует значение фасета"""
+        if facet == 'sender':
+            return [code for code, key in enumerate(self.sender_values) if key == value]
+        if facet == 'action':
+            return [code for code, action in enumerate(self.store.actions) if action and action == value]
+        return [value]
+    
+    def codes_mask(self, column, codes):
+        """Маска строк, у которых код в колонке column входит в codes.
+        
+        Байты колонки переводятся в 0/1 таблицей bytes.translate; у кодов
+        шириной в несколько байт каждый разряд берется срезом с шагом
+        itemsize, и маски разрядов пересекаются.
+        """
+        data = column.tobytes()
+        width = column.itemsize
+        result = 0
+        for code in codes:
+            mask = None
+            for shift, byte in enumerate(code.to_bytes(width, sys.byteorder, signed=column.typecode.islower())):
+                table = bytes(byte) + b'\x01' + bytes(255 - byte)
+                plane = data[shift::width] if width > 1 else data
+                bits = int.from_bytes(plane.translate(table), 'little')
+                mask = bits if mask is None else mask & bits
+            result |= mask
+        return result
+    
+    def rows_mask(self, rows):
+        """Маска строк rows"""
+        if isinstance(rows, range):
+            mask = bytes(rows.start) + b'\x01' * len(rows) + bytes(self.size - rows.stop)
+        else:
+            mask = bytearray(self.size)
+            for row in rows:
+                mask[row] = 1
+        return int.from_bytes(mask, 'little')
+    
+    def value_mask(self, facet, value):
+        """Маска сообщений со значением value фасета facet"""
+        key = (facet, value)
+        with self.lock:
+            mask = self.masks.get(key)
+            if mask is not None:
+                self.masks.move_to_end(key)
+                return mask
+        
+        mask = self.codes_mask(getattr(self.store, FACET_COLUMNS[facet]), self.value_codes(facet, value))
+        with self.lock:
+            self.masks[key] = mask
+            while len(self.masks) > self.mask_cache_size:
+                self.masks.popitem(last=False)
+        return mask
+    
+    def date_mask(self, since, until):
+        """Маска сообщений с since по until включительно (номера дней, None - без границы)"""
+        if self.dates is None:
+            self.dates = DateIndex(self.store, range(self.size))
+        keys = self.dates.keys
+        low = bisect.bisect_left(keys, since * MINUTES_PER_DAY) if since is not None else 0
+        high = bisect.bisect_left(keys, (until + 1) * MINUTES_PER_DAY) if until is not None else len(keys)
+        high = max(low, high)
+        if self.dates.order is None:
+            return self.rows_mask(range(low, high))
+        return self.rows_mask(self.dates.order[low:high])
+    
+    def text_rows_mask(self, text_rows):
+        """Маска результата текстового поиска; для того же результата берется готовая"""
+        cached = self.text_mask
+        if cached is not None and cached[0] is text_rows:
+            return cached[1]
+        mask = self.rows_mask(text_rows)
+        self.text_mask = (text_rows, mask)
+        return mask
+    
+    def counts(self, facet, mask):
+        """Число сообщений по значениям фасета среди строк маски (None - все строки)"""
+        column = getattr(self.store, FACET_COLUMNS[facet])
+        if column.itemsize == 1:
+            # Однобайтовые коды (тип, медиа) считаются через bytes.count
+            data = column.tobytes() if mask is None else bytes(compress(column, mask.to_bytes(self.size, 'little')))
+            codes = {code: data.count(code) for code in set(data)}
+        else:
+            if mask is not None:
+                column = compress(column, mask.to_bytes(self.size, 'little'))
+            codes = Counter(column)
+        
+        result = Counter()
+        for code, count in codes.items():
+            value = self.value_of(facet, code)
+            if value is not None:
+                result[value] += count
+        return result
+    
+    def apply(self, selection, text_rows=None, cancelled=None):
+        """Строки, прошедшие фильтр, и счетчики значений всех фасетов.
+        
+        selection - {фасет: frozenset значений} и 'dates': (since, until),
+        text_rows - результат текстового поиска или None. Возвращает
+        (rows, {фасет: Counter}) или None, если поиск отменен.
+        """
+        masks = {}
+        for facet, values in selection.items():
+            if cancelled is not None and cancelled.is_set():
+                return None
+            if facet == 'dates':
+                masks[facet] = self.date_mask(*values)
+                continue
+            mask = 0
+            for value in values:
+                mask |= self.value_mask(facet, value)
+            masks[facet] = mask
+        if text_rows is not None:
+            masks['text'] = self.text_rows_mask(text_rows)
+        
+        mask = intersect_masks(masks.values())
+        if mask is None:
+            rows = range(self.size)
+        elif len(masks) == 1 and text_rows is not None:
+            rows = text_rows
+        else:
+            rows = array('l', compress(range(self.size), mask.to_bytes(self.size, 'little')))
+        
+        counts = {}
+        for facet in FACET_COLUMNS:
+            if cancelled is not None and cancelled.is_set():
+                return None
+            others = intersect_masks(mask for key, mask in masks.items() if key != facet)
+            counts[facet] = self.counts(facet, others)
+        return rows, counts
+
+def intersect_masks(masks):
+    """Пересечение масок FacetIndex; None, если масок нет"""
+    result = None
+    for mask in masks:
+        result = mask if result is None else result & mask
+    return result
+
+def view_positions(view, rows):
+    """Позиции строк rows (по возрастанию) в представлении view; строки вне view пропускаются"""
+    if isinstance(view, range) and view.start == 0 and view.step == 1:
+        return array('l', rows)
+    positions = array('l')
+    view_len = len(view)
+    pos = 0
+    for row in rows:
+        pos = bisect.bisect_left(view, row, pos)
+        if pos == view_len:
+            break
+        if view[pos] == row:
+            positions.append(pos)
+    return positions
+
+class TrigramIndex:
+    """Триграммный индекс по колонке search_data хранилища.
+    
+    Каждой тройке символов сопоставлен отсортированный массив строк,
+    в которых она встречается. Для запроса пересекаются списки всех его
+    триграмм, а точная проверка подстроки делается только по кандидатам,
+    поэтому результат совпадает с обычным поиском.
+    """
+    
+    # Индекс используется, если кандидатов меньше 1/scan_ratio всех строк
+    scan_ratio = 8
+    verify_limit = 64
+    
+    def __init__(self):
+        self.postings = {}
+        self.rows = 0
+        self.build_seconds = 0.0
+        self.nbytes = 0
+    
+    def build(self, store, cancelled=None, on_progress=None, progress_every=50000):
+        """Построение индекса; False, если построение прервано"""
+        started = time.perf_counter()
+        postings = self.postings
+        data = store.search_data
+        offsets = store.search_offsets
+        total = len(store)
+        
+        for row in range(total):
+            segment = data[offsets[row]:offsets[row + 1]].decode('utf-8', 'surrogatepass')
+            for gram in {segment[i:i + 3] for i in range(len(segment) - 2)}:
+                rows = postings.get(gram)
+                if rows is None:
+                    rows = postings[gram] = array('i')
+                rows.append(row)
+            
+            if row % progress_every == 0 and row:
+                if cancelled is not None and cancelled.is_set():
+                    return False
+                if on_progress:
+                    on_progress(row, total)
+        
+        self.rows = total
+        self.build_seconds = time.perf_counter() - started
+        self.nbytes = sys.getsizeof(postings) + sum(
+            sys.getsizeof(gram) + sys.getsizeof(rows) for gram, rows in postings.items()
+        )
+        return True
+    
+    def candidates(self, query):
+        """Отсортированные строки-кандидаты для запроса.
+        
+        None означает, что индекс не поможет: запрос короче триграммы или
+        даже самая редкая его триграмма встречается почти везде, и обычный
+        проход по колонке будет быстрее.
+        """
+        if len(query) < 3:
+            return None
+        
+        lists = []
+        for gram in {query[i:i + 3] for i in range(len(query) - 2)}:
+            rows = self.postings.get(gram)
+            if rows is None:
+                return array('i')
+            lists.append(rows)
+        
+        lists.sort(key=len)
+        if len(lists[0]) * self.scan_ratio > self.rows:
+            return None
+        
+        result = set(lists[0])
+        for rows in lists[1:]:
+            # Немногих кандидатов дешевле проверить, чем пересекать дальше
+            if len(result) < self.verify_limit:
+                break
+            result.intersection_update(rows)
+        return sorted(result)
+
+class TrigramIndexBuilder(threading.Thread):
+    """Фоновое построение TrigramIndex после загрузки чата.
+    
+    События для окна, как у ChatLoader:
+      ('progress', rows_done, total_rows)
+      ('done', index)
+      ('error', exception)
+    """
+    
+    def __init__(self, store):
+        super().__init__(daemon=True)
+        self.store = store
+        self.events = queue.Queue()
+        self.cancelled = threading.Event()
+    
+    def cancel(self):
+        self.cancelled.set()
+    
+    def run(self):
+        try:
+            index = TrigramIndex()
+            on_progress = lambda done, total: self.events.put(('progress', done, total))
+            with PROFILER.measure('index', len(self.store)):
+                built = index.build(self.store, self.cancelled, on_progress)
+            if built:
+                self.events.put(('done', index))
+        except Exception as e:
+            self.events.put(('error', e))
+
+class SearchJob(threading.Thread):
+    """Поиск и фильтр по фасетам в фоновом потоке.
+    
+    pattern - SearchPattern или None, если ищутся только фасеты.
+    Результат кладется в очередь ('done', rows, stats, facet_counts) или
+    ('error', exception), окно забирает его через after(). facet_counts -
+    счетчики FacetIndex.apply или None, если фасеты не заданы; в
+    text_rows остается результат одного текстового поиска, по нему
+    уточняется следующий запрос. found - готовый text_rows для того же
+    запроса (поменялись только фасеты), тогда текст заново не ищется.
+    При find=True (поиск в чате) текст не сужает rows, а позиции
+    совпадений в rows кладутся в hits. Отмененный поиск ничего не сообщает.
+    """
+    
+    def __init__(self, store, pattern, index=None, rows=None, facets=None, selection=None, find=False,
+                 found=None):
+        super().__init__(daemon=True)
+        self.store = store
+        self.pattern = pattern
+        self.index = index
+        self.rows = rows
+        self.facets = facets
+        self.selection = selection or {}
+        self.find = find
+        self.found = found
+        self.text_rows = None
+        self.hits = None
+        self.events = queue.Queue()
+        self.cancelled = threading.Event()
+    
+    def cancel(self):
+        self.cancelled.set()
+    
+    def run(self):
+        try:
+            rows = self.found
+            if self.pattern is not None and rows is None:
+                with PROFILER.measure('search') as measure:
+                    rows = self.store.search(self.pattern, self.index, self.rows, self.cancelled)
+                    measure.items = len(rows) if rows is not None else 0
+                if rows is None:
+                    return
+            self.text_rows = rows
+            if self.find:
+                rows = None
+            
+            counts = None
+            if self.facets is not None:
+                result = self.facets.apply(self.selection, rows, self.cancelled)
+                if result is None:
+                    return
+                rows, counts = result
+            elif rows is None:
+                rows = range(len(self.store))
+            
+            if self.find and self.text_rows is not None:
+                self.hits = view_positions(rows, self.text_rows)
+            
+            stats = self.store.stats if isinstance(rows, range) else ChatStats.from_rows(self.store, rows)
+            self.events.put(('done', rows, stats, counts))
+        except Exception as e:
+            self.events.put(('error', e))
+
+class JsonStreamReader:
+    """Потоковое чтение JSON-документа без загрузки всего дерева в память.
+    
+    Структура (объекты и массивы) обходится вручную, а отдельные значения
+    разбираются через JSONDecoder.raw_decode из буфера, который дочитывается
+    кусками по мере необходимости.
+    """
+    
+    # Одно значение больше этого считается ошибкой разбора: битый файл не
+    # дочитывается в память целиком
+    max_value_size = 256 << 20
+    
+    def __init__(self, f, chunk_size=1 << 20):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        # Позиция в буфере, для которой известно смещение в байтах
+        self.mark_pos = 0
+        self.mark_offset = f.tell()
+    
+    @property
+    def bytes_read(self):
+        """Сколько байт файла уже прочитано"""
+        return self.f.tell()
+    
+    def tell(self):
+        """Смещение текущей позиции разбора в байтах от начала файла.
+        
+        Перекодируется только часть буфера, пройденная с прошлого вызова.
+        """
+        self.mark_offset += len(self.buf[self.mark_pos:self.pos].encode('utf-8', 'surrogatepass'))
+        self.mark_pos = self.pos
+        return self.mark_offset
+    
+    def fill(self, size=None):
+        """Дочитывание следующего куска файла, False в конце файла"""
+        if self.eof:
+            return False
+        with PROFILER.measure('read', log=False) as measure:
+            chunk = self.f.read(size or self.chunk_size)
+            measure.items = len(chunk)
+        # Отбрасываем уже разобранную часть буфера
+        if self.pos:
+            self.tell()
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+            self.mark_pos = 0
+        if not chunk:
+            self.eof = True
+            self.buf += self.utf8.decode(b'', final=True)
+            return False
+        self.buf += self.utf8.decode(chunk)
+        return True
+    
+    def peek(self):
+        """Следующий значащий символ (пробелы пропускаются)"""
+        while True:
+            self.pos = _JSON_WS.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                raise ValueError("Неожиданный конец файла")
+    
+    def expect(self, char):
+        """Пропуск обязательного символа структуры"""
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Ожидался '{char}', найден '{found}' (около байта {self.bytes_read})")
+        self.pos += 1
+    
+    def read_value(self):
+        """Разбор одного JSON-значения целиком"""
+        self.peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if len(self.buf) - self.pos > self.max_value_size or not self.fill(size):
+                    raise
+                # Большое значение: дочитываем всё крупнее, чтобы не разбирать его заново много раз
+                size = min(size * 2, self.max_value_size)
+                continue
+            # Число у края буфера могло быть обрезано: "7." или "1e" разбираются
+            # как 7 и 1. Оно закончено, только если за ним уже виден другой символ
+            if end == len(self.buf) or (type(value) in (int, float) and self.number_cut(end)):
+                if self.fill():
+                    continue
+            self.pos = end
+            return value
+    
+    def number_cut(self, end):
+        """Число, разобранное до end, может продолжаться за краем буфера"""
+        if self.buf[end] in '.eE+-0123456789':
+            return True
+        return _JSON_WS.match(self.buf, end).end() == len(self.buf)
+    
+    def next_item(self, closing):
+        """Разделитель между элементами: True, если контейнер закончился"""
+        found = self.peek()
+        self.pos += 1
+        if found == closing:
+            return True
+        if found != ',':
+            raise ValueError(f"Ожидалась ',' или '{closing}', найден '{found}' (около байта {self.bytes_read})")
+        return False
+    
+    def iter_array(self):
+        """Элементы массива по одному"""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.read_value()
+            if self.next_item(']'):
+                return
+    
+    def iter_array_spans(self):
+        """Элементы массива вместе с их байтовым диапазоном (начало, конец) в файле"""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            self.peek()
+            start = self.tell()
+            value = self.read_value()
+            yield value, (start, self.tell())
+            if self.next_item(']'):
+                return
+    
+    def iter_object_keys(self):
+        """Ключи объекта; значение каждого ключа читает вызывающий код"""
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.read_value()
+            self.expect(':')
+            yield key
+            if self.next_item('}'):
+                return
+
+class ChatEntry:
+    """Чат полного экспорта аккаунта в индексе: без сообщений, только
+    описание и байтовый диапазон объекта чата в файле"""
+    
+    __slots__ = ('section', 'name', 'type', 'id', 'message_count', 'start', 'end')
+    
+    def __init__(self, section, start):
+        self.section = section
+        self.name = ''
+        self.type = ''
+        self.id = None
+        self.message_count = 0
+        self.start = start
+        self.end = start
+    
+    @property
+    def title(self):
+        """Название для списка чатов"""
+        if self.name:
+            return self.name
+        if self.type == 'saved_messages':
+            return "Избранное"
+        return f"Чат {self.id}"
+
+def chat_name(meta):
+    """Название чата по его метаданным"""
+    if meta.get('type') == 'saved_messages':
+        return "Избранное"
+    return meta.get('name') or 'Неизвестный чат'
+
+def find_chat(chats, selector):
+    """Чат индекса по id, точному названию или единственному совпадению части названия"""
+    selector = selector.strip()
+    lowered = selector.lower()
+    for entry in chats:
+        if str(entry.id) == selector or entry.title.lower() == lowered:
+            return entry
+    
+    matches = [entry for entry in chats if lowered in entry.title.lower()]
+    if len(matches) == 1:
+        return matches[0]
+    if not matches:
+        raise ValueError(f"Чат «{selector}» не найден")
+    raise ValueError(f"Под «{selector}» подходят {len(matches)} чатов, уточните название или укажите id")
+
+class ChatLoader(threading.Thread):
+    """Фоновая загрузка result.json.
+    
+    Поток не обращается к Tk: события складываются в очередь,
+    которую окно разбирает через after():
+      ('progress', bytes_read, total_bytes, count)
+      ('tail', meta, store) - массив messages прочитан до конца
+      ('chats', meta, chats) - это полный экспорт аккаунта: вместо
+        сообщений собран индекс чатов (список ChatEntry)
+      ('cache', status) - строка о чтении или записи кэша для статуса
+      ('done', meta)
+      ('error', exception)
+    
+    Полный экспорт (chats.list и left_chats.list) за один проход
+    превращается в индекс: сообщения разбираются только для подсчета и
+    сразу отбрасываются. Затем загрузчик с chat=ChatEntry читает только
+    объект выбранного чата, начиная с его смещения в файле.
+    
+    С cache (ChatCache) уже виденный файл открывается из кэша, а новый
+    после разбора записывается в кэш: 'tail' приходит до записи, так что
+    чат показывается сразу, а 'done' - после нее.
+    
+    Чат от mmap_min_bytes (или при mapped=True) читается через mmap в
+    MappedMessageStore, который вместо текстов хранит диапазоны сообщений
+    в файле.
+    """
+    
+    progress_every = 2000
+    chat_sections = ('chats', 'left_chats')
+    mmap_min_bytes = 512 << 20
+    
+    def __init__(self, file_path, chat=None, cache=None, mapped=None):
+        super().__init__(daemon=True)
+        self.file_path = file_path
+        self.chat = chat
+        self.cache = cache
+        self.mapped = mapped
+        self.events = queue.Queue()
+        self.cancelled = threading.Event()
+    
+    def cancel(self):
+        self.cancelled.set()
+    
+    def run(self):
+        try:
+            meta = self.read_export()
+            if not self.cancelled.is_set():
+                self.events.put(('done', meta))
+        except Exception as e:
+            if not self.cancelled.is_set():
+                self.events.put(('error', e))
+    
+    def read_export(self):
+        """Разбор экспорта: всё, кроме messages, собирается в meta"""
+        start = self.chat.start if self.chat is not None else 0
+        total_bytes = (self.chat.end if self.chat is not None else os.path.getsize(self.file_path)) - start
+        meta = {}
+        chats = []
+        store = None
+        
+        fingerprint = None
+        if self.cache is not None:
+            fingerprint = self.cache.fingerprint(self.file_path)
+            cached = self.read_cache(fingerprint)
+            if cached is not None:
+                return cached
+        
+        mapped = self.mapped if self.mapped is not None else total_bytes >= self.mmap_min_bytes
+        # Время разбора считается без времени чтения файла (фаза read)
+        started = time.perf_counter()
+        read_before = PROFILER.total_seconds('read')
+        with open(self.file_path, 'rb') as f:
+            # Отображение переживает закрытие файла и живет, пока нужно хранилищу
+            source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if mapped else f
+            source.seek(start)
+            reader = JsonStreamReader(source)
+            for key in reader.iter_object_keys():
+                if key in self.chat_sections and self.chat is None and reader.peek() == '{':
+                    self.read_chat_index(reader, key, chats, start, total_bytes)
+                    if self.cancelled.is_set():
+                        return meta
+                    continue
+                if key != 'messages':
+                    meta[key] = reader.read_value()
+                    continue
+                
+                if mapped:
+                    store = MappedMessageStore(source)
+                    messages = reader.iter_array_spans()
+                else:
+                    store = MessageStore()
+                    messages = ((message, None) for message in reader.iter_array())
+                for message, span in messages:
+                    store.append(message, span)
+                    if len(store) % self.progress_every == 0:
+                        if self.cancelled.is_set():
+                            return meta
+                        self.events.put(('progress', reader.bytes_read - start, total_bytes, len(store)))
+                
+                self.events.put(('progress', reader.bytes_read - start, total_bytes, len(store)))
+                self.events.put(('tail', dict(meta), store))
+        
+        if PROFILER.enabled:
+            elapsed = time.perf_counter() - started - (PROFILER.total_seconds('read') - read_before)
+            PROFILER.record('parse', elapsed, len(store) if store is not None else sum(e.message_count for e in chats))
+        if mapped and store is None:
+            source.close()
+        if chats:
+            self.events.put(('chats', dict(meta), chats))
+        if fingerprint is not None and (store is not None or chats):
+            self.write_cache(fingerprint, meta, store, chats)
+        return meta
+    
+    def read_cache(self, fingerprint):
+        """События из кэша вместо разбора; None, если файла в кэше нет"""
+        try:
+            with PROFILER.measure('cache') as measure:
+                cached = self.cache.load(fingerprint, self.chat)
+                measure.items = len(cached[1]) if cached is not None else 0
+        except sqlite3.Error as e:
+            self.events.put(('cache', f"Кэш недоступен: {e}"))
+            return None
+        if cached is None:
+            return None
+        
+        meta, store, chats = cached
+        if chats is not None:
+            self.events.put(('chats', dict(meta), chats))
+        else:
+            self.events.put(('progress', 1, 1, len(store)))
+            self.events.put(('tail', dict(meta), store))
+        self.events.put(('cache', "Открыт из кэша"))
+        return meta
+    
+    def write_cache(self, fingerprint, meta, store, chats):
+        """Запись разобранного файла в кэш; ошибка кэша не мешает загрузке"""
+        self.events.put(('cache', "Запись в кэш..."))
+        started = time.perf_counter()
+        try:
+            with PROFILER.measure('cache', len(store) if store is not None else 0):
+                saved = self.cache.save(fingerprint, meta, store, chats or None, self.chat, self.cancelled)
+        except sqlite3.Error as e:
+            self.events.put(('cache', f"Кэш недоступен: {e}"))
+            return
+        if saved:
+            self.events.put(('cache', f"Кэш записан за {time.perf_counter() - started:.1f} с"))
+    
+    def read_chat_index(self, reader, section, chats, start, total_bytes):
+        """Индекс чатов раздела section: название, тип, id, число сообщений и байтовый диапазон"""
+        counted = sum(entry.message_count for entry in chats)
+        for key in reader.iter_object_keys():
+            if key != 'list':
+                reader.read_value()
+                continue
+            
+            reader.expect('[')
+            if reader.peek() == ']':
+                reader.pos += 1
+                continue
+            
+            while True:
+                reader.peek()
+                entry = ChatEntry(section, reader.tell())
+                for chat_key in reader.iter_object_keys():
+                    if chat_key == 'messages':
+                        for _ in reader.iter_array():
+                            entry.message_count += 1
+                            counted += 1
+                            if counted % self.progress_every == 0:
+                                if self.cancelled.is_set():
+                                    return
+                                self.events.put(('progress', reader.bytes_read - start, total_bytes, counted))
+                        continue
+                    value = reader.read_value()
+                    if chat_key in ('name', 'type', 'id'):
+                        setattr(entry, chat_key, value if chat_key == 'id' else str(value or ''))
+                entry.end = reader.tell()
+                chats.append(entry)
+                if reader.next_item(']'):
+                    break
+
+def default_cache_path():
+    """Файл кэша: TELEGRAM_VIEWER_CACHE или каталог кэша пользователя; None - кэш выключен"""
+    value = os.environ.get('TELEGRAM_VIEWER_CACHE', '')
+    if value.lower() in ('0', 'off', 'no', 'false'):
+        return None
+    if value:
+        return value
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'telegram_chat_viewer', 'cache.sqlite3')
+
+def default_thumbnail_dir():
+    """Каталог дискового кэша миниатюр рядом с базой кэша; None - кэш выключен"""
+    path = default_cache_path()
+    if path is None:
+        return None
+    return os.path.join(os.path.dirname(os.path.abspath(path)), 'thumbnails')
+
+class ChatCache:
+    """Кэш разобранных экспортов в базе SQLite.
+    
+    Файл узнается по пути, размеру, времени изменения и хэшу первого и
+    последнего мегабайта; чат полного экспорта - еще и по смещению его
+    объекта в файле. Для чата в базе лежат числовые колонки MessageStore
+    (по блобу на колонку), тексты страницами по text_page сообщений,
+    строки поиска в таблице FTS5 (search_fts) с триграммами и готовая статистика,
+    для полного экспорта - индекс чатов. Повторное открытие читает
+    только колонки, а тексты и поиск идут запросами (CachedMessageStore).
+    
+    Каждый вызов работает через свое соединение, поэтому кэш можно
+    использовать из потоков загрузки и поиска одновременно.
+    """
+    
+    # 2 - строки поиска приводятся normalize_search_text
+    # 3 - пути к картинкам сообщений (media_paths)
+    schema_version = 3
+    text_page = 256
+    fts_batch = 5000
+    hash_bytes = 1 << 20
+    # После записи старые чаты удаляются, пока база больше max_bytes
+    default_max_bytes = 2 << 30
+    
+    columns = (
+        ('ids', 'q'), ('timestamps', 'q'), ('day_keys', 'i'), ('minutes', 'h'),
+        ('sender_codes', 'i'), ('kind_codes', 'B'), ('media_codes', 'B'), ('action_codes', 'H')
+    )
+    
+    def __init__(self, path, max_bytes=None):
+        self.path = path
+        self.max_bytes = self.default_max_bytes if max_bytes is None else max_bytes
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self.connect() as db:
+            self.create_schema(db)
+    
+    @classmethod
+    def open_default(cls):
+        """Кэш по умолчанию или None, если он выключен или SQLite собран без FTS5"""
+        path = default_cache_path()
+        if path is None or sqlite3 is None:
+            return None
+        try:
+            return cls(path)
+        except (sqlite3.Error, OSError):
+            return None
+    
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+    
+    def create_schema(self, db):
+        """Таблицы кэша; база другой версии схемы очищается"""
+        db.execute("CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT)")
+        row = db.execute("SELECT value FROM info WHERE key = 'schema'").fetchone()
+        if row is not None and row[0] != str(self.schema_version):
+            for table in ('exports', 'columns', 'pages', 'search_fts'):
+                db.execute(f"DROP TABLE IF EXISTS {table}")
+        
+        db.execute("""CREATE TABLE IF NOT EXISTS exports (
+            id INTEGER PRIMARY KEY,
+            path TEXT NOT NULL,
+            chat_start INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            hash TEXT NOT NULL,
+            title TEXT NOT NULL,
+            meta TEXT,
+            extra TEXT,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            data_bytes INTEGER NOT NULL DEFAULT 0,
+            complete INTEGER NOT NULL DEFAULT 0,
+            used REAL NOT NULL,
+            UNIQUE (path, chat_start))""")
+        db.execute("""CREATE TABLE IF NOT EXISTS columns (
+            export_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            data BLOB NOT NULL,
+            PRIMARY KEY (export_id, name))""")
+        db.execute("""CREATE TABLE IF NOT EXISTS pages (
+            export_id INTEGER NOT NULL,
+            page INTEGER NOT NULL,
+            offsets BLOB NOT NULL,
+            data BLOB NOT NULL,
+            PRIMARY KEY (export_id, page))""")
+        # rowid строки поиска - (export_id << 32) + номер строки хранилища
+        db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(search, tokenize='trigram')")
+        db.execute("INSERT OR REPLACE INTO info VALUES ('schema', ?)", (str(self.schema_version),))
+    
+    @classmethod
+    def fingerprint(cls, file_path):
+        """(путь, размер, mtime_ns, хэш начала и конца файла)"""
+        info = os.stat(file_path)
+        digest = hashlib.blake2b(digest_size=16)
+        with open(file_path, 'rb') as f:
+            digest.update(f.read(cls.hash_bytes))
+            if info.st_size > 2 * cls.hash_bytes:
+                f.seek(-cls.hash_bytes, os.SEEK_END)
+                digest.update(f.read())
+        return os.path.abspath(file_path), info.st_size, info.st_mtime_ns, digest.hexdigest()
+    
+    def load(self, fingerprint, chat=None):
+        """(meta, store, chats) из кэша или None, если файл не кэширован или изменился.
+        
+        Для полного экспорта store пустое, а chats - индекс чатов, как у
+        ChatLoader; для чата chats равен None.
+        """
+        path, size, mtime_ns, digest = fingerprint
+        chat_start = chat.start if chat is not None else -1
+        with closing(self.connect()) as db:
+            row = db.execute(
+                "SELECT id, size, mtime_ns, hash, meta, extra FROM exports "
+                "WHERE path = ? AND chat_start = ? AND complete = 1",
+                (path, chat_start)
+            ).fetchone()
+            if row is None or tuple(row[1:4]) != (size, mtime_ns, digest):
+                return None
+            export_id, meta, extra = row[0], json.loads(row[4]), json.loads(row[5])
+            
+            if 'chats' in extra:
+                chats = []
+                for item in extra['chats']:
+                    entry = ChatEntry(item['section'], item['start'])
+                    for key in ('name', 'type', 'id', 'message_count', 'end'):
+                        setattr(entry, key, item[key])
+                    chats.append(entry)
+                store = MessageStore()
+            else:
+                chats = None
+                store = CachedMessageStore(self, export_id)
+                for name, data in db.execute("SELECT name, data FROM columns WHERE export_id = ?", (export_id,)):
+                    column = getattr(store, name)
+                    column.frombytes(data)
+                store.restore(extra)
+            
+            with db:
+                db.execute("UPDATE exports SET used = ? WHERE id = ?", (time.time(), export_id))
+        return meta, store, chats
+    
+    def save(self, fingerprint, meta, store=None, chats=None, chat=None, cancelled=None):
+        """Запись разобранного чата или индекса полного экспорта; False, если запись отменена"""
+        path, size, mtime_ns, digest = fingerprint
+        chat_start = chat.start if chat is not None else -1
+        
+        if chats is not None:
+            extra = {'chats': [
+                {key: getattr(entry, key) for key in ChatEntry.__slots__} for entry in chats
+            ]}
+            count = sum(entry.message_count for entry in chats)
+            title = f"Полный экспорт, чатов: {len(chats)}"
+        else:
+            extra = store.snapshot()
+            count = len(store)
+            title = chat_name(meta)
+        
+        with closing(self.connect()) as db:
+            with db:
+                self.delete(db, "path = ? AND chat_start = ?", (path, chat_start))
+                before = self.used_bytes(db)
+                export_id = db.execute(
+                    "INSERT INTO exports (path, chat_start, size, mtime_ns, hash, title, meta, extra, "
+                    "message_count, used) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (path, chat_start, size, mtime_ns, digest, title,
+                     json.dumps(meta), json.dumps(extra),
+                     count, time.time())
+                ).lastrowid
+                
+                if chats is None and not self.write_store(db, export_id, store, cancelled):
+                    db.rollback()
+                    return False
+                db.execute("UPDATE exports SET complete = 1, data_bytes = ? WHERE id = ?",
+                           (max(self.used_bytes(db) - before, 0), export_id))
+            
+            self.trim(db, self.max_bytes, keep=export_id)
+        return True
+    
+    def write_store(self, db, export_id, store, cancelled=None):
+        """Колонки, страницы текстов и строки поиска хранилища"""
+        db.executemany(
+            "INSERT INTO columns VALUES (?, ?, ?)",
+            ((export_id, name, getattr(store, name).tobytes()) for name, _ in self.columns)
+        )
+        
+        page_size = self.text_page
+        for page, start in enumerate(range(0, len(store), page_size)):
+            texts = [store.text(row).encode('utf-8', 'surrogatepass')
+                     for row in range(start, min(start + page_size, len(store)))]
+            offsets = array('Q', [0])
+            for text in texts:
+                offsets.append(offsets[-1] + len(text))
+            db.execute(
+                "INSERT INTO pages VALUES (?, ?, ?, ?)",
+                (export_id, page, offsets.tobytes(), b''.join(texts))
+            )
+        
+        # SQLite не принимает одиночные суррогаты, они заменяются
+        base = export_id << 32
+        for start in range(0, len(store), self.fts_batch):
+            if cancelled is not None and cancelled.is_set():
+                return False
+            end = min(start + self.fts_batch, len(store))
+            db.executemany("INSERT INTO search_fts (rowid, search) VALUES (?, ?)", (
+                (base + row, store.search_text(row).encode('utf-8', 'surrogatepass').decode('utf-8', 'replace'))
+                for row in range(start, end)
+            ))
+        return True
+    
+    def delete(self, db, where, params=()):
+        """Удаление записей exports по условию вместе с их данными; число удаленных"""
+        ids = [row[0] for row in db.execute(f"SELECT id FROM exports WHERE {where}", params)]
+        for export_id in ids:
+            db.execute("DELETE FROM columns WHERE export_id = ?", (export_id,))
+            db.execute("DELETE FROM pages WHERE export_id = ?", (export_id,))
+            db.execute("DELETE FROM search_fts WHERE rowid BETWEEN ? AND ?",
+                       (export_id << 32, ((export_id + 1) << 32) - 1))
+            db.execute("DELETE FROM exports WHERE id = ?", (export_id,))
+        return len(ids)
+    
+    def used_bytes(self, db):
+        """Занятый данными объем базы без свободных страниц"""
+        page_size = db.execute("PRAGMA page_size").fetchone()[0]
+        pages = db.execute("PRAGMA page_count").fetchone()[0]
+        free = db.execute("PRAGMA freelist_count").fetchone()[0]
+        return (pages - free) * page_size
+    
+    def trim(self, db, max_bytes, keep=None):
+        """Удаление давно не открывавшихся записей, пока они вместе больше max_bytes.
+        
+        Объем записи (data_bytes) измеряется при сохранении. Удаленные
+        строки FTS5 остаются в индексе отметками до слияния сегментов:
+        здесь делается только частичное слияние, а место на диске
+        возвращает vacuum(). Запись keep (только что сохраненная) не
+        удаляется. Возвращает число удаленных записей.
+        """
+        total = db.execute("SELECT COALESCE(SUM(data_bytes), 0) FROM exports").fetchone()[0]
+        removed = 0
+        with db:
+            for export_id, data_bytes in db.execute(
+                    "SELECT id, data_bytes FROM exports WHERE id IS NOT ? ORDER BY used", (keep,)).fetchall():
+                if total <= max_bytes:
+                    break
+                removed += self.delete(db, "id = ?", (export_id,))
+                total -= data_bytes
+            if removed:
+                db.execute("INSERT INTO search_fts (search_fts, rank) VALUES ('merge', 500)")
+        return removed
+    
+    def entries(self):
+        """Записи кэша: (путь, смещение чата или -1, сообщений, название, байт, время открытия)"""
+        with closing(self.connect()) as db:
+            return db.execute(
+                "SELECT path, chat_start, message_count, title, data_bytes, used FROM exports "
+                "WHERE complete = 1 ORDER BY used DESC"
+            ).fetchall()
+    
+    def size(self):
+        """Размер файла базы вместе с журналом WAL"""
+        return sum(os.path.getsize(path) for path in (self.path, self.path + '-wal')
+                   if os.path.exists(path))
+    
+    def remove(self, file_path):
+        """Удаление всех записей файла (и всех его чатов); число удаленных"""
+        with closing(self.connect()) as db:
+            with db:
+                return self.delete(db, "path = ?", (os.path.abspath(file_path),))
+    
+    def clear(self):
+        """Удаление всех записей"""
+        with closing(self.connect()) as db:
+            with db:
+                removed = self.delete(db, "1")
+        self.vacuum()
+        return removed
+    
+    def shrink(self, max_bytes):
+        """Ограничение размера кэша: удаление старых записей и сжатие файла"""
+        with closing(self.connect()) as db:
+            removed = self.trim(db, max_bytes)
+        self.vacuum()
+        return removed
+    
+    def vacuum(self):
+        """Сжатие файла базы после удаления записей"""
+        with closing(self.connect()) as db:
+            with db:
+                db.execute("INSERT INTO search_fts (search_fts) VALUES ('optimize')")
+            db.execute("VACUUM")
+            db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+class CachedMessageStore(MessageStore):
+    """MessageStore, открытый из ChatCache.
+    
+    Числовые колонки, отправители и статистика лежат в памяти, как у
+    обычного хранилища, а тексты читаются из базы страницами, из которых
+    в памяти держатся последние pages_max (LRU). Поиск идет запросом к
+    таблице FTS5: триграммы дают кандидатов, instr проверяет подстроку,
+    так что результат совпадает с обычным поиском.
+    """
+    
+    trigram_search = False
+    pages_max = 64
+    # Шаг виртуальной машины SQLite между проверками отмены поиска
+    search_check_steps = 100000
+    
+    def __init__(self, cache, export_id):
+        super().__init__()
+        self.cache = cache
+        self.export_id = export_id
+        self.text_page = cache.text_page
+        self.pages = OrderedDict()
+        self.db = cache.connect()
+        # Страницы текстов запрашивают и окно, и поток экспорта
+        self.db_lock = threading.Lock()
+    
+    def restore(self, extra):
+        """Словари хранилища из MessageStore.snapshot()"""
+        self.senders = [tuple(sender) for sender in extra['senders']]
+        self.sender_index = {sender: code for code, sender in enumerate(self.senders)}
+        self.actions = extra['actions']
+        self.action_index = {action: code for code, action in enumerate(self.actions)}
+        self.file_names = {int(row): name for row, name in extra['file_names'].items()}
+        self.sticker_emojis = {int(row): emoji for row, emoji in extra['sticker_emojis'].items()}
+        self.media_paths = {int(row): path for row, path in extra['media_paths'].items()}
+        self.bad_dates = extra['bad_dates']
+        self.stats = ChatStats.restore(extra['stats'])
+    
+    def text(self, row):
+        """Текст сообщения со страницы из базы"""
+        page, index = divmod(row, self.text_page)
+        with self.db_lock:
+            texts = self.pages.get(page)
+            if texts is None:
+                offsets, data = self.db.execute(
+                    "SELECT offsets, data FROM pages WHERE export_id = ? AND page = ?",
+                    (self.export_id, page)
+                ).fetchone()
+                texts = self.pages[page] = (array('Q', offsets), data)
+                if len(self.pages) > self.pages_max:
+                    self.pages.popitem(last=False)
+            else:
+                self.pages.move_to_end(page)
+        offsets, data = texts
+        return data[offsets[index]:offsets[index + 1]].decode('utf-8', 'surrogatepass')
+    
+    def search(self, pattern, index=None, rows=None, cancelled=None):
+        """Номера строк с совпадением pattern по таблице FTS5; index и rows не нужны.
+        
+        Запрос короче триграммы проверяется проходом instr по строкам чата.
+        Целое слово и регулярное выражение дополнительно проверяются
+        функцией search_match (SearchPattern.matches) в самом запросе.
+        Поиск идет в своем соединении, чтобы не задерживать чтение текстов,
+        а отмененный возвращает None.
+        """
+        result = array('l')
+        query = pattern.needle
+        if query is not None and (not query or '\x00' in query or '\x01' in query):
+            return result
+        
+        base = self.export_id << 32
+        bounds = (base, base + len(self) - 1)
+        if query is None:
+            sql = "SELECT rowid FROM search_fts WHERE rowid BETWEEN ? AND ? AND search_match(search) ORDER BY rowid"
+            params = bounds
+        else:
+            where = "rowid BETWEEN ? AND ? AND instr(search, ?) > 0"
+            params = bounds + (query,)
+            if len(query) >= 3:
+                where = "search_fts MATCH ? AND " + where
+                params = ('"' + query.replace('"', '""') + '"',) + params
+            if pattern.word is not None:
+                where += " AND search_match(search)"
+            sql = f"SELECT rowid FROM search_fts WHERE {where} ORDER BY rowid"
+        
+        with closing(self.cache.connect()) as db:
+            db.create_function('search_match', 1, pattern.matches, deterministic=True)
+            if cancelled is not None:
+                db.set_progress_handler(cancelled.is_set, self.search_check_steps)
+            try:
+                for (rowid,) in db.execute(sql, params):
+                    result.append(rowid - base)
+            except sqlite3.OperationalError:
+                if cancelled is None or not cancelled.is_set():
+                    raise
+        if cancelled is not None and cancelled.is_set():
+            return None
+        return result
+
+class MessageLayout:
+    """Геометрия сообщения без привязки к месту в ленте.
+    
+    Зависит только от строки хранилища и ширины переноса width, поэтому
+    переживает прокрутку, поиск и смену представления.
+    """
+    
+    __slots__ = ('width', 'height', 'time', 'is_service', 'text',
+                 'is_my', 'name', 'lines', 'bubble_width', 'bubble_height', 'thumb')
+
+class MessageBlock:
+    """Сообщение на своем месте в ленте: геометрия, отступ сверху и разделитель дня"""
+    
+    __slots__ = ('layout', 'top', 'date_label', 'height')
+    
+    def __init__(self, layout, top, date_label, height):
+        self.layout = layout
+        self.top = top
+        self.date_label = date_label
+        self.height = height
+
+class HeightIndex:
+    """Префиксные суммы высот сообщений ленты (дерево Фенвика).
+    
+    Высота еще не измеренного сообщения принимается равной estimate, а
+    дерево хранит только отклонения измеренных высот от оценки. Поэтому
+    индекс для представления любого размера создается одним выделением
+    памяти, а координата сообщения и сообщение под координатой
+    находятся за O(log n).
+    """
+    
+    def __init__(self, size, estimate):
+        self.size = size
+        self.estimate = estimate
+        self.tree = array('q', bytes(8 * (size + 1)))
+        self.heights = array('H', bytes(2 * size))
+        self.total_delta = 0
+        self.top_step = 1 << size.bit_length() >> 1
+    
+    def __len__(self):
+        return self.size
+    
+    def height(self, pos):
+        """Измеренная или оценочная высота сообщения pos"""
+        return self.heights[pos] or self.estimate
+    
+    def set_height(self, pos, height):
+        """Запись измеренной высоты сообщения pos"""
+        height = min(height, 0xFFFF)
+        delta = height - (self.heights[pos] or self.estimate)
+        self.heights[pos] = height
+        if not delta:
+            return
+        
+        self.total_delta += delta
+        tree = self.tree
+        i = pos + 1
+        while i <= self.size:
+            tree[i] += delta
+            i += i & -i
+    
+    def offset_of(self, pos):
+        """Координата верха сообщения pos от начала ленты"""
+        total = pos * self.estimate
+        tree = self.tree
+        i = pos
+        while i > 0:
+            total += tree[i]
+            i &= i - 1
+        return total
+    
+    def total(self):
+        """Высота всей ленты"""
+        return self.size * self.estimate + self.total_delta
+    
+    def find(self, y):
+        """Сообщение под координатой y и сдвиг от его верха"""
+        if y <= 0 or not self.size:
+            return 0, 0
+        
+        tree = self.tree
+        estimate = self.estimate
+        pos = 0
+        step = self.top_step
+        while step:
+            next_pos = pos + step
+            if next_pos <= self.size:
+                block = tree[next_pos] + step * estimate
+                if block <= y:
+                    pos = next_pos
+                    y -= block
+            step >>= 1
+        
+        if pos >= self.size:
+            pos = self.size - 1
+            y += self.height(pos)
+        return pos, y
+
+def load_thumbnail(path, max_width, max_height, cache_dir=None):
+    """Уменьшенная копия картинки path (PIL, RGB или RGBA) не больше max_width x max_height.
+    
+    JPEG декодируется сразу в уменьшенном масштабе (Image.draft), так что
+    большое фото не разворачивается в память целиком. С cache_dir готовая
+    миниатюра сохраняется на диск под ключом из пути, размера и времени
+    изменения файла и размеров миниатюры, и повторно файл не декодируется.
+    Нечитаемая картинка - OSError (или ValueError от Pillow).
+    """
+    info = os.stat(path)
+    cached_path = None
+    if cache_dir:
+        key = f"{os.path.abspath(path)}|{info.st_size}|{info.st_mtime_ns}|{max_width}x{max_height}"
+        digest = hashlib.sha1(key.encode('utf-8', 'surrogatepass')).hexdigest()
+        cached_path = os.path.join(cache_dir, digest[:2], digest)
+        try:
+            with Image.open(cached_path) as cached:
+                cached.load()
+                return cached.copy()
+        except OSError:
+            pass
+    
+    with Image.open(path) as img:
+        img.draft('RGB', (max_width, max_height))
+        has_alpha = img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info
+        img.thumbnail((max_width, max_height))
+        thumb = img.convert('RGBA' if has_alpha else 'RGB')
+    
+    if cached_path:
+        # Запись через временный файл, чтобы параллельные загрузчики не видели половину
+        temp_path = f"{cached_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(cached_path), exist_ok=True)
+            if has_alpha:
+                thumb.save(temp_path, 'PNG')
+            else:
+                thumb.save(temp_path, 'JPEG', quality=85)
+            os.replace(temp_path, cached_path)
+        except OSError:
+            # Без кэша миниатюра просто будет декодирована заново
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+    return thumb
+
+class ThumbnailLoader:
+    """Миниатюры картинок для ленты: фоновое декодирование и LRU, ограниченный по байтам.
+    
+    Ключ миниатюры - (путь, ширина, высота). request() ставит картинку в
+    пул потоков, поток уменьшает ее (load_thumbnail) и кладет результат в
+    очередь. Окно забирает готовые миниатюры через collect() в потоке Tk,
+    превращает их в изображения Tk (make_image) и держит в LRU не больше
+    max_bytes (4 байта на пиксель). Изображение, вытесненное из LRU, живет,
+    пока его показывает набор элементов ленты. Задачи, ключей которых уже
+    нет в окрестности окна (want), пропускаются, не начавшись, поэтому
+    быстрая прокрутка не копит очередь.
+    
+    Наличие файла тоже проверяется в пуле, а не в потоке Tk: пути
+    отсутствующих и нечитаемых картинок собираются в failed, и окно
+    раскладывает такие сообщения заново, с подписью вместо рамки.
+    """
+    
+    def __init__(self, make_image, max_bytes=64 << 20, workers=None, cache_dir=None):
+        self.make_image = make_image
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.images = OrderedDict()
+        self.bytes = 0
+        self.pending = set()
+        self.futures = {}
+        self.failed = set()
+        self.wanted = frozenset()
+        self.results = queue.Queue()
+        self.executor = ThreadPoolExecutor(workers or min(4, os.cpu_count() or 1), thread_name_prefix='thumbnail')
+    
+    def get(self, key):
+        """Готовое изображение или None"""
+        entry = self.images.get(key)
+        if entry is None:
+            return None
+        self.images.move_to_end(key)
+        return entry[0]
+    
+    def request(self, key):
+        """Запрос миниатюры; готовая появится в collect()"""
+        if key in self.pending or key[0] in self.failed or key in self.images:
+            return
+        self.pending.add(key)
+        self.wanted = self.wanted | {key}
+        self.futures[key] = self.executor.submit(self.decode, key)
+    
+    def want(self, keys):
+        """Ключи, которые еще нужны (сообщения в окне и около него)"""
+        self.wanted = frozenset(keys)
+    
+    def decode(self, key):
+        """Декодирование в потоке пула"""
+        if key not in self.wanted:
+            self.results.put((key, None, True))
+            return
+        # Отсутствующая или нечитаемая картинка остается подписью медиа и больше не запрашивается
+        try:
+            image = load_thumbnail(*key, self.cache_dir)
+        except Exception:
+            image = None
+        self.results.put((key, image, False))
+    
+    def collect(self):
+        """Результаты пула (в потоке Tk): множества ключей, для которых появились
+        изображения, и ключей, картинки которых не удалось загрузить"""
+        ready = set()
+        failed = set()
+        while True:
+            try:
+                key, image, skipped = self.results.get_nowait()
+            except queue.Empty:
+                return ready, failed
+            if key not in self.pending:
+                # Задача, запущенная до clear()
+                continue
+            self.pending.discard(key)
+            self.futures.pop(key, None)
+            if skipped:
+                # Ключ снова понадобился, пока задача ждала в очереди
+                if key in self.wanted:
+                    self.request(key)
+            elif image is None:
+                self.failed.add(key[0])
+                failed.add(key)
+            else:
+                self.put(key, self.make_image(image), image.width * image.height * 4)
+                ready.add(key)
+    
+    def put(self, key, image, size):
+        self.images[key] = (image, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes and len(self.images) > 1:
+            _, (_, evicted) = self.images.popitem(last=False)
+            self.bytes -= evicted
+    
+    def clear(self):
+        """Сброс при смене чата: задачи в очереди отменяются, результаты уже начатых отбрасываются"""
+        for future in self.futures.values():
+            future.cancel()
+        self.futures.clear()
+        self.pending.clear()
+        self.images.clear()
+        self.bytes = 0
+        self.failed.clear()
+        self.wanted = frozenset()
+    
+    def shutdown(self):
+        """Остановка пула при закрытии окна"""
+        self.clear()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+class CanvasMessageSlot:
+    """Набор элементов Canvas для одного сообщения ленты.
+    
+    Элементы создаются один раз, при прокрутке переставляются
+    через coords()/itemconfigure(), а ненужные скрываются. Прямоугольники
+    подсветки совпадений (marks) добавляются по мере надобности и лежат
+    между пузырьком и текстом. photo держит показанную миниатюру, пока
+    набор ее показывает, даже если ThumbnailLoader ее уже вытеснил.
+    """
+    
+    def __init__(self, canvas, colors, fonts):
+        self.canvas = canvas
+        self.tag = f"slot{id(self)}"
+        self.block = None
+        self.y = 0
+        self.shown = set()
+        self.marks = []
+        # Начало текста сообщения относительно y (None у служебных сообщений)
+        self.text_origin = None
+        self.photo = None
+        
+        options = {'state': 'hidden', 'tags': ('message', self.tag)}
+        self.date_bg = canvas.create_rectangle(0, 0, 0, 0, fill=colors['date_bg'], outline="", **options)
+        self.date_text = canvas.create_text(0, 0, fill=colors['time'], font=fonts['date'], **options)
+        self.service_text = canvas.create_text(0, 0, fill=colors['service'], font=fonts['service'], **options)
+        self.bubble = canvas.create_polygon(0, 0, 0, 0, 0, 0, smooth=True, outline="", **options)
+        self.tail = canvas.create_polygon(0, 0, 0, 0, 0, 0, outline="", **options)
+        self.thumb_bg = canvas.create_rectangle(0, 0, 0, 0, fill=colors['thumb_bg'], outline="", **options)
+        self.thumb_image = canvas.create_image(0, 0, anchor='center', **options)
+        self.name_text = canvas.create_text(
+            0, 0, fill=colors['name'], font=fonts['name'], anchor='nw', **options
+        )
+        self.body_text = canvas.create_text(0, 0, fill=colors['text'], font=fonts['body'], anchor='nw', **options)
+        self.time_text = canvas.create_text(0, 0, fill=colors['time'], font=fonts['time'], anchor='nw', **options)
+    
+    def mark(self, index):
+        """Прямоугольник подсветки номер index (создается при первом обращении)"""
+        while len(self.marks) <= index:
+            item = self.canvas.create_rectangle(0, 0, 0, 0, outline="", state='hidden', tags=('message', self.tag))
+            self.canvas.tag_lower(item, self.body_text)
+            self.marks.append(item)
+        return self.marks[index]
+    
+    def show_only(self, items):
+        """Показ перечисленных элементов и скрытие остальных"""
+        for item in self.shown - items:
+            self.canvas.itemconfigure(item, state='hidden')
+        for item in items - self.shown:
+            self.canvas.itemconfigure(item, state='normal')
+        self.shown = items
+    
+    def hide(self):
+        self.show_only(set())
+        self.block = None
+        self.photo = None
+
+def compress_png_rows(data, stride, level=6):
+    """Сжатие строк RGB-пикселей для PNG в самостоятельный кусок потока deflate.
+    
+    Перед каждой строкой ставится байт фильтра 0 (без фильтра), кусок
+    заканчивается полным сбросом. Возвращает (сжатые байты, adler32 и
+    длину несжатых данных): по ним PngStreamWriter склеивает куски,
+    сжатые в разных процессах, в один поток zlib.
+    """
+    rows = len(data) // stride
+    raw = bytearray(rows * (stride + 1))
+    view = memoryview(data)
+    for i in range(rows):
+        start = i * (stride + 1) + 1
+        raw[start:start + stride] = view[i * stride:(i + 1) * stride]
+    
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(raw) + compressor.flush(zlib.Z_FULL_FLUSH)
+    return compressed, zlib.adler32(raw), len(raw)
+
+def adler32_combine(adler1, adler2, length2):
+    """adler32 склеенных данных по контрольным суммам частей (как в zlib)"""
+    base = 65521
+    rem = length2 % base
+    sum1 = adler1 & 0xFFFF
+    sum2 = (rem * sum1 + (adler1 >> 16) + (adler2 >> 16) + base - rem) % base
+    sum1 = (sum1 + (adler2 & 0xFFFF) + base - 1) % base
+    return (sum2 << 16) | sum1
+
+class PngStreamWriter:
+    """Запись RGB-изображения в PNG полосами, без сборки кадра в памяти.
+    
+    Высота известна заранее и пишется в заголовок. Полосы приходят
+    сжатыми кусками compress_png_rows (их можно готовить параллельно)
+    и сразу уходят в файл блоками IDAT. При ошибке внутри with
+    недописанный файл удаляется.
+    """
+    
+    chunk_size = 1 << 20
+    
+    def __init__(self, path, width, height, compress_level=6):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.stride = width * 3
+        self.compress_level = compress_level
+        self.rows_written = 0
+        self.adler = 1
+        # Заголовок потока zlib: deflate, окно 32 КБ
+        self.pending = bytearray(b'\x78\x9c')
+        
+        self.file = open(path, 'wb')
+        self.file.write(b'\x89PNG\r\n\x1a\n')
+        # 8 бит на канал, тип цвета 2 (RGB), без чересстрочности
+        self.write_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+            os.remove(self.path)
+    
+    def write_chunk(self, kind, data):
+        self.file.write(struct.pack('>I', len(data)))
+        self.file.write(kind)
+        self.file.write(data)
+        self.file.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(kind))))
+    
+    def write_rows(self, data):
+        """Добавление строк пикселей (байты RGB, как у Image.tobytes())"""
+        self.write_compressed(compress_png_rows(data, self.stride, self.compress_level))
+    
+    def write_compressed(self, piece):
+        """Добавление полосы, уже сжатой compress_png_rows"""
+        compressed, adler, length = piece
+        rows = length // (self.stride + 1)
+        if self.rows_written + rows > self.height:
+            raise ValueError("Строк больше, чем высота изображения")
+        
+        self.pending += compressed
+        self.adler = adler32_combine(self.adler, adler, length)
+        self.rows_written += rows
+        if len(self.pending) >= self.chunk_size:
+            self.write_chunk(b'IDAT', bytes(self.pending))
+            self.pending.clear()
+    
+    def close(self):
+        """Завершение потока deflate и запись конца файла"""
+        if self.rows_written != self.height:
+            self.file.close()
+            os.remove(self.path)
+            raise ValueError(f"Записано {self.rows_written} строк из {self.height}")
+        
+        # Пустой последний блок deflate и контрольная сумма zlib
+        self.pending += zlib.compressobj(self.compress_level, zlib.DEFLATED, -15).flush()
+        self.pending += struct.pack('>I', self.adler)
+        self.write_chunk(b'IDAT', bytes(self.pending))
+        self.pending.clear()
+        self.write_chunk(b'IEND', b'')
+        self.file.close()
+
+@lru_cache(maxsize=1)
+def load_export_fonts():
+    """Шрифты экспорта: DejaVu, если он установлен, иначе встроенный шрифт Pillow.
+    
+    Загружаются один раз на процесс, в том числе в процессах отрисовки полос.
+    """
+    try:
+        font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 16)
+        font_small = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 12)
+        font_bold = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 18)
+    except OSError:
+        font = ImageFont.load_default()
+        font_small = ImageFont.load_default()
+        font_bold = ImageFont.load_default()
+    return font, font_small, font_bold
+
+@lru_cache(maxsize=1)
+def load_export_measurers():
+    """Измерители текста для шрифтов экспорта: обычного, мелкого и жирного"""
+    return tuple(TextMeasurer(font.getlength, font.getbbox('Ay')[3]) for font in load_export_fonts())
+
+def render_export_tile(job):
+    """Отрисовка полосы экспорта; выполняется и в процессах ProcessPoolExecutor.
+    
+    job - (высота полосы, записи, путь). С путем полоса сохраняется
+    отдельным PNG и возвращается путь, без пути возвращается кусок
+    сжатых строк для PngStreamWriter.
+    """
+    height, records, path = job
+    img = ChatImageRenderer.render_records(height, records)
+    if path:
+        img.save(path, 'PNG')
+        return path
+    return compress_png_rows(img.tobytes(), img.width * 3)
+
+class ExportCancelled(Exception):
+    """Экспорт прерван пользователем"""
+
+def export_subtitle(store, rows, total=None, conditions=()):
+    """Подзаголовок экспорта PNG: условия отбора, число сообщений и период.
+    
+    total - сколько сообщений было отобрано, если в экспорт идут только
+    последние len(rows) из них.
+    """
+    if total is not None and total > len(rows):
+        parts = list(conditions) + [f"Последние {len(rows)} из {total} сообщений"]
+    else:
+        parts = list(conditions) + [f"{len(rows)} сообщений"]
+    if len(rows):
+        first, last = format_day(store.day_keys[rows[0]]), format_day(store.day_keys[rows[-1]])
+        parts.append(first if first == last else f"{first} - {last}")
+    return " · ".join(parts)
+
+def search_condition(query):
+    """Условие «Поиск» для подзаголовка экспорта; длинный запрос обрезается"""
+    if len(query) > 40:
+        query = query[:39] + "…"
+    return f"Поиск «{query}»"
+
+class ChatImageRenderer:
+    """Экспорт выбранных сообщений в PNG полосами фиксированной высоты.
+    
+    Сначала считается вертикальная раскладка всех сообщений: в памяти
+    остается только координата начала каждого сообщения. Затем для
+    каждой полосы собираются компактные записи ее сообщений (тексты и
+    размеры, без хранилища), и полосы рисуются независимо - на всех ядрах
+    через ProcessPoolExecutor. Готовые полосы собираются по порядку:
+    либо каждая в свой файл, либо подряд в одно высокое изображение
+    через PngStreamWriter. Расход памяти не зависит от числа сообщений.
+    
+    С media_dir (папка экспорта) в пузырьки вставляются миниатюры
+    картинок: в раскладке под них отводится рамка фиксированного размера,
+    а декодирует их (load_thumbnail, с дисковым кэшем thumbnail_dir)
+    процесс, который рисует полосу.
+    
+    subtitle - строка под названием чата; по умолчанию в ней число
+    сообщений и их период (export_subtitle).
+    """
+    
+    width = 1200
+    tile_height = 2000
+    header_height = 120
+    bottom_margin = 50
+    
+    background_color = (23, 33, 43)  # #17212b
+    text_color = (255, 255, 255)
+    my_bubble_color = (43, 82, 120)  # #2b5278
+    other_bubble_color = (24, 37, 51)  # #182533
+    name_color = (91, 179, 240)
+    muted_color = (112, 132, 153)
+    date_bg_color = (35, 46, 60)
+    
+    # Пузырек сообщения
+    max_bubble_width = 500
+    line_height = 20
+    padding = 15
+    thumb_width = 320
+    thumb_height = 240
+    
+    # Параллельная отрисовка окупается только на нескольких полосах
+    parallel_min_tiles = 4
+    # Шаг по сообщениям между проверками отмены в раскладке
+    cancel_check_every = 5000
+    
+    def __init__(self, store, rows, chat_name, workers=None, media_dir=None, thumbnail_dir=None, subtitle=None):
+        self.store = store
+        self.rows = rows
+        self.chat_name = chat_name
+        self.subtitle = subtitle if subtitle is not None else export_subtitle(store, rows)
+        self.workers = workers or os.cpu_count() or 1
+        self.media_dir = media_dir
+        self.thumbnail_dir = thumbnail_dir
+        self.text_measure, self.small_measure, self.bold_measure = load_export_measurers()
+        self.offsets = array('q')
+        self.tile_tops = [0]
+        self.height = 0
+    
+    def layout(self, cancelled=None):
+        """Раскладка: координата начала каждого сообщения и границы полос.
+        
+        Полоса заканчивается на начале последнего сообщения, которое в нее
+        помещается, поэтому в серии файлов сообщения не режутся пополам
+        (кроме тех, что сами выше полосы). Отмена через cancelled
+        прерывает раскладку исключением ExportCancelled.
+        """
+        started = time.perf_counter()
+        store = self.store
+        offsets = array('q')
+        y = self.header_height
+        previous_day = None
+        
+        for i, row in enumerate(self.rows):
+            if i % self.cancel_check_every == 0 and cancelled is not None and cancelled.is_set():
+                raise ExportCancelled()
+            offsets.append(y)
+            day_key = store.day_keys[row]
+            if day_key != previous_day:
+                y += self.date_separator_height()
+                previous_day = day_key
+            if store.is_service(row):
+                y += 30
+            else:
+                y += self.message_geometry(row)[4] + 15
+        
+        self.offsets = offsets
+        self.height = y + self.bottom_margin
+        
+        tops = [0]
+        while self.height - tops[-1] > self.tile_height:
+            limit = tops[-1] + self.tile_height
+            i = bisect.bisect_right(offsets, limit) - 1
+            start = offsets[i] if i >= 0 else limit
+            tops.append(start if start > tops[-1] else limit)
+        self.tile_tops = tops
+        
+        if PROFILER.enabled:
+            PROFILER.record('export_layout', time.perf_counter() - started, len(self.rows))
+    
+    def tile_count(self):
+        return len(self.tile_tops)
+    
+    def tile_bounds(self, index):
+        """Верх и низ полосы index в координатах всего изображения"""
+        top = self.tile_tops[index]
+        bottom = self.tile_tops[index + 1] if index + 1 < len(self.tile_tops) else self.height
+        return top, bottom
+    
+    def tile_records(self, index):
+        """Высота полосы и записи для ее отрисовки с координатами y внутри полосы.
+        
+        Записи: ('header', y, заголовок, подзаголовок), ('date', y, подпись),
+        ('service', y, текст) и ('message', y, свое ли, имя, строки,
+        ширина, высота пузырька, миниатюра, время).
+        """
+        store = self.store
+        top, bottom = self.tile_bounds(index)
+        records = []
+        
+        if top < self.header_height:
+            records.append(('header', -top, f"💬 {self.chat_name}", self.subtitle))
+        
+        # Первым идет сообщение, начавшееся выше полосы и заходящее в нее
+        first = max(bisect.bisect_right(self.offsets, top) - 1, 0)
+        for i in range(first, len(self.rows)):
+            y = self.offsets[i] - top
+            if y >= bottom - top:
+                break
+            
+            row = self.rows[i]
+            day_key = store.day_keys[row]
+            if i == 0 or store.day_keys[self.rows[i - 1]] != day_key:
+                records.append(('date', y, format_day(day_key)))
+                y += self.date_separator_height()
+            
+            if store.is_service(row):
+                records.append(('service', y, store.service_text(row)))
+            else:
+                records.append(('message', y) + self.message_geometry(row) + (store.time_label(row),))
+        
+        return bottom - top, records
+    
+    def render_tile(self, index):
+        """Изображение одной полосы (в текущем процессе)"""
+        return self.render_records(*self.tile_records(index))
+    
+    def map_tiles(self, paths):
+        """Результаты render_export_tile для всех полос по порядку.
+        
+        В очереди пула одновременно не больше двух полос на процесс, чтобы
+        память не росла, если запись отстает от отрисовки.
+        """
+        count = self.tile_count()
+        jobs = (self.tile_records(index) + (paths[index] if paths else None,) for index in range(count))
+        
+        if self.workers < 2 or count < self.parallel_min_tiles:
+            yield from map(render_export_tile, jobs)
+            return
+        
+        # spawn: экспорт запускается из потока рядом с Tk, а fork такого
+        # процесса небезопасен
+        try:
+            executor = ProcessPoolExecutor(min(self.workers, count), mp_context=multiprocessing.get_context('spawn'))
+        except (OSError, NotImplementedError):
+            yield from map(render_export_tile, jobs)
+            return
+        
+        pending = deque()
+        try:
+            for job in jobs:
+                pending.append(executor.submit(render_export_tile, job))
+                if len(pending) >= self.workers * 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+    
+    def save(self, output_path, split=False, on_progress=None, cancelled=None):
+        """Запись PNG: одно изображение или серия файлов _001, _002...; возвращает пути.
+        
+        cancelled (threading.Event) проверяется после каждой полосы: экспорт
+        прерывается ExportCancelled, а недописанные файлы удаляются.
+        """
+        with PROFILER.measure('export_render', len(self.rows)):
+            return self.write_png(output_path, split, on_progress, cancelled)
+    
+    def write_png(self, output_path, split, on_progress, cancelled):
+        """Отрисовка полос и запись файлов для save()"""
+        count = self.tile_count()
+        paths = None
+        if split:
+            root, ext = os.path.splitext(output_path)
+            digits = max(3, len(str(count)))
+            paths = [f"{root}_{index + 1:0{digits}d}{ext or '.png'}" for index in range(count)]
+        
+        tiles = self.map_tiles(paths)
+        try:
+            if split:
+                for done, _ in enumerate(tiles, 1):
+                    if cancelled is not None and cancelled.is_set():
+                        raise ExportCancelled()
+                    if on_progress:
+                        on_progress(done, count)
+                return paths
+            
+            with PngStreamWriter(output_path, self.width, self.height) as writer:
+                for done, piece in enumerate(tiles, 1):
+                    if cancelled is not None and cancelled.is_set():
+                        raise ExportCancelled()
+                    writer.write_compressed(piece)
+                    if on_progress:
+                        on_progress(done, count)
+            return [output_path]
+        except BaseException:
+            # Сначала останавливается пул, чтобы процессы не дописали полосы после удаления
+            tiles.close()
+            for path in paths or ():
+                if os.path.exists(path):
+                    os.remove(path)
+            raise
+    
+    @classmethod
+    def render_records(cls, height, records):
+        """Отрисовка полосы по записям tile_records"""
+        fonts = load_export_fonts()
+        measurers = load_export_measurers()
+        img = Image.new('RGB', (cls.width, height), cls.background_color)
+        draw = ImageDraw.Draw(img)
+        
+        for record in records:
+            kind = record[0]
+            if kind == 'message':
+                cls.draw_message(img, draw, fonts, measurers, *record[1:])
+            elif kind == 'service':
+                cls.draw_service_message(draw, fonts, measurers, *record[1:])
+            elif kind == 'date':
+                cls.draw_date_separator(draw, fonts, measurers, *record[1:])
+            elif kind == 'header':
+                cls.draw_header(draw, fonts, measurers, *record[1:])
+        
+        return img
+    
+    @classmethod
+    def draw_header(cls, draw, fonts, measurers, y_pos, title, subtitle):
+        """Заголовок и подзаголовок"""
+        _, font_small, font_bold = fonts
+        _, small_measure, bold_measure = measurers
+        title_x = (cls.width - bold_measure.width(title)) // 2
+        draw.text((title_x, y_pos + 30), title, fill=cls.text_color, font=font_bold)
+        
+        subtitle_x = (cls.width - small_measure.width(subtitle)) // 2
+        draw.text((subtitle_x, y_pos + 60), subtitle, fill=cls.muted_color, font=font_small)
+    
+    def date_separator_height(self):
+        """Высота разделителя даты вместе с отступом под ним"""
+        return self.small_measure.line_height + 10 + 20
+    
+    @classmethod
+    def draw_date_separator(cls, draw, fonts, measurers, y_pos, date_str):
+        """Разделитель даты"""
+        small_measure = measurers[1]
+        bg_width = small_measure.width(date_str) + 20
+        bg_height = small_measure.line_height + 10
+        bg_x = (cls.width - bg_width) // 2
+        
+        draw.rectangle([bg_x, y_pos, bg_x + bg_width, y_pos + bg_height], fill=cls.date_bg_color)
+        draw.text((bg_x + 10, y_pos + 5), date_str, fill=cls.muted_color, font=fonts[1])
+    
+    @classmethod
+    def draw_service_message(cls, draw, fonts, measurers, y_pos, service_text):
+        """Служебное сообщение"""
+        text_x = (cls.width - measurers[1].width(service_text)) // 2
+        draw.text((text_x, y_pos), service_text, fill=cls.muted_color, font=fonts[1])
+    
+    def thumbnail_of(self, row):
+        """Миниатюра сообщения для записи полосы: (путь, каталог кэша) или None"""
+        relative = self.store.media_path(row) if self.media_dir else ''
+        if not relative:
+            return None
+        path = os.path.normpath(os.path.join(self.media_dir, relative))
+        return (path, self.thumbnail_dir) if os.path.isfile(path) else None
+    
+    def message_geometry(self, row):
+        """Свое ли сообщение, имя, строки текста, ширина и высота пузырька, миниатюра"""
+        store = self.store
+        from_user = store.sender_name(row)
+        is_my = 'user6582117962' in store.sender_id(row)
+        name = from_user if not is_my else ''
+        measure = self.text_measure
+        thumb = self.thumbnail_of(row)
+        if thumb and not store.text(row).strip():
+            lines, content_width = [], 0
+        else:
+            lines, content_width = measure.wrap(store.display_text(row, 300), self.max_bubble_width - self.padding * 2)
+        if name:
+            content_width = max(content_width, measure.width(name))
+        thumb_height = 0
+        if thumb:
+            content_width = max(content_width, self.thumb_width)
+            thumb_height = self.thumb_height + (6 if lines else 0)
+        bubble_width = int(min(self.max_bubble_width, max(200, content_width + self.padding * 2)))
+        name_height = 20 if name else 0
+        bubble_height = name_height + thumb_height + len(lines) * self.line_height + 15 + self.padding * 2
+        return is_my, name, lines, bubble_width, bubble_height, thumb
+    
+    @classmethod
+    def draw_thumbnail(cls, img, draw, thumb, x, y):
+        """Миниатюра по центру рамки thumb_width x thumb_height; нечитаемая картинка - пустая рамка"""
+        draw.rectangle([x, y, x + cls.thumb_width, y + cls.thumb_height], fill=cls.background_color)
+        try:
+            image = load_thumbnail(thumb[0], cls.thumb_width, cls.thumb_height, thumb[1])
+        except Exception:
+            return
+        left = x + (cls.thumb_width - image.width) // 2
+        top = y + (cls.thumb_height - image.height) // 2
+        img.paste(image, (left, top), image if image.mode == 'RGBA' else None)
+    
+    @classmethod
+    def draw_message(cls, img, draw, fonts, measurers, y_pos, is_my, name, lines, bubble_width, bubble_height,
+                     thumb, time_str):
+        """Обычное сообщение в пузырьке"""
+        if is_my:
+            bubble_x = cls.width - bubble_width - 50
+            bubble_color = cls.my_bubble_color
+        else:
+            bubble_x = 50
+            bubble_color = cls.other_bubble_color
+        
+        draw.rectangle([bubble_x, y_pos, bubble_x + bubble_width, y_pos + bubble_height], fill=bubble_color)
+        
+        text_x = bubble_x + cls.padding
+        text_y = y_pos + cls.padding
+        
+        font, font_small, _ = fonts
+        if name:
+            draw.text((text_x, text_y), name, fill=cls.name_color, font=font)
+            text_y += 20
+        
+        if thumb:
+            cls.draw_thumbnail(img, draw, thumb, text_x, text_y)
+            text_y += cls.thumb_height + 6
+        
+        for line in lines:
+            draw.text((text_x, text_y), line, fill=cls.text_color, font=font)
+            text_y += cls.line_height
+        
+        time_x = bubble_x + bubble_width - cls.padding - measurers[1].width(time_str)
+        time_y = y_pos + bubble_height - 15 - 5
+        draw.text((time_x, time_y), time_str, fill=cls.muted_color, font=font_small)
+
+class ExportJob(threading.Thread):
+    """Экспорт в PNG в фоновом потоке.
+    
+    Как у ChatLoader, поток не обращается к Tk, а складывает события в
+    очередь, которую окно разбирает через after():
+      ('layout', messages) - идет раскладка
+      ('progress', tiles_done, tiles_total) - отрисована очередная полоса
+      ('done', paths, seconds)
+      ('cancelled',) - экспорт отменен, недописанные файлы удалены
+      ('error', exception)
+    """
+    
+    def __init__(self, store, rows, chat_name, output_path, split=False, workers=None, media_dir=None,
+                 subtitle=None):
+        super().__init__(daemon=True)
+        self.store = store
+        self.rows = rows
+        self.chat_name = chat_name
+        self.subtitle = subtitle
+        self.output_path = output_path
+        self.split = split
+        self.workers = workers
+        self.media_dir = media_dir
+        self.events = queue.Queue()
+        self.cancelled = threading.Event()
+    
+    def cancel(self):
+        """Остановка после текущей полосы"""
+        self.cancelled.set()
+    
+    def run(self):
+        started = time.perf_counter()
+        try:
+            renderer = ChatImageRenderer(self.store, self.rows, self.chat_name, self.workers,
+                                         self.media_dir, default_thumbnail_dir(), self.subtitle)
+            self.events.put(('layout', len(self.rows)))
+            renderer.layout(self.cancelled)
+            self.events.put(('progress', 0, renderer.tile_count()))
+            
+            on_progress = lambda done, total: self.events.put(('progress', done, total))
+            paths = renderer.save(self.output_path, self.split, on_progress, self.cancelled)
+            self.events.put(('done', paths, time.perf_counter() - started))
+        except ExportCancelled:
+            self.events.put(('cancelled',))
+        except Exception as e:
+            self.events.put(('error', e))
+
 class TelegramChatFinalWorking:
     def __init__(self, root):
         self.root = root
@@ -28,16 +3247,95 @@ class TelegramChatFinalWorking:
         self.root.configure(bg='#17212b')
         
         # Данные чата
-        self.chat_data = None
-        self.messages = []
-        self.filtered_messages = []
+        self.chat_meta = {}
+        self.store = MessageStore()
+        self.view = range(0)
+        self.view_stats = self.store.stats
         self.current_chat_name = ""
-        self.search_query = ""
-        
-        # Настройки виртуализации
-        self.messages_per_page = 20
-        self.current_page = 0
-        self.total_pages = 0
+        self.search_pattern = None
+        self.loader = None
+        
+        # Поиск в чате: лента не фильтруется, а совпадения подсвечиваются.
+        # find_hits - отсортированные позиции совпадений в self.view,
+        # find_current - номер выбранного из них
+        self.find_mode = False
+        self.find_hits = None
+        self.find_current = None
+        
+        # Кэш разобранных файлов (None, если выключен или недоступен)
+        self.cache = ChatCache.open_default()
+        self.cache_status = ""
+        
+        # Фильтр по фасетам: индекс чата, примененный выбор, результат
+        # одного текстового поиска (по нему уточняется запрос) и видимость панели
+        self.facet_index = None
+        self.facet_selection = {}
+        self.text_rows = None
+        self.facets_visible = False
+        
+        # Индекс дат текущего представления строится при первом переходе к дате
+        self.date_index = None
+        
+        # Фоновый экспорт в PNG и его окно прогресса
+        self.export_job = None
+        self.export_progress = None
+        
+        # Строка замеров (F12) и ее периодическое обновление
+        self.profile_overlay = False
+        self.profile_after_id = None
+        
+        # Полный экспорт аккаунта: файл и индекс его чатов
+        self.chat_file = None
+        self.chat_index = None
+        
+        # Поиск: задержка после ввода и текущее фоновое задание
+        self.search_debounce_ms = 250
+        self.search_after_id = None
+        self.search_job = None
+        
+        # Триграммный индекс строится в фоне только для больших чатов
+        self.trigram_index_min_messages = 100000
+        self.trigram_index = None
+        self.index_builder = None
+        self.index_status = ""
+        
+        # Настройки виртуализации: позиция ленты задается первым видимым
+        # сообщением (номер в self.view) и сдвигом от его верха в пикселях
+        self.top_index = 0
+        self.top_offset = 0
+        self.at_bottom = True
+        self.visible_range = (0, 0)
+        self.overscan = 200
+        self.wheel_step = 60
+        
+        # Элементы Canvas, привязанные к видимым сообщениям, и свободные наборы
+        self.active_slots = {}
+        self.free_slots = []
+        
+        # Геометрия сообщений кэшируется по строке хранилища, а высоты
+        # сообщений текущего представления собраны в дерево префиксных сумм.
+        # Большие прыжки по ленте считаются по дереву, а не перебором
+        self.layout_cache = OrderedDict()
+        self.layout_cache_size = 5000
+        self.layout_width = 0
+        self.height_estimate = 90
+        self.heights = HeightIndex(0, self.height_estimate)
+        self.jump_threshold = 2000
+        self.resize_after_id = None
+        self.resize_delay_ms = 50
+        self.slots_width = 0
+        
+        # Миниатюры картинок в пузырьках. Рамка фиксированного размера, чтобы
+        # высота сообщения не менялась после загрузки картинки; декодируются
+        # только картинки сообщений в окне и в полосе overscan
+        self.thumb_width = 240
+        self.thumb_height = 180
+        self.thumbnail_poll_ms = 40
+        self.thumbnail_after_id = None
+        self.media_dir = None
+        self.thumbnails = None
+        if PIL_AVAILABLE and ImageTk is not None:
+            self.thumbnails = ThumbnailLoader(ImageTk.PhotoImage, cache_dir=default_thumbnail_dir())
         
         # Цвета Telegram Web
         self.colors = {
@@ -52,7 +3350,10 @@ class TelegramChatFinalWorking:
             'button': '#5bb3f0',
             'search_bg': '#232e3c',
             'date_bg': '#232e3c',
-            'border': '#2f3b4c'
+            'border': '#2f3b4c',
+            'match': '#6e5a1c',
+            'match_current': '#a8801a',
+            'thumb_bg': '#0e1621'
         }
         
         # Настройки Canvas
@@ -61,17 +3362,41 @@ class TelegramChatFinalWorking:
         self.message_padding = 20
         self.bubble_padding = 12
         self.max_bubble_width = 400
+        self.update_layout_width()
         
         self.setup_ui()
+        self.root.protocol("WM_DELETE_WINDOW", self.close)
         
+    def close(self):
+        """Закрытие окна: остановка фоновых заданий, которые не завершаются сами"""
+        self.cancel_search()
+        if self.thumbnails is not None:
+            self.thumbnails.shutdown()
+        self.root.destroy()
+    
     def setup_ui(self):
         """Настройка пользовательского интерфейса"""
+        self.setup_fonts()
         self.setup_top_panel()
         self.setup_search_panel()
         self.setup_canvas_area()
         self.setup_navigation_panel()
         self.setup_bottom_panel()
         
+    def setup_fonts(self):
+        """Шрифты ленты и измерители ширины текста для них"""
+        self.fonts = {
+            'date': tkfont.Font(family='Arial', size=10),
+            'service': tkfont.Font(family='Arial', size=10),
+            'name': tkfont.Font(family='Arial', size=10, weight='bold'),
+            'body': tkfont.Font(family='Arial', size=11),
+            'time': tkfont.Font(family='Arial', size=9)
+        }
+        self.measurers = {
+            key: TextMeasurer(font.measure, font.metrics('linespace'))
+            for key, font in self.fonts.items()
+        }
+        
     def setup_top_panel(self):
         """Настройка верхней панели"""
         top_frame = tk.Frame(self.root, bg=self.colors['bg'], height=60)
@@ -98,9 +3423,22 @@ class TelegramChatFinalWorking:
             text="Выберите файл чата",
             bg=self.colors['bg'],
             fg=self.colors['text'],
-            font=('Arial', 12, 'bold')
+            font=('Arial', 12, 'bold')
+        )
+        self.chat_title.pack(side='left', padx=20, pady=15)
+        
+        # Выбор чата, если открыт полный экспорт аккаунта
+        self.chats_btn = tk.Button(
+            top_frame,
+            text="💬 Чаты",
+            command=self.choose_chat,
+            bg=self.colors['other_message'],
+            fg=self.colors['text'],
+            font=('Arial', 10),
+            relief='flat',
+            padx=15,
+            cursor='hand2'
         )
-        self.chat_title.pack(side='left', padx=20, pady=15)
         
         # Кнопка экспорта в изображение
         export_btn = tk.Button(
@@ -144,7 +3482,15 @@ class TelegramChatFinalWorking:
             insertbackground=self.colors['text']
         )
         self.search_entry.pack(side='left', fill='x', expand=True, padx=(0, 10), pady=10, ipady=5)
-        self.search_entry.bind('<KeyRelease>', self.on_search)
+        # Поиск запускается только при изменении текста, а не на каждую клавишу
+        self.search_var.trace_add('write', self.on_search)
+        self.search_entry.bind('<Return>', self.on_search_return)
+        self.search_entry.bind('<Shift-Return>', self.prev_match)
+        self.root.bind('<F3>', self.next_match)
+        self.root.bind('<Shift-F3>', self.prev_match)
+        
+        # Режим поиска: подстрока, целое слово или регулярное выражение
+        self.search_mode_var = tk.StringVar(value=SEARCH_MODES['text'])
         
         clear_btn = tk.Button(
             search_frame,
@@ -159,26 +3505,108 @@ class TelegramChatFinalWorking:
         )
         clear_btn.pack(side='right', pady=10)
         
+        tk.Button(
+            search_frame,
+            text="⚙ Фильтры",
+            command=self.toggle_facets,
+            bg=self.colors['other_message'],
+            fg=self.colors['text'],
+            font=('Arial', 9),
+            relief='flat',
+            padx=10,
+            cursor='hand2'
+        ).pack(side='right', padx=(0, 10), pady=10)
+        
+        mode_box = ttk.Combobox(
+            search_frame,
+            textvariable=self.search_mode_var,
+            values=list(SEARCH_MODES.values()),
+            state='readonly',
+            width=7
+        )
+        mode_box.pack(side='right', padx=(0, 10), pady=10)
+        mode_box.bind('<<ComboboxSelected>>', self.run_search)
+        
+        # Поиск в чате: вся лента остается на месте, совпадения подсвечиваются
+        self.find_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(
+            search_frame,
+            text="В чате",
+            variable=self.find_var,
+            command=self.run_search,
+            bg=self.colors['bg'],
+            fg=self.colors['text'],
+            selectcolor=self.colors['search_bg'],
+            activebackground=self.colors['bg'],
+            activeforeground=self.colors['text'],
+            font=('Arial', 9)
+        ).pack(side='right', padx=(0, 10), pady=10)
+        
+        for text, command in (("▼", self.next_match), ("▲", self.prev_match)):
+            tk.Button(
+                search_frame,
+                text=text,
+                command=command,
+                bg=self.colors['other_message'],
+                fg=self.colors['text'],
+                font=('Arial', 9),
+                relief='flat',
+                width=2,
+                cursor='hand2'
+            ).pack(side='right', padx=(0, 2), pady=10)
+        
+        self.match_label = tk.Label(
+            search_frame,
+            bg=self.colors['bg'],
+            fg=self.colors['time'],
+            font=('Arial', 9)
+        )
+        self.match_label.pack(side='right', padx=(0, 5), pady=10)
+        
     def setup_canvas_area(self):
         """Настройка Canvas для отображения чата"""
-        canvas_frame = tk.Frame(self.root, bg=self.colors['chat_bg'], relief='solid', bd=1)
-        canvas_frame.pack(fill='both', expand=True, padx=10, pady=5)
+        body_frame = tk.Frame(self.root, bg=self.colors['bg'])
+        body_frame.pack(fill='both', expand=True, padx=10, pady=5)
+        
+        # Панель фильтров слева от ленты, показывается кнопкой «⚙ Фильтры»
+        self.facet_panel = FacetPanel(body_frame, self.colors, self.on_search)
         
+        canvas_frame = tk.Frame(body_frame, bg=self.colors['chat_bg'], relief='solid', bd=1)
+        canvas_frame.pack(side='right', fill='both', expand=True)
+        
+        # Canvas сам не прокручивается: элементы видимых сообщений
+        # расставляются в координатах окна, а полоса прокрутки
+        # управляет позицией в ленте
         self.canvas = tk.Canvas(
             canvas_frame,
             bg=self.colors['chat_bg'],
-            highlightthickness=0,
-            scrollregion=(0, 0, 0, 2000)
+            highlightthickness=0
         )
         
-        scrollbar = ttk.Scrollbar(canvas_frame, orient="vertical", command=self.canvas.yview)
-        self.canvas.configure(yscrollcommand=scrollbar.set)
+        self.scrollbar = ttk.Scrollbar(canvas_frame, orient="vertical", command=self.on_scrollbar)
         
         self.canvas.pack(side="left", fill="both", expand=True)
-        scrollbar.pack(side="right", fill="y")
+        self.scrollbar.pack(side="right", fill="y")
+        
+        self.empty_text = self.canvas.create_text(
+            0, 100,
+            text="Сообщения не найдены",
+            fill=self.colors['text'],
+            font=('Arial', 14),
+            state='hidden'
+        )
         
         self.canvas.bind('<Configure>', self.on_canvas_configure)
         self.canvas.bind('<MouseWheel>', self.on_mousewheel)
+        self.canvas.bind('<Button-4>', lambda event: self.scroll_by(-self.wheel_step))
+        self.canvas.bind('<Button-5>', lambda event: self.scroll_by(self.wheel_step))
+        self.canvas.bind('<Button-1>', lambda event: self.canvas.focus_set())
+        self.canvas.bind('<Prior>', lambda event: self.prev_page())
+        self.canvas.bind('<Next>', lambda event: self.next_page())
+        self.canvas.bind('<Up>', lambda event: self.scroll_by(-self.wheel_step))
+        self.canvas.bind('<Down>', lambda event: self.scroll_by(self.wheel_step))
+        self.canvas.bind('<End>', lambda event: self.go_to_last())
+        self.canvas.bind('<Home>', lambda event: self.go_to_first())
         
     def setup_navigation_panel(self):
         """Настройка панели навигации"""
@@ -202,7 +3630,7 @@ class TelegramChatFinalWorking:
         
         self.page_label = tk.Label(
             nav_frame,
-            text="Страница 0 из 0",
+            text="Сообщения 0 из 0",
             bg=self.colors['bg'],
             fg=self.colors['text'],
             font=('Arial', 10)
@@ -238,6 +3666,22 @@ class TelegramChatFinalWorking:
         last_btn.pack(side='right', pady=5)
         self.last_btn = last_btn
         
+        # Переход к дате и календарь активности (Ctrl+G)
+        self.date_btn = tk.Button(
+            nav_frame,
+            text="📅 К дате",
+            command=self.go_to_date,
+            bg=self.colors['other_message'],
+            fg=self.colors['text'],
+            font=('Arial', 9),
+            relief='flat',
+            padx=15,
+            cursor='hand2',
+            state='disabled'
+        )
+        self.date_btn.pack(side='right', padx=(0, 10), pady=5)
+        self.root.bind('<Control-g>', self.go_to_date)
+        
     def setup_bottom_panel(self):
         """Настройка нижней панели"""
         bottom_frame = tk.Frame(self.root, bg=self.colors['bg'], height=30)
@@ -253,14 +3697,69 @@ class TelegramChatFinalWorking:
         )
         self.stats_label.pack(side='left', pady=5)
         
+        # Замеры времени по фазам, показываются по F12
+        self.profile_label = tk.Label(
+            bottom_frame,
+            bg=self.colors['bg'],
+            fg=self.colors['time'],
+            font=('Arial', 8)
+        )
+        self.root.bind('<F12>', self.toggle_profile_overlay)
+        
     def on_canvas_configure(self, event):
-        """Обработка изменения размера Canvas"""
+        """Обработка изменения размера Canvas.
+        
+        При перетаскивании границы окна события идут сериями, поэтому
+        перерисовка откладывается до паузы между ними.
+        """
         self.canvas_width = event.width
+        self.canvas_height = event.height
+        if self.resize_after_id:
+            self.root.after_cancel(self.resize_after_id)
+        self.resize_after_id = self.root.after(self.resize_delay_ms, self.apply_resize)
+    
+    def apply_resize(self):
+        """Перерисовка ленты под новый размер окна"""
+        self.resize_after_id = None
+        if self.canvas_width != self.slots_width:
+            self.slots_width = self.canvas_width
+            self.release_slots()
+            self.update_layout_width()
+        self.clamp_scroll()
         self.redraw_canvas()
+    
+    def update_layout_width(self):
+        """Ширина переноса текста по ширине окна.
+        
+        При ее смене сбрасываются только измеренные высоты, а геометрия
+        из кэша пересчитывается лениво, при следующем обращении.
+        """
+        width = min(self.max_bubble_width, self.canvas_width - 2 * self.message_padding - 20)
+        width = max(width, 120)
+        if width != self.layout_width:
+            self.layout_width = width
+            self.heights = HeightIndex(len(self.view), self.height_estimate)
         
     def on_mousewheel(self, event):
         """Обработка прокрутки колесом мыши"""
-        self.canvas.yview_scroll(int(-1*(event.delta/120)), "units")
+        self.scroll_by(int(-event.delta / 120 * self.wheel_step))
+    
+    def on_scrollbar(self, *args):
+        """Команды полосы прокрутки: moveto или scroll"""
+        if not self.view:
+            return
+        
+        if args[0] == 'moveto':
+            fraction = min(max(float(args[1]), 0.0), 1.0)
+            self.top_index, self.top_offset = self.heights.find(int(fraction * self.heights.total()))
+            self.clamp_scroll()
+            self.redraw_canvas()
+        elif args[0] == 'scroll':
+            amount = int(args[1])
+            if args[2] == 'pages':
+                self.scroll_by(amount * self.page_step())
+            else:
+                self.scroll_by(amount * self.wheel_step)
         
     def load_chat_file(self):
         """Загрузка JSON файла чата"""
@@ -270,403 +3769,981 @@ class TelegramChatFinalWorking:
         )
         
         if file_path:
-            self.chat_title.config(text="Загрузка...")
-            self.root.update()
-            
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    self.chat_data = json.load(f)
-                
-                self.current_chat_name = self.chat_data.get('name', 'Неизвестный чат')
-                self.messages = self.chat_data.get('messages', [])
-                self.filtered_messages = self.messages.copy()
-                
-                self.chat_title.config(text=f"💬 {self.current_chat_name}")
-                
-                self.setup_pagination()
-                self.go_to_last()
-                
-                self.export_btn.config(state='normal')
-                self.last_btn.config(state='normal')
+            self.chat_file = file_path
+            self.chat_index = None
+            self.chats_btn.pack_forget()
+            self.start_loader()
+    
+    def start_loader(self, chat=None):
+        """Запуск фоновой загрузки файла или одного чата полного экспорта"""
+        if self.loader:
+            self.loader.cancel()
+        self.stop_trigram_index()
+        self.cancel_search()
+        self.unload_chat()
+        
+        self.chat_title.config(text="Загрузка...")
+        self.stats_label.config(text="Чтение файла...")
+        
+        # Разбор идет в отдельном потоке, окно остается отзывчивым
+        self.cache_status = ""
+        self.loader = ChatLoader(self.chat_file, chat, self.cache)
+        self.loader.start()
+        self.root.after(100, self.poll_loader, self.loader)
+    
+    def unload_chat(self):
+        """Освобождение памяти текущего чата до загрузки следующего"""
+        self.store = MessageStore()
+        self.view = range(0)
+        self.view_stats = self.store.stats
+        self.layout_cache.clear()
+        self.search_pattern = None
+        self.reset_facets()
+        self.media_dir = None
+        if self.thumbnails is not None:
+            self.thumbnails.clear()
+        self.export_btn.config(state='disabled')
+        self.date_btn.config(state='disabled')
+        self.reset_view()
+        self.redraw_canvas()
+    
+    def choose_chat(self):
+        """Выбор чата из индекса полного экспорта"""
+        if not self.chat_index:
+            return
+        dialog = ChatPickerDialog(self.root, self.chat_index)
+        if dialog.result is not None:
+            self.start_loader(dialog.result)
+    
+    def poll_loader(self, loader):
+        """Обработка событий фоновой загрузки в потоке Tk"""
+        if loader is not self.loader:
+            return
+        
+        try:
+            while True:
+                event = loader.events.get_nowait()
+                kind = event[0]
                 
-            except Exception as e:
-                messagebox.showerror("Ошибка", f"Не удалось загрузить файл:\\n{str(e)}")
-                self.chat_title.config(text="Ошибка загрузки")
-    
-    def setup_pagination(self):
-        """Настройка пагинации"""
-        self.total_pages = max(1, (len(self.filtered_messages) + self.messages_per_page - 1) // self.messages_per_page)
-        self.current_page = 0
+                if kind == 'progress':
+                    _, bytes_read, total_bytes, count = event
+                    percent = bytes_read * 100 // total_bytes if total_bytes else 100
+                    self.stats_label.config(
+                        text=f"Загрузка: {bytes_read / 1048576:.1f} из {total_bytes / 1048576:.1f} МБ "
+                             f"({percent}%) | Сообщений: {count}"
+                    )
+                elif kind == 'tail':
+                    self.on_chat_loaded(event[1], event[2])
+                elif kind == 'chats':
+                    self.on_chat_index(event[1], event[2])
+                elif kind == 'cache':
+                    self.cache_status = event[1]
+                    if len(self.store):
+                        self.update_stats()
+                elif kind == 'done':
+                    self.chat_meta = event[1]
+                    self.loader = None
+                    return
+                elif kind == 'error':
+                    self.loader = None
+                    messagebox.showerror("Ошибка", f"Не удалось загрузить файл:\n{event[1]}")
+                    self.chat_title.config(text="Ошибка загрузки")
+                    self.update_stats()
+                    return
+        except queue.Empty:
+            pass
+        
+        self.root.after(100, self.poll_loader, loader)
+    
+    def on_chat_index(self, meta, chats):
+        """Полный экспорт аккаунта прочитан: показ списка чатов"""
+        self.chat_meta = meta
+        self.chat_index = chats
+        self.chats_btn.pack(side='left', pady=15)
+        self.chat_title.config(text=f"Полный экспорт, чатов: {len(chats)}")
+        self.stats_label.config(text="Выберите чат")
+        # Окно выбора открывается после обработки текущих событий загрузчика
+        self.root.after_idle(self.choose_chat)
+    
+    def on_chat_loaded(self, meta, store):
+        """Показ чата сразу после чтения всего массива сообщений"""
+        self.chat_meta = meta
+        self.current_chat_name = chat_name(meta)
+        self.store = store
+        self.layout_cache.clear()
+        # Пути к картинкам в экспорте отсчитываются от папки result.json
+        self.media_dir = os.path.dirname(os.path.abspath(self.chat_file)) if self.chat_file else None
+        self.view = range(len(store))
+        self.view_stats = store.stats
+        self.search_pattern = None
+        self.search_var.set("")
+        self.reset_facets()
+        
+        self.chat_title.config(text=f"💬 {self.current_chat_name}")
+        
+        self.reset_view()
+        self.go_to_last()
+        
+        self.export_btn.config(state='normal')
+        self.last_btn.config(state='normal')
+        self.date_btn.config(state='normal')
+        
+        if len(store) >= self.trigram_index_min_messages and store.trigram_search:
+            self.start_trigram_index()
+        
+        if self.facets_visible:
+            self.start_search(None, {})
+    
+    def start_trigram_index(self):
+        """Запуск фонового построения триграммного индекса"""
+        self.index_builder = TrigramIndexBuilder(self.store)
+        self.index_builder.start()
+        self.index_status = "Индекс: 0%"
+        self.root.after(500, self.poll_index_builder, self.index_builder)
+    
+    def stop_trigram_index(self):
+        """Сброс индекса при смене чата"""
+        if self.index_builder:
+            self.index_builder.cancel()
+        self.index_builder = None
+        self.trigram_index = None
+        self.index_status = ""
+    
+    def poll_index_builder(self, builder):
+        """Обработка событий построения индекса в потоке Tk"""
+        if builder is not self.index_builder:
+            return
+        
+        try:
+            while True:
+                event = builder.events.get_nowait()
+                if event[0] == 'progress':
+                    self.index_status = f"Индекс: {event[1] * 100 // event[2]}%"
+                elif event[0] == 'done':
+                    index = event[1]
+                    self.trigram_index = index
+                    self.index_builder = None
+                    self.index_status = (f"Индекс: {index.nbytes / 1048576:.1f} МБ "
+                                         f"за {index.build_seconds:.1f} с")
+                    self.update_stats()
+                    return
+                elif event[0] == 'error':
+                    self.index_builder = None
+                    self.index_status = "Индекс недоступен"
+                    self.update_stats()
+                    return
+        except queue.Empty:
+            pass
+        
+        self.update_stats()
+        self.root.after(500, self.poll_index_builder, builder)
+    
+    def reset_view(self):
+        """Сброс ленты после смены набора сообщений"""
+        self.release_slots()
+        self.heights = HeightIndex(len(self.view), self.height_estimate)
+        self.date_index = None
+        self.find_hits = None
+        self.find_current = None
+        self.top_index = 0
+        self.top_offset = 0
+        self.update_match_label()
         self.update_navigation()
     
     def update_navigation(self):
         """Обновление кнопок навигации"""
-        self.page_label.config(text=f"Страница {self.current_page + 1} из {self.total_pages}")
+        view_len = len(self.view)
+        first, last = self.visible_range
+        if view_len:
+            day_key = self.store.day_keys[self.view[min(first, view_len - 1)]]
+            day_text = f" · {format_day(day_key)}" if day_key >= 0 else ""
+            self.page_label.config(text=f"Сообщения {first + 1}–{last} из {view_len}{day_text}")
+        else:
+            self.page_label.config(text="Сообщения 0 из 0")
         
-        self.prev_btn.config(state='normal' if self.current_page > 0 else 'disabled')
-        self.next_btn.config(state='normal' if self.current_page < self.total_pages - 1 else 'disabled')
+        can_go_up = self.top_index > 0 or self.top_offset > 0
+        self.prev_btn.config(state='normal' if can_go_up else 'disabled')
+        self.next_btn.config(state='normal' if not self.at_bottom else 'disabled')
         
         self.update_stats()
     
+    def page_step(self):
+        """Прокрутка на экран с небольшим перекрытием"""
+        return max(self.canvas_height - 40, self.wheel_step)
+    
     def prev_page(self):
         """Предыдущая страница"""
-        if self.current_page > 0:
-            self.current_page -= 1
-            self.redraw_canvas()
+        self.scroll_by(-self.page_step())
     
     def next_page(self):
         """Следующая страница"""
-        if self.current_page < self.total_pages - 1:
-            self.current_page += 1
-            self.redraw_canvas()
+        self.scroll_by(self.page_step())
+    
+    def go_to_first(self):
+        """Переход к первым сообщениям"""
+        self.top_index = 0
+        self.top_offset = 0
+        self.clamp_scroll()
+        self.redraw_canvas()
     
     def go_to_last(self):
         """Переход к последним сообщениям"""
-        self.current_page = self.total_pages - 1
+        self.anchor_to_end()
         self.redraw_canvas()
     
-    def redraw_canvas(self):
-        """Перерисовка Canvas с сообщениями"""
-        if not self.filtered_messages:
-            self.canvas.delete("all")
-            self.canvas.create_text(
-                self.canvas_width // 2, 100,
-                text="Сообщения не найдены",
-                fill=self.colors['text'],
-                font=('Arial', 14)
-            )
+    def go_to_position(self, pos):
+        """Переход к сообщению pos текущего представления (оно оказывается вверху окна)"""
+        self.top_index = pos
+        self.top_offset = 0
+        self.clamp_scroll()
+        self.redraw_canvas()
+    
+    def current_date_index(self):
+        """Индекс дат текущего представления (строится один раз на представление)"""
+        if self.date_index is None:
+            self.date_index = DateIndex(self.store, self.view)
+        return self.date_index
+    
+    def go_to_date(self, event=None):
+        """Окно перехода к дате по текущему представлению (с учетом поиска)"""
+        if not self.view:
             return
         
-        self.canvas.delete("all")
-        
-        start_idx = self.current_page * self.messages_per_page
-        end_idx = min(start_idx + self.messages_per_page, len(self.filtered_messages))
-        page_messages = self.filtered_messages[start_idx:end_idx]
-        
-        y_pos = 20
-        current_date = None
-        
-        for message in page_messages:
-            msg_date = self.get_message_date(message)
-            if msg_date != current_date:
-                y_pos = self.draw_date_separator(msg_date, y_pos)
-                current_date = msg_date
-            
-            if message.get('type') == 'service':
-                y_pos = self.draw_service_message(message, y_pos)
-            else:
-                y_pos = self.draw_message_bubble(message, y_pos)
+        index = self.current_date_index()
+        if not index.days:
+            messagebox.showinfo("Переход к дате", "У показанных сообщений нет дат")
+            return
         
-        self.canvas.configure(scrollregion=(0, 0, 0, y_pos + 50))
-        self.update_navigation()
-        self.canvas.yview_moveto(1.0)
+        day = self.store.day_keys[self.view[self.top_index]]
+        dialog = DateJumpDialog(self.root, index, day if day >= 0 else index.days[-1])
+        if dialog.result is not None:
+            self.go_to_position(dialog.result)
     
-    def draw_date_separator(self, date_str, y_pos):
-        """Рисование разделителя дня"""
-        text_width = len(date_str) * 8
-        bg_width = text_width + 20
-        bg_height = 25
-        
-        x_center = self.canvas_width // 2
-        bg_x1 = x_center - bg_width // 2
-        bg_x2 = x_center + bg_width // 2
-        
-        self.canvas.create_rectangle(
-            bg_x1, y_pos, bg_x2, y_pos + bg_height,
-            fill=self.colors['date_bg'],
-            outline="",
-            tags="date_separator"
-        )
-        
-        self.canvas.create_text(
-            x_center, y_pos + bg_height // 2,
-            text=date_str,
-            fill=self.colors['time'],
-            font=('Arial', 10),
-            tags="date_separator"
-        )
-        
-        return y_pos + bg_height + 15
+    def scroll_by(self, dy):
+        """Прокрутка ленты на dy пикселей (положительное значение - вниз)"""
+        if not self.view or not dy:
+            return
+        self.top_offset += dy
+        self.clamp_scroll()
+        self.redraw_canvas()
     
-    def draw_service_message(self, message, y_pos):
-        """Рисование служебного сообщения"""
-        action = message.get('action', '')
-        actor = message.get('actor', '')
-        time_str = self.format_time(message.get('date', ''))
-        
-        service_text = f"{actor} {self.get_action_text(action)} • {time_str}"
-        x_center = self.canvas_width // 2
-        
-        self.canvas.create_text(
-            x_center, y_pos,
-            text=service_text,
-            fill=self.colors['service'],
-            font=('Arial', 10),
-            tags="service"
-        )
-        
-        return y_pos + 25
+    def anchor_to_end(self):
+        """Позиция, при которой последнее сообщение прижато к низу окна"""
+        y = self.canvas_height
+        pos = len(self.view)
+        while pos > 0 and y > 0:
+            pos -= 1
+            y -= self.block_at(pos).height
+        self.top_index = pos
+        self.top_offset = max(-y, 0)
     
-    def draw_message_bubble(self, message, y_pos):
-        """Рисование пузырька сообщения"""
-        from_user = message.get('from', '')
-        from_id = message.get('from_id', '')
-        text = message.get('text', '')
-        time_str = self.format_time(message.get('date', ''))
+    def clamp_scroll(self):
+        """Нормализация позиции: сдвиг внутри первого сообщения и без пустоты снизу"""
+        view_len = len(self.view)
+        if not view_len:
+            self.top_index = 0
+            self.top_offset = 0
+            return
         
-        is_my_message = 'user6582117962' in from_id
+        self.top_index = min(max(self.top_index, 0), view_len - 1)
         
-        if isinstance(text, list):
-            full_text = ""
-            for item in text:
-                if isinstance(item, dict):
-                    full_text += item.get('text', '')
-                else:
-                    full_text += str(item)
-            text = full_text
+        # Дальние переходы считаются по префиксным суммам высот, ближние -
+        # по точным высотам соседних сообщений, чтобы лента не дергалась
+        if not -self.jump_threshold < self.top_offset < self.jump_threshold:
+            y = self.heights.offset_of(self.top_index) + self.top_offset
+            self.top_index, self.top_offset = self.heights.find(y)
         
-        if not text.strip():
-            text = self.get_media_text(message)
+        while self.top_offset < 0 and self.top_index > 0:
+            self.top_index -= 1
+            self.top_offset += self.block_at(self.top_index).height
+        self.top_offset = max(self.top_offset, 0)
+        
+        while self.top_index < view_len - 1:
+            height = self.block_at(self.top_index).height
+            if self.top_offset < height:
+                break
+            self.top_offset -= height
+            self.top_index += 1
+        
+        y = -self.top_offset
+        pos = self.top_index
+        while pos < view_len and y < self.canvas_height:
+            y += self.block_at(pos).height
+            pos += 1
+        if y < self.canvas_height:
+            self.anchor_to_end()
+    
+    def update_scrollbar(self):
+        """Положение ползунка по координате верха окна в ленте"""
+        total = max(self.heights.total(), 1)
+        first = min((self.heights.offset_of(self.top_index) + self.top_offset) / total, 1.0)
+        last = 1.0 if self.at_bottom else min(first + self.canvas_height / total, 1.0)
+        self.scrollbar.set(first, last)
+    
+    def release_slots(self):
+        """Освобождение всех наборов элементов (смена представления или ширины)"""
+        for slot in self.active_slots.values():
+            slot.hide()
+            self.free_slots.append(slot)
+        self.active_slots.clear()
+    
+    def redraw_canvas(self):
+        """Перерисовка видимой части ленты.
+        
+        Элементы Canvas есть только у сообщений в окне и в полосе overscan
+        над и под ним. Наборы элементов сообщений, ушедших из этой полосы,
+        переиспользуются для новых через coords()/itemconfigure(), а
+        оставшиеся на экране сообщения только сдвигаются.
+        """
+        view_len = len(self.view)
+        if not view_len:
+            self.release_slots()
+            self.canvas.coords(self.empty_text, self.canvas_width // 2, 100)
+            self.canvas.itemconfigure(self.empty_text, state='normal')
+            self.visible_range = (0, 0)
+            self.at_bottom = True
+            self.scrollbar.set(0.0, 1.0)
+            self.update_navigation()
+            return
         
-        if len(text) > 200:
-            text = text[:200] + "..."
+        self.canvas.itemconfigure(self.empty_text, state='hidden')
+        started = time.perf_counter() if PROFILER.enabled else None
+        
+        placements = {}
+        y = -self.top_offset
+        pos = self.top_index
+        
+        above_y = y
+        above = pos
+        while above > 0 and above_y > -self.overscan:
+            above -= 1
+            block = self.block_at(above)
+            above_y -= block.height
+            placements[above] = (block, above_y)
+        
+        last_visible = pos
+        while pos < view_len and y < self.canvas_height + self.overscan:
+            block = self.block_at(pos)
+            placements[pos] = (block, y)
+            if y < self.canvas_height:
+                last_visible = pos
+            y += block.height
+            pos += 1
+        self.at_bottom = pos == view_len and y <= self.canvas_height
+        
+        for pos in [pos for pos in self.active_slots if pos not in placements]:
+            slot = self.active_slots.pop(pos)
+            slot.hide()
+            self.free_slots.append(slot)
+        
+        for pos, (block, y) in placements.items():
+            slot = self.active_slots.get(pos)
+            if slot is None:
+                slot = self.free_slots.pop() if self.free_slots else CanvasMessageSlot(self.canvas, self.colors, self.fonts)
+                self.active_slots[pos] = slot
+                self.place_message(slot, block, y, pos)
+            elif slot.y != y:
+                self.canvas.move(slot.tag, 0, y - slot.y)
+                slot.y = y
+        
+        self.visible_range = (self.top_index, last_visible + 1)
+        if self.thumbnails is not None:
+            self.thumbnails.want(slot.block.layout.thumb for slot in self.active_slots.values() if slot.block.layout.thumb)
+        if started is not None:
+            PROFILER.record('redraw', time.perf_counter() - started, len(placements))
+        self.update_scrollbar()
+        self.update_navigation()
+    
+    def block_at(self, pos):
+        """Сообщение pos текущего представления на своем месте в ленте"""
+        slot = self.active_slots.get(pos)
+        if slot is not None:
+            return slot.block
+        
+        store = self.store
+        row = self.view[pos]
+        layout = self.layout_row(row)
+        top = 20 if pos == 0 else 0
+        height = top + layout.height
+        
+        # Разделитель дня перед первым сообщением каждого дня
+        day_key = store.day_keys[row]
+        if pos == 0 or store.day_keys[self.view[pos - 1]] != day_key:
+            date_label = format_day(day_key)
+            height += 40
+        else:
+            date_label = None
         
-        lines = self.wrap_text(text, 40)
+        if pos == len(self.view) - 1:
+            height += 30
         
-        line_height = 18
-        text_height = len(lines) * line_height
-        name_height = 20 if (not is_my_message and from_user) else 0
-        time_height = 15
+        self.heights.set_height(pos, height)
+        return MessageBlock(layout, top, date_label, height)
+    
+    def layout_row(self, row):
+        """Геометрия сообщения из кэша; запись другой ширины или с незагрузившейся картинкой пересчитывается"""
+        layout = self.layout_cache.get(row)
+        if layout is not None and layout.width == self.layout_width and not self.thumbnail_failed(layout):
+            self.layout_cache.move_to_end(row)
+            return layout
+        
+        layout = self.layout_message(row)
+        self.layout_cache[row] = layout
+        self.layout_cache.move_to_end(row)
+        if len(self.layout_cache) > self.layout_cache_size:
+            self.layout_cache.popitem(last=False)
+        return layout
+    
+    def layout_message(self, row):
+        """Расчет размеров сообщения без рисования"""
+        started = time.perf_counter() if PROFILER.enabled else None
+        store = self.store
+        width = self.layout_width
+        
+        layout = MessageLayout()
+        layout.width = width
+        layout.time = self.format_time(row)
+        layout.thumb = None
+        
+        if store.is_service(row):
+            layout.is_service = True
+            layout.text = store.service_text(row)
+            layout.height = 25
+        else:
+            layout.is_service = False
+            from_user = store.sender_name(row)
+            layout.is_my = 'user6582117962' in store.sender_id(row)
+            layout.name = from_user if (not layout.is_my and from_user) else ''
+            body = self.measurers['body']
+            layout.thumb = self.thumbnail_key(row)
+            if layout.thumb and not store.text(row).strip():
+                # Подпись «📷 Фото» не нужна, когда видна сама картинка
+                layout.lines, content_width = [], 0
+            else:
+                layout.lines, content_width = body.wrap(self.get_display_text(row, 200), width - self.bubble_padding * 2)
+            
+            line_height = body.line_height
+            name_height = 20 if layout.name else 0
+            time_height = 15
+            thumb_height = 0
+            if layout.thumb:
+                content_width = max(content_width, layout.thumb[1])
+                thumb_height = layout.thumb[2] + (6 if layout.lines else 0)
+            
+            if layout.name:
+                content_width = max(content_width, self.measurers['name'].width(layout.name))
+            layout.bubble_width = min(width, max(200, content_width + self.bubble_padding * 2))
+            layout.bubble_height = (name_height + thumb_height + len(layout.lines) * line_height
+                                    + time_height + self.bubble_padding * 2)
+            layout.height = layout.bubble_height + 10
+        
+        if started is not None:
+            PROFILER.record('layout', time.perf_counter() - started, 1, log=False)
+        return layout
+    
+    def place_message(self, slot, block, y, pos):
+        """Расстановка элементов набора по геометрии сообщения pos текущего представления"""
+        canvas = self.canvas
+        layout = block.layout
+        slot.block = block
+        slot.y = y
+        shown = set()
         
-        bubble_width = min(self.max_bubble_width, max(200, max(len(line) * 8 for line in lines) + 20))
-        bubble_height = name_height + text_height + time_height + self.bubble_padding * 2
+        x_center = self.canvas_width // 2
+        y_pos = y + block.top
+        
+        if block.date_label:
+            bg_width = self.measurers['date'].width(block.date_label) + 20
+            bg_height = 25
+            canvas.coords(slot.date_bg, x_center - bg_width // 2, y_pos, x_center + bg_width // 2, y_pos + bg_height)
+            canvas.coords(slot.date_text, x_center, y_pos + bg_height // 2)
+            canvas.itemconfigure(slot.date_text, text=block.date_label)
+            shown.update((slot.date_bg, slot.date_text))
+            y_pos += bg_height + 15
+        
+        if layout.is_service:
+            canvas.coords(slot.service_text, x_center, y_pos)
+            canvas.itemconfigure(slot.service_text, text=layout.text)
+            shown.add(slot.service_text)
+            slot.text_origin = None
+            slot.show_only(shown)
+            return
         
-        if is_my_message:
+        bubble_width = layout.bubble_width
+        bubble_height = layout.bubble_height
+        if layout.is_my:
             bubble_x = self.canvas_width - bubble_width - self.message_padding
             bubble_color = self.colors['my_message']
+            tail_x = bubble_x + bubble_width
+            tail_tip = tail_x + 8
         else:
             bubble_x = self.message_padding
             bubble_color = self.colors['other_message']
-        
-        self.draw_rounded_rectangle(
-            bubble_x, y_pos, bubble_x + bubble_width, y_pos + bubble_height,
-            radius=18, fill=bubble_color, tags="message_bubble"
+            tail_x = bubble_x
+            tail_tip = tail_x - 8
+        
+        canvas.coords(slot.bubble, *self.rounded_rectangle_points(
+            bubble_x, y_pos, bubble_x + bubble_width, y_pos + bubble_height, radius=18
+        ))
+        canvas.coords(
+            slot.tail,
+            tail_x, y_pos + bubble_height - 15,
+            tail_tip, y_pos + bubble_height - 8,
+            tail_x, y_pos + bubble_height - 5
         )
-        
-        if is_my_message:
-            self.canvas.create_polygon(
-                bubble_x + bubble_width, y_pos + bubble_height - 15,
-                bubble_x + bubble_width + 8, y_pos + bubble_height - 8,
-                bubble_x + bubble_width, y_pos + bubble_height - 5,
-                fill=bubble_color, outline="", tags="message_bubble"
-            )
-        else:
-            self.canvas.create_polygon(
-                bubble_x, y_pos + bubble_height - 15,
-                bubble_x - 8, y_pos + bubble_height - 8,
-                bubble_x, y_pos + bubble_height - 5,
-                fill=bubble_color, outline="", tags="message_bubble"
-            )
+        canvas.itemconfigure(slot.bubble, fill=bubble_color)
+        canvas.itemconfigure(slot.tail, fill=bubble_color)
+        shown.update((slot.bubble, slot.tail))
         
         text_x = bubble_x + self.bubble_padding
         text_y = y_pos + self.bubble_padding
         
-        if not is_my_message and from_user:
-            self.canvas.create_text(
-                text_x, text_y,
-                text=from_user,
-                fill=self.colors['name'],
-                font=('Arial', 10, 'bold'),
-                anchor='nw',
-                tags="message_text"
-            )
-            text_y += name_height
-        
-        for line in lines:
-            self.canvas.create_text(
-                text_x, text_y,
-                text=line,
-                fill=self.colors['text'],
-                font=('Arial', 11),
-                anchor='nw',
-                tags="message_text"
-            )
-            text_y += line_height
-        
-        time_x = bubble_x + bubble_width - self.bubble_padding - len(time_str) * 6
-        time_y = y_pos + bubble_height - time_height - 5
-        
-        self.canvas.create_text(
-            time_x, time_y,
-            text=time_str,
-            fill=self.colors['time'],
-            font=('Arial', 9),
-            anchor='nw',
-            tags="message_time"
-        )
-        
-        return y_pos + bubble_height + 10
+        if layout.name:
+            canvas.coords(slot.name_text, text_x, text_y)
+            canvas.itemconfigure(slot.name_text, text=layout.name)
+            shown.add(slot.name_text)
+            text_y += 20
+        
+        slot.photo = None
+        if layout.thumb:
+            self.place_thumbnail(slot, layout.thumb, text_x, text_y, shown)
+            text_y += layout.thumb[2] + 6
+        
+        canvas.coords(slot.body_text, text_x, text_y)
+        canvas.itemconfigure(slot.body_text, text='\n'.join(layout.lines))
+        shown.add(slot.body_text)
+        slot.text_origin = (text_x, text_y - y)
+        shown.update(self.place_match_marks(slot, pos))
+        
+        time_x = bubble_x + bubble_width - self.bubble_padding - self.measurers['time'].width(layout.time)
+        time_y = y_pos + bubble_height - 15 - 5
+        canvas.coords(slot.time_text, time_x, time_y)
+        canvas.itemconfigure(slot.time_text, text=layout.time)
+        shown.add(slot.time_text)
+        
+        slot.show_only(shown)
     
-    def draw_rounded_rectangle(self, x1, y1, x2, y2, radius=10, **kwargs):
-        """Рисование скругленного прямоугольника на Canvas"""
-        points = []
-        
-        for i in range(0, 90, 10):
-            x = x1 + radius - radius * math.cos(math.radians(i))
-            y = y1 + radius - radius * math.sin(math.radians(i))
-            points.extend([x, y])
-        
-        for i in range(90, 180, 10):
-            x = x2 - radius - radius * math.cos(math.radians(i))
-            y = y1 + radius - radius * math.sin(math.radians(i))
-            points.extend([x, y])
-        
-        for i in range(180, 270, 10):
-            x = x2 - radius - radius * math.cos(math.radians(i))
-            y = y2 - radius - radius * math.sin(math.radians(i))
-            points.extend([x, y])
+    def thumbnail_key(self, row):
+        """Ключ миниатюры сообщения для ThumbnailLoader или None (нет картинки, файла или Pillow)"""
+        if self.thumbnails is None or not self.media_dir:
+            return None
+        relative = self.store.media_path(row)
+        if not relative:
+            return None
+        # Есть ли файл, проверяет пул ThumbnailLoader: в потоке Tk нет обращений к диску
+        path = os.path.normpath(os.path.join(self.media_dir, relative))
+        if path in self.thumbnails.failed:
+            return None
+        return path, min(self.thumb_width, self.layout_width - self.bubble_padding * 2), self.thumb_height
+    
+    def thumbnail_failed(self, layout):
+        """Картинка из раскладки не загрузилась: раскладка устарела"""
+        return layout.thumb is not None and layout.thumb[0] in self.thumbnails.failed
+    
+    def place_thumbnail(self, slot, key, x, y, shown):
+        """Рамка миниатюры и сама картинка, если она уже загружена; иначе запрос в фон"""
+        canvas = self.canvas
+        _, width, height = key
+        canvas.coords(slot.thumb_bg, x, y, x + width, y + height)
+        canvas.coords(slot.thumb_image, x + width // 2, y + height // 2)
+        shown.add(slot.thumb_bg)
+        
+        image = self.thumbnails.get(key)
+        if image is None:
+            self.thumbnails.request(key)
+            self.schedule_thumbnails()
+            return
+        canvas.itemconfigure(slot.thumb_image, image=image)
+        slot.photo = image
+        shown.add(slot.thumb_image)
+    
+    def schedule_thumbnails(self):
+        """Проверка готовых миниатюр через thumbnail_poll_ms"""
+        if self.thumbnail_after_id is None:
+            self.thumbnail_after_id = self.root.after(self.thumbnail_poll_ms, self.poll_thumbnails)
+    
+    def poll_thumbnails(self):
+        """Показ готовых миниатюр у сообщений, которые еще расставлены в ленте (без перерисовки).
+        
+        Сообщения, чья картинка не загрузилась, раскладываются заново без рамки.
+        """
+        self.thumbnail_after_id = None
+        ready, failed = self.thumbnails.collect()
+        relayout = []
+        for pos, slot in self.active_slots.items():
+            key = slot.block.layout.thumb
+            if key in failed:
+                relayout.append(pos)
+                continue
+            image = self.thumbnails.get(key) if key in ready else None
+            if image is not None:
+                self.canvas.itemconfigure(slot.thumb_image, image=image)
+                slot.photo = image
+                slot.show_only(slot.shown | {slot.thumb_image})
+        
+        if relayout:
+            for pos in relayout:
+                slot = self.active_slots.pop(pos)
+                slot.hide()
+                self.free_slots.append(slot)
+                self.layout_cache.pop(self.view[pos], None)
+            self.clamp_scroll()
+            self.redraw_canvas()
+        if self.thumbnails.pending:
+            self.schedule_thumbnails()
+    
+    def match_at(self, pos):
+        """Номер совпадения в find_hits для позиции pos или None (бинарный поиск)"""
+        hits = self.find_hits
+        if not hits:
+            return None
+        k = bisect.bisect_left(hits, pos)
+        return k if k < len(hits) and hits[k] == pos else None
+    
+    def place_match_marks(self, slot, pos):
+        """Подсветка совпадений в пузырьке сообщения pos; возвращает показанные прямоугольники.
+        
+        Куски считаются только для видимых сообщений из списка совпадений:
+        SearchPattern.spans по тому же тексту, из которого сделан перенос,
+        затем каждый кусок раскладывается по строкам пузырька.
+        """
+        canvas = self.canvas
+        hit = self.match_at(pos)
+        current = hit is not None and hit == self.find_current
+        canvas.itemconfigure(slot.bubble, outline=self.colors['match_current'] if current else "", width=2)
+        if hit is None or slot.text_origin is None or self.search_pattern is None:
+            return set()
+        
+        text = ' '.join(self.get_display_text(self.view[pos], 200).split())
+        spans = self.search_pattern.spans(text)
+        if not spans:
+            return set()
+        
+        measurer = self.measurers['body']
+        line_height = measurer.line_height
+        text_x, text_y = slot.text_origin
+        text_y += slot.y
+        color = self.colors['match_current'] if current else self.colors['match']
+        
+        marks = set()
+        line_start = 0
+        for i, line in enumerate(slot.block.layout.lines):
+            line_end = line_start + len(line)
+            for start, end in spans:
+                start = max(start, line_start)
+                end = min(end, line_end)
+                if start >= end:
+                    continue
+                item = slot.mark(len(marks))
+                left = text_x + measurer.width(line[:start - line_start])
+                right = text_x + measurer.width(line[:end - line_start])
+                top = text_y + i * line_height
+                canvas.coords(item, left, top, right, top + line_height)
+                canvas.itemconfigure(item, fill=color)
+                marks.add(item)
+            # Строки разделены пробелом, кроме кусков слова длиннее строки
+            line_start = line_end + (text[line_end:line_end + 1] == ' ')
+        return marks
+    
+    def refresh_matches(self, positions=None):
+        """Обновление подсветки у уже расставленных сообщений без их перерисовки"""
+        for pos in list(self.active_slots) if positions is None else positions:
+            slot = self.active_slots.get(pos)
+            if slot is None or slot.block is None:
+                continue
+            items = {item for item in slot.shown if item not in slot.marks}
+            slot.show_only(items | self.place_match_marks(slot, pos))
+    
+    def next_match(self, event=None):
+        """Следующее совпадение"""
+        self.step_match(1)
+    
+    def prev_match(self, event=None):
+        """Предыдущее совпадение"""
+        self.step_match(-1)
+    
+    def step_match(self, step):
+        """Переход на step совпадений вперед или назад по готовому списку позиций (без нового поиска).
+        
+        Если совпадение еще не выбрано, отсчет идет от верха окна; после
+        последнего совпадения переход продолжается с первого.
+        """
+        hits = self.find_hits
+        if not hits:
+            return
+        if self.find_current is None:
+            k = bisect.bisect_left(hits, self.top_index) - (step < 0)
+        else:
+            k = self.find_current + step
+        self.show_match(k % len(hits))
+    
+    def show_match(self, k):
+        """Выбор совпадения k: лента прокручивается, только если его не видно целиком"""
+        previous = self.find_current
+        previous_pos = self.find_hits[previous] if previous is not None and previous < len(self.find_hits) else None
+        self.find_current = k
+        pos = self.find_hits[k]
+        
+        slot = self.active_slots.get(pos)
+        if slot is None or slot.y < 0 or slot.y + slot.block.height > self.canvas_height:
+            # Совпадение ставится на треть высоты окна, чтобы было видно сообщения до него
+            self.top_index = pos
+            self.top_offset = -(self.canvas_height // 3)
+            self.clamp_scroll()
+            self.redraw_canvas()
+        self.refresh_matches((previous_pos, pos))
+        self.update_match_label()
+    
+    def update_match_label(self):
+        """Счетчик совпадений рядом со строкой поиска"""
+        hits = self.find_hits
+        if hits is None:
+            text = ""
+        elif not hits:
+            text = "Нет совпадений"
+        else:
+            current = self.find_current + 1 if self.find_current is not None else "–"
+            text = f"{current} / {len(hits)}"
+        self.match_label.config(text=text)
+    
+    def rounded_rectangle_points(self, x1, y1, x2, y2, radius=10):
+        """Точки скругленного прямоугольника: готовый шаблон размера, сдвинутый в (x1, y1)"""
+        xs, ys = rounded_rectangle_template(x2 - x1, y2 - y1, radius)
+        points = [0] * (len(xs) * 2)
+        points[0::2] = [x + x1 for x in xs]
+        points[1::2] = [y + y1 for y in ys]
+        return points
+    
+    def get_display_text(self, row, max_length):
+        """Текст для пузырька: подпись медиа вместо пустого текста, обрезка по длине"""
+        return self.store.display_text(row, max_length)
+    
+    def get_media_text(self, row):
+        """Получение текста для медиафайлов"""
+        return self.store.media_text(row)
+    
+    def on_search(self, *args):
+        """Отложенный запуск поиска после изменения строки поиска"""
+        if self.search_after_id:
+            self.root.after_cancel(self.search_after_id)
+        self.search_after_id = self.root.after(self.search_debounce_ms, self.run_search)
+    
+    def cancel_search(self):
+        """Отмена отложенного и выполняющегося поиска"""
+        if self.search_after_id:
+            self.root.after_cancel(self.search_after_id)
+            self.search_after_id = None
+        if self.search_job:
+            self.search_job.cancel()
+            self.search_job = None
+    
+    def run_search(self, event=None):
+        """Запуск поиска, если изменились строка поиска, режим, поиск в чате или выбор фильтров.
+        
+        Возвращает False, если показанный результат уже соответствует запросу.
+        """
+        query = self.search_var.get().strip()
+        mode = next(key for key, label in SEARCH_MODES.items() if label == self.search_mode_var.get())
+        selection = self.facet_panel.selection() if self.facets_visible else {}
+        self.cancel_search()
+        
+        applied = self.search_pattern.key if self.search_pattern else None
+        if (((mode, query) if query else None) == applied and selection == self.facet_selection
+                and self.find_var.get() == self.find_mode):
+            return False
+        
+        pattern = None
+        if query:
+            try:
+                pattern = SearchPattern(query, mode)
+            except re.error as e:
+                self.stats_label.config(text=f"Ошибка в регулярном выражении: {e}")
+                return True
+        self.start_search(pattern, selection)
+        return True
+    
+    def on_search_return(self, event=None):
+        """Enter в строке поиска: новый поиск или, если запрос не менялся, следующее совпадение"""
+        if not self.run_search():
+            self.next_match()
+    
+    def start_search(self, pattern, selection):
+        """Поиск и фильтр в фоновом потоке; при открытой панели заодно считаются счетчики"""
+        self.cancel_search()
+        if not len(self.store):
+            return
         
-        for i in range(270, 360, 10):
-            x = x1 + radius - radius * math.cos(math.radians(i))
-            y = y2 - radius - radius * math.sin(math.radians(i))
-            points.extend([x, y])
+        find = self.find_var.get()
+        if pattern is None and not selection and not self.facets_visible:
+            self.facet_selection = {}
+            self.text_rows = None
+            self.find_mode = find
+            self.apply_search_result(None, range(len(self.store)), self.store.stats)
+            return
         
-        return self.canvas.create_polygon(points, smooth=True, **kwargs)
+        # Уточненный запрос ищется только среди уже найденных сообщений, а
+        # при том же запросе берется прошлый результат
+        base_rows = self.text_rows if pattern is not None and pattern.narrows(self.search_pattern) else None
+        found = None
+        if pattern is not None and self.search_pattern is not None and pattern.key == self.search_pattern.key:
+            found = self.text_rows
+        
+        facets = None
+        if selection or self.facets_visible:
+            facets = self.current_facet_index()
+        
+        self.search_job = SearchJob(self.store, pattern, self.trigram_index, base_rows, facets, selection, find,
+                                    found)
+        self.search_job.start()
+        self.root.after(20, self.poll_search, self.search_job)
     
-    def wrap_text(self, text, max_chars):
-        """Разбивка текста на строки"""
-        words = text.split()
-        lines = []
-        current_line = []
-        current_length = 0
-        
-        for word in words:
-            if current_length + len(word) + 1 <= max_chars:
-                current_line.append(word)
-                current_length += len(word) + 1
-            else:
-                if current_line:
-                    lines.append(' '.join(current_line))
-                current_line = [word]
-                current_length = len(word)
+    def poll_search(self, job):
+        """Получение результата поиска в потоке Tk"""
+        if job is not self.search_job:
+            return
         
-        if current_line:
-            lines.append(' '.join(current_line))
+        try:
+            event = job.events.get_nowait()
+        except queue.Empty:
+            self.root.after(20, self.poll_search, job)
+            return
         
-        return lines if lines else [""]
-    
-    def get_media_text(self, message):
-        """Получение текста для медиафайлов"""
-        if 'photo' in message:
-            return "📷 Фото"
-        elif message.get('media_type') == 'sticker':
-            emoji = message.get('sticker_emoji', '🎭')
-            return f"{emoji} Стикер"
-        elif message.get('media_type') == 'video_message':
-            return "🎥 Видеосообщение"
-        elif message.get('media_type') == 'video_file':
-            return "🎥 Видео"
-        elif message.get('media_type') == 'audio_file':
-            return f"🎵 {message.get('file_name', 'Аудиофайл')}"
-        elif message.get('media_type') == 'voice_message':
-            return "🎤 Голосовое сообщение"
-        elif message.get('media_type') == 'animation':
-            return "🎬 GIF анимация"
-        elif 'file' in message:
-            return f"📎 {message.get('file_name', 'Файл')}"
+        self.search_job = None
+        if event[0] == 'done':
+            self.facet_selection = job.selection
+            self.text_rows = job.text_rows
+            self.find_mode = job.find
+            if event[3] is not None:
+                self.facet_panel.show_counts(event[3])
+            self.apply_search_result(job.pattern, event[1], event[2], job.hits)
         else:
-            return "Сообщение"
+            messagebox.showerror("Ошибка", f"Ошибка поиска:\n{event[1]}")
     
-    def on_search(self, event=None):
-        """Обработка поиска"""
-        query = self.search_var.get().lower().strip()
-        self.search_query = query
-        
-        if not query:
-            self.filtered_messages = self.messages.copy()
-        else:
-            self.filtered_messages = []
-            for msg in self.messages:
-                text = msg.get('text', '')
-                if isinstance(text, list):
-                    full_text = ""
-                    for item in text:
-                        if isinstance(item, dict):
-                            full_text += item.get('text', '')
-                        else:
-                            full_text += str(item)
-                    text = full_text
-                
-                from_user = msg.get('from', '')
-                
-                if (query in text.lower() or 
-                    query in from_user.lower() or
-                    query in msg.get('file_name', '').lower()):
-                    self.filtered_messages.append(msg)
-        
-        self.setup_pagination()
-        self.go_to_last()
+    def apply_search_result(self, pattern, rows, stats, hits=None):
+        """Показ найденных сообщений и подсветка совпадений.
+        
+        При поиске в чате текст не сужает ленту: если представление не
+        изменилось, она остается на месте и обновляется только подсветка,
+        иначе открывается у того же сообщения; затем выбирается ближайшее
+        к верху окна совпадение. Отфильтрованная лента открывается в конце.
+        """
+        top_row = self.view[self.top_index] if self.find_mode and len(self.view) else None
+        self.search_pattern = pattern
+        self.view_stats = stats
+        
+        if top_row is None or rows != self.view:
+            self.view = rows
+            self.reset_view()
+            if top_row is None:
+                self.go_to_last()
+            else:
+                self.go_to_position(bisect.bisect_left(rows, top_row))
+        
+        # В отфильтрованной ленте совпадение есть в каждом сообщении
+        if hits is None and pattern is not None:
+            hits = range(len(rows))
+        self.find_hits = hits
+        self.find_current = None
+        self.refresh_matches()
+        if self.find_mode and hits:
+            self.show_match(min(bisect.bisect_left(hits, self.top_index), len(hits) - 1))
+        self.update_match_label()
+        self.update_stats()
     
     def clear_search(self):
         """Очистка поиска"""
         self.search_var.set("")
-        self.on_search()
+        self.run_search()
+    
+    def current_facet_index(self):
+        """Индекс фасетов текущего чата; панель заполняется его значениями"""
+        if self.facet_index is None:
+            self.facet_index = FacetIndex(self.store)
+            self.facet_panel.rebuild(self.facet_index)
+        return self.facet_index
+    
+    def reset_facets(self):
+        """Сброс фильтров при смене чата"""
+        self.facet_index = None
+        self.facet_selection = {}
+        self.text_rows = None
+        self.facet_panel.clear()
+    
+    def toggle_facets(self):
+        """Показ и скрытие панели фильтров; скрытые фильтры не применяются"""
+        self.facets_visible = not self.facets_visible
+        if self.facets_visible:
+            self.facet_panel.frame.pack(side='left', fill='y', padx=(0, 5))
+            self.start_search(self.search_pattern, self.facet_panel.selection())
+        else:
+            self.facet_panel.frame.pack_forget()
+            self.run_search()
     
     def update_stats(self):
         """Обновление статистики"""
-        if not self.messages:
+        store = self.store
+        if not len(store):
             self.stats_label.config(text="Готов к загрузке чата")
             return
         
-        total_messages = len(self.messages)
-        filtered_count = len(self.filtered_messages)
+        stats_text = f"Всего сообщений: {store.stats.total}"
+        if (self.search_pattern and not self.find_mode) or self.facet_selection:
+            stats_text += (f" | Найдено: {self.view_stats.total}"
+                           f" (участников: {self.view_stats.participants(store)})")
+        if self.search_pattern and self.find_mode and self.find_hits is not None:
+            stats_text += f" | Совпадений: {len(self.find_hits)}"
+        stats_text += f" | Участников: {store.stats.participants(store)}"
         
-        users = set()
-        for msg in self.messages:
-            if 'from' in msg:
-                users.add(msg.get('from'))
+        first, last = self.visible_range
+        stats_text += f" | Показано: {first + 1 if last else 0}-{last}"
         
-        stats_text = f"Всего сообщений: {total_messages}"
-        if self.search_query:
-            stats_text += f" | Найдено: {filtered_count}"
-        stats_text += f" | Участников: {len(users)}"
+        if store.bad_dates:
+            stats_text += f" | Без даты: {store.bad_dates}"
         
-        start_idx = self.current_page * self.messages_per_page + 1
-        end_idx = min((self.current_page + 1) * self.messages_per_page, filtered_count)
-        stats_text += f" | Показано: {start_idx}-{end_idx}"
+        if self.index_status:
+            stats_text += f" | {self.index_status}"
+        
+        if self.cache_status:
+            stats_text += f" | {self.cache_status}"
         
         self.stats_label.config(text=stats_text)
     
-    def format_time(self, date_str):
-        """Форматирование времени"""
-        try:
-            dt = datetime.fromisoformat(date_str.replace('T', ' ').replace('Z', ''))
-            return dt.strftime('%H:%M')
-        except:
-            return "00:00"
+    def toggle_profile_overlay(self, event=None):
+        """Показ и скрытие замеров по фазам в нижней панели"""
+        self.profile_overlay = not self.profile_overlay
+        if self.profile_overlay:
+            PROFILER.enable()
+            self.profile_label.pack(side='right', pady=5)
+            self.update_profile_overlay()
+            return
+        
+        self.profile_label.pack_forget()
+        if self.profile_after_id:
+            self.root.after_cancel(self.profile_after_id)
+            self.profile_after_id = None
+        # Замеры в журнал (TELEGRAM_VIEWER_PROFILE) продолжаются и без строки
+        if PROFILER.logger is None:
+            PROFILER.disable()
     
-    def get_message_date(self, message):
-        """Получение даты сообщения"""
-        try:
-            date_str = message.get('date', '')
-            dt = datetime.fromisoformat(date_str.replace('T', ' ').replace('Z', ''))
-            return dt.strftime('%d.%m.%Y')
-        except:
-            return "Неизвестная дата"
+    def update_profile_overlay(self):
+        """Обновление строки замеров раз в полсекунды"""
+        self.profile_label.config(text=PROFILER.status_text())
+        self.profile_after_id = self.root.after(500, self.update_profile_overlay)
+    
+    def format_time(self, row):
+        """Форматирование времени"""
+        return self.store.time_label(row)
     
     def get_action_text(self, action):
         """Получение текста для служебного действия"""
-        actions = {
-            'joined_telegram': 'присоединился к Telegram',
-            'left_chat': 'покинул чат',
-            'joined_chat': 'присоединился к чату',
-            'created_chat': 'создал чат'
-        }
-        return actions.get(action, action)
+        return ACTION_TEXTS.get(action, action)
     
     def export_to_image_simple(self):
         """Упрощенный экспорт в изображение"""
-        if not self.messages:
+        if self.export_job:
+            return
+        
+        if not len(self.store):
             messagebox.showwarning("Предупреждение", "Нет данных для экспорта")
             return
         
@@ -675,11 +4752,13 @@ class TelegramChatFinalWorking:
             return
         
         # Простой диалог выбора количества сообщений
-        dialog = SimpleExportDialog(self.root, len(self.filtered_messages))
+        dialog = SimpleExportDialog(self.root, len(self.view))
         if not dialog.result:
             return
         
         max_messages = dialog.result
+        split = dialog.split
+        thumbnails = dialog.thumbnails
         
         # Выбор пути сохранения - ЧЕТКИЙ И ПРОСТОЙ
         default_filename = f"{self.current_chat_name.replace(' ', '_')}_chat_{max_messages}msg.png"
@@ -688,263 +4767,620 @@ class TelegramChatFinalWorking:
             title="Сохранить изображение чата",
             defaultextension=".png",
             filetypes=[("PNG изображения", "*.png"), ("Все файлы", "*.*")],
-            initialfilename=default_filename
+            initialfile=default_filename
         )
         
         if not file_path:
             messagebox.showinfo("Отмена", "Экспорт отменен")
             return
         
-        # Показываем простой прогресс
-        progress_window = SimpleProgressWindow(self.root)
-        
-        def create_image():
-            try:
-                progress_window.update_status("Подготовка данных...")
-                
-                # Берем последние сообщения
-                messages_to_export = self.filtered_messages[-max_messages:] if len(self.filtered_messages) > max_messages else self.filtered_messages
-                
-                progress_window.update_status("Создание изображения...")
-                
-                # Создаем простое изображение
-                self.create_simple_image(messages_to_export, file_path, progress_window)
-                
-                progress_window.close()
-                
-                # Показываем результат
-                if os.path.exists(file_path):
-                    file_size = os.path.getsize(file_path) / 1024  # в КБ
-                    messagebox.showinfo(
-                        "Успех!", 
-                        f"✅ Изображение создано!\\n\\n"
-                        f"📁 Файл: {file_path}\\n"
-                        f"📊 Сообщений: {len(messages_to_export)}\\n"
-                        f"💾 Размер: {file_size:.1f} КБ"
-                    )
-                else:
-                    messagebox.showerror("Ошибка", "Файл не был создан")
-                    
-            except Exception as e:
-                progress_window.close()
-                messagebox.showerror("Ошибка", f"Не удалось создать изображение:\\n{str(e)}")
-        
-        # Запускаем в отдельном потоке
-        thread = threading.Thread(target=create_image)
-        thread.daemon = True
-        thread.start()
-    
-    def create_simple_image(self, messages, output_path, progress_window):
-        """Создание простого изображения чата"""
-        # Настройки
-        width = 1200
-        background_color = (23, 33, 43)  # #17212b
-        text_color = (255, 255, 255)
-        my_bubble_color = (43, 82, 120)  # #2b5278
-        other_bubble_color = (24, 37, 51)  # #182533
-        
-        # Примерная высота
-        estimated_height = len(messages) * 80 + 200
-        height = min(estimated_height, 8000)  # Ограничиваем высоту
-        
-        # Создаем изображение
-        img = Image.new('RGB', (width, height), background_color)
-        draw = ImageDraw.Draw(img)
-        
-        # Пытаемся загрузить шрифт
-        try:
-            font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 16)
-            font_small = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 12)
-            font_bold = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 18)
-        except:
-            font = ImageFont.load_default()
-            font_small = ImageFont.load_default()
-            font_bold = ImageFont.load_default()
-        
-        progress_window.update_status("Рисование заголовка...")
-        
-        # Заголовок
-        title = f"💬 {self.current_chat_name}"
-        title_bbox = draw.textbbox((0, 0), title, font=font_bold)
-        title_width = title_bbox[2] - title_bbox[0]
-        title_x = (width - title_width) // 2
-        draw.text((title_x, 30), title, fill=text_color, font=font_bold)
-        
-        subtitle = f"Последние {len(messages)} сообщений"
-        subtitle_bbox = draw.textbbox((0, 0), subtitle, font=font_small)
-        subtitle_width = subtitle_bbox[2] - subtitle_bbox[0]
-        subtitle_x = (width - subtitle_width) // 2
-        draw.text((subtitle_x, 60), subtitle, fill=(112, 132, 153), font=font_small)
-        
-        # Рисуем сообщения
-        y_pos = 120
-        current_date = None
-        
-        for i, message in enumerate(messages):
-            if y_pos > height - 100:
-                break
-            
-            # Обновляем прогресс
-            if i % 10 == 0:
-                progress = int((i / len(messages)) * 100)
-                progress_window.update_status(f"Обработано {i+1}/{len(messages)} сообщений ({progress}%)")
-            
-            # Разделитель дня
-            msg_date = self.get_message_date(message)
-            if msg_date != current_date:
-                y_pos = self.draw_simple_date_separator(draw, msg_date, y_pos, width, font_small)
-                current_date = msg_date
-            
-            # Сообщение
-            if message.get('type') == 'service':
-                y_pos = self.draw_simple_service_message(draw, message, y_pos, width, font_small)
-            else:
-                y_pos = self.draw_simple_message(draw, message, y_pos, width, font, font_small, my_bubble_color, other_bubble_color, text_color)
-        
-        progress_window.update_status("Сохранение файла...")
+        rows = self.view[-max_messages:]
+        subtitle = export_subtitle(self.store, rows, len(self.view), self.export_conditions())
+        self.create_simple_image(rows, file_path, split, thumbnails, subtitle)
+    
+    def export_conditions(self):
+        """Условия, по которым отобрана лента, для подзаголовка экспорта"""
+        conditions = []
+        if self.search_pattern is not None and not self.find_mode:
+            conditions.append(search_condition(self.search_pattern.query))
+        facets = [FACET_TITLES[facet].lower() for facet in FACET_COLUMNS if facet in self.facet_selection]
+        if 'dates' in self.facet_selection:
+            facets.append("даты")
+        if facets:
+            conditions.append("Фильтр: " + ", ".join(facets))
+        return conditions
+    
+    def create_simple_image(self, rows, output_path, split=False, thumbnails=False, subtitle=None):
+        """Запуск экспорта строк rows в фоне с окном прогресса"""
+        media_dir = self.media_dir if thumbnails else None
+        job = ExportJob(self.store, rows, self.current_chat_name, output_path, split, media_dir=media_dir,
+                        subtitle=subtitle)
+        self.export_job = job
+        self.export_progress = SimpleProgressWindow(self.root, job.cancel)
+        job.start()
+        self.root.after(100, self.poll_export, job)
+    
+    def poll_export(self, job):
+        """Обработка событий экспорта в потоке Tk"""
+        if job is not self.export_job:
+            return
+        
+        window = self.export_progress
+        try:
+            while True:
+                event = job.events.get_nowait()
+                kind = event[0]
+                
+                if kind == 'layout':
+                    window.update_status(f"Раскладка {event[1]} сообщений...")
+                elif kind == 'progress':
+                    window.show_progress(event[1], event[2], len(job.rows))
+                elif kind in ('done', 'cancelled', 'error'):
+                    self.export_job = None
+                    window.close()
+                    self.on_export_finished(job, event)
+                    return
+        except queue.Empty:
+            pass
+        
+        self.root.after(100, self.poll_export, job)
+    
+    def on_export_finished(self, job, event):
+        """Сообщение об итоге экспорта"""
+        kind = event[0]
+        if kind == 'cancelled':
+            messagebox.showinfo("Отмена", "Экспорт отменен, недописанные файлы удалены")
+            return
+        if kind == 'error':
+            messagebox.showerror("Ошибка", f"Не удалось создать изображение:\n{event[1]}")
+            return
         
-        # Обрезаем до нужной высоты
-        final_height = min(y_pos + 50, height)
-        img = img.crop((0, 0, width, final_height))
+        paths, seconds = event[1], event[2]
+        if not all(os.path.exists(path) for path in paths):
+            messagebox.showerror("Ошибка", "Файл не был создан")
+            return
         
-        # Сохраняем
-        img.save(output_path, 'PNG', quality=100)
+        file_size = sum(os.path.getsize(path) for path in paths) / 1024  # в КБ
+        if len(paths) == 1:
+            files_text = f"📁 Файл: {paths[0]}"
+        else:
+            files_text = f"📁 Файлы: {paths[0]} ... {os.path.basename(paths[-1])} ({len(paths)} шт.)"
+        messagebox.showinfo(
+            "Успех!", 
+            f"✅ Изображение создано за {seconds:.1f} с!\n\n"
+            f"{files_text}\n"
+            f"📊 Сообщений: {len(job.rows)}\n"
+            f"💾 Размер: {file_size:.1f} КБ"
+        )
+
+class FacetPanel:
+    """Боковая панель фильтров: тип, медиа, действие, отправитель и даты.
     
-    def draw_simple_date_separator(self, draw, date_str, y_pos, width, font):
-        """Простой разделитель даты"""
-        bbox = draw.textbbox((0, 0), date_str, font=font)
-        text_width = bbox[2] - bbox[0]
-        text_height = bbox[3] - bbox[1]
+    Значения берутся из FacetIndex (rebuild), счетчики приходят из
+    результата поиска (show_counts); любое изменение выбора вызывает
+    on_change, а выбор в виде словаря для FacetIndex.apply отдает selection().
+    """
+    
+    def __init__(self, parent, colors, on_change):
+        self.colors = colors
+        self.on_change = on_change
+        self.checks = {}
+        self.senders = []
         
-        bg_width = text_width + 20
-        bg_height = text_height + 10
-        bg_x = (width - bg_width) // 2
+        self.frame = tk.Frame(parent, bg=colors['bg'], width=250)
+        self.frame.pack_propagate(False)
         
-        # Фон
-        draw.rectangle([bg_x, y_pos, bg_x + bg_width, y_pos + bg_height], fill=(35, 46, 60))
+        header = tk.Frame(self.frame, bg=colors['bg'])
+        header.pack(fill='x')
+        tk.Label(
+            header,
+            text="Фильтры",
+            bg=colors['bg'],
+            fg=colors['text'],
+            font=('Arial', 11, 'bold')
+        ).pack(side='left')
+        tk.Button(
+            header,
+            text="Сбросить",
+            command=self.reset,
+            bg=colors['other_message'],
+            fg=colors['text'],
+            font=('Arial', 8),
+            relief='flat',
+            cursor='hand2'
+        ).pack(side='right')
+        
+        # Даты: ДД.ММ.ГГГГ, применяются по Enter или при уходе из поля
+        dates_frame = tk.Frame(self.frame, bg=colors['bg'])
+        dates_frame.pack(fill='x', pady=(8, 0))
+        self.date_vars = []
+        self.date_entries = []
+        for text in ("с", "по"):
+            tk.Label(
+                dates_frame,
+                text=text,
+                bg=colors['bg'],
+                fg=colors['time'],
+                font=('Arial', 9)
+            ).pack(side='left')
+            var = tk.StringVar()
+            entry = tk.Entry(
+                dates_frame,
+                textvariable=var,
+                width=10,
+                bg=colors['search_bg'],
+                fg=colors['text'],
+                font=('Arial', 9),
+                relief='flat',
+                insertbackground=colors['text']
+            )
+            entry.pack(side='left', padx=(3, 6), ipady=2)
+            entry.bind('<Return>', lambda event: self.on_change())
+            entry.bind('<FocusOut>', lambda event: self.on_change())
+            self.date_vars.append(var)
+            self.date_entries.append(entry)
         
-        # Текст
-        text_x = bg_x + 10
-        text_y = y_pos + 5
-        draw.text((text_x, text_y), date_str, fill=(112, 132, 153), font=font)
+        # Флажки типа, медиа и действий пересоздаются для каждого чата
+        self.checks_frame = tk.Frame(self.frame, bg=colors['bg'])
+        self.checks_frame.pack(fill='x')
         
-        return y_pos + bg_height + 20
+        tk.Label(
+            self.frame,
+            text=FACET_TITLES['sender'],
+            bg=colors['bg'],
+            fg=colors['text'],
+            font=('Arial', 9, 'bold')
+        ).pack(anchor='w', pady=(6, 0))
+        
+        list_frame = tk.Frame(self.frame, bg=colors['bg'])
+        list_frame.pack(fill='both', expand=True)
+        self.sender_list = tk.Listbox(
+            list_frame,
+            selectmode='multiple',
+            bg=colors['chat_bg'],
+            fg=colors['text'],
+            selectbackground=colors['my_message'],
+            font=('Arial', 9),
+            relief='flat',
+            activestyle='none',
+            exportselection=False
+        )
+        scrollbar = ttk.Scrollbar(list_frame, orient='vertical', command=self.sender_list.yview)
+        self.sender_list.configure(yscrollcommand=scrollbar.set)
+        self.sender_list.pack(side='left', fill='both', expand=True)
+        scrollbar.pack(side='right', fill='y')
+        self.sender_list.bind('<<ListboxSelect>>', lambda event: self.on_change())
     
-    def draw_simple_service_message(self, draw, message, y_pos, width, font):
-        """Простое служебное сообщение"""
-        action = message.get('action', '')
-        actor = message.get('actor', '')
-        time_str = self.format_time(message.get('date', ''))
+    def rebuild(self, index):
+        """Флажки и список отправителей для значений нового чата"""
+        self.clear()
+        for facet in ('kind', 'media', 'action'):
+            values = index.values(facet)
+            if not values:
+                continue
+            tk.Label(
+                self.checks_frame,
+                text=FACET_TITLES[facet],
+                bg=self.colors['bg'],
+                fg=self.colors['text'],
+                font=('Arial', 9, 'bold')
+            ).pack(anchor='w', pady=(6, 0))
+            for value, label in values:
+                var = tk.IntVar()
+                button = tk.Checkbutton(
+                    self.checks_frame,
+                    text=label,
+                    variable=var,
+                    command=self.on_change,
+                    bg=self.colors['bg'],
+                    fg=self.colors['text'],
+                    selectcolor=self.colors['search_bg'],
+                    activebackground=self.colors['bg'],
+                    activeforeground=self.colors['text'],
+                    font=('Arial', 9),
+                    anchor='w'
+                )
+                button.pack(fill='x')
+                self.checks[(facet, value)] = (var, button, label)
+        
+        self.senders = index.values('sender')
+        for _, label in self.senders:
+            self.sender_list.insert('end', label)
+    
+    def clear(self):
+        """Удаление значений прежнего чата"""
+        for widget in self.checks_frame.winfo_children():
+            widget.destroy()
+        self.checks.clear()
+        self.senders = []
+        self.sender_list.delete(0, 'end')
+        for var in self.date_vars:
+            var.set("")
+    
+    def reset(self):
+        """Снятие всех фильтров"""
+        for var, _, _ in self.checks.values():
+            var.set(0)
+        self.sender_list.selection_clear(0, 'end')
+        for var in self.date_vars:
+            var.set("")
+        self.on_change()
+    
+    def parse_day(self, position):
+        """Номер дня из поля даты; пустое или неразборчивое поле - None"""
+        text = self.date_vars[position].get().strip()
+        parsed = parse_jump_date(text) if text else None
+        self.date_entries[position].config(
+            fg=self.colors['text'] if parsed or not text else '#f44336'
+        )
+        return parsed[0] if parsed else None
+    
+    def selection(self):
+        """Выбор для FacetIndex.apply: только фасеты, в которых что-то отмечено"""
+        selection = {}
+        for (facet, value), (var, _, _) in self.checks.items():
+            if var.get():
+                selection.setdefault(facet, set()).add(value)
+        senders = {self.senders[position][0] for position in self.sender_list.curselection()}
+        if senders:
+            selection['sender'] = senders
+        selection = {facet: frozenset(values) for facet, values in selection.items()}
+        
+        since, until = self.parse_day(0), self.parse_day(1)
+        if since is not None or until is not None:
+            selection['dates'] = (since, until)
+        return selection
+    
+    def show_counts(self, counts):
+        """Счетчики значений с учетом остальных фильтров"""
+        for (facet, value), (_, button, label) in self.checks.items():
+            count = counts[facet].get(value, 0)
+            button.config(
+                text=f"{label} ({count})",
+                fg=self.colors['text'] if count else self.colors['time']
+            )
         
-        service_text = f"{actor} {self.get_action_text(action)} • {time_str}"
+        # Строки списка переписываются с сохранением выбора и прокрутки
+        selected = self.sender_list.curselection()
+        top = self.sender_list.yview()[0]
+        self.sender_list.delete(0, 'end')
+        sender_counts = counts['sender']
+        for value, label in self.senders:
+            self.sender_list.insert('end', f"{label} — {sender_counts.get(value, 0)}")
+        for position in selected:
+            self.sender_list.selection_set(position)
+        self.sender_list.yview_moveto(top)
+
+class ChatPickerDialog:
+    """Выбор чата полного экспорта с фильтром по названию"""
+    
+    def __init__(self, parent, chats):
+        self.result = None
+        self.chats = sorted(chats, key=lambda entry: -entry.message_count)
+        self.shown = self.chats
         
-        bbox = draw.textbbox((0, 0), service_text, font=font)
-        text_width = bbox[2] - bbox[0]
-        text_x = (width - text_width) // 2
+        self.dialog = tk.Toplevel(parent)
+        self.dialog.title("Выбор чата")
+        self.dialog.geometry("480x520")
+        self.dialog.configure(bg='#17212b')
+        self.dialog.transient(parent)
+        self.dialog.grab_set()
         
-        draw.text((text_x, y_pos), service_text, fill=(112, 132, 153), font=font)
+        x = parent.winfo_rootx() + 50
+        y = parent.winfo_rooty() + 50
+        self.dialog.geometry(f"+{x}+{y}")
         
-        return y_pos + 30
-    
-    def draw_simple_message(self, draw, message, y_pos, width, font, font_small, my_color, other_color, text_color):
-        """Простое сообщение"""
-        from_user = message.get('from', '')
-        from_id = message.get('from_id', '')
-        text = message.get('text', '')
-        time_str = self.format_time(message.get('date', ''))
+        tk.Label(
+            self.dialog,
+            text=f"💬 Чатов в экспорте: {len(chats)}",
+            bg='#17212b',
+            fg='white',
+            font=('Arial', 12, 'bold')
+        ).pack(pady=(15, 10))
         
-        is_my_message = 'user6582117962' in from_id
+        self.filter_var = tk.StringVar()
+        self.filter_var.trace_add('write', self.apply_filter)
+        filter_entry = tk.Entry(
+            self.dialog,
+            textvariable=self.filter_var,
+            bg='#232e3c',
+            fg='white',
+            font=('Arial', 10),
+            relief='flat',
+            insertbackground='white'
+        )
+        filter_entry.pack(fill='x', padx=20, ipady=4)
+        filter_entry.focus_set()
         
-        # Обработка текста
-        if isinstance(text, list):
-            full_text = ""
-            for item in text:
-                if isinstance(item, dict):
-                    full_text += item.get('text', '')
-                else:
-                    full_text += str(item)
-            text = full_text
+        list_frame = tk.Frame(self.dialog, bg='#17212b')
+        list_frame.pack(fill='both', expand=True, padx=20, pady=10)
         
-        if not text.strip():
-            text = self.get_media_text(message)
+        self.listbox = tk.Listbox(
+            list_frame,
+            bg='#0e1621',
+            fg='white',
+            selectbackground='#2b5278',
+            font=('Arial', 10),
+            relief='flat',
+            activestyle='none'
+        )
+        scrollbar = ttk.Scrollbar(list_frame, orient='vertical', command=self.listbox.yview)
+        self.listbox.configure(yscrollcommand=scrollbar.set)
+        self.listbox.pack(side='left', fill='both', expand=True)
+        scrollbar.pack(side='right', fill='y')
+        self.listbox.bind('<Double-Button-1>', lambda event: self.ok_clicked())
+        self.dialog.bind('<Return>', lambda event: self.ok_clicked())
+        self.dialog.bind('<Escape>', lambda event: self.cancel_clicked())
         
-        # Ограничиваем длину
-        if len(text) > 300:
-            text = text[:300] + "..."
+        btn_frame = tk.Frame(self.dialog, bg='#17212b')
+        btn_frame.pack(pady=(0, 15))
         
-        # Разбиваем на строки
-        max_chars = 50
-        lines = []
-        words = text.split()
-        current_line = []
-        current_length = 0
+        tk.Button(
+            btn_frame,
+            text="✅ Открыть",
+            command=self.ok_clicked,
+            bg='#4CAF50',
+            fg='white',
+            font=('Arial', 11, 'bold'),
+            padx=20,
+            pady=5,
+            relief='flat',
+            cursor='hand2'
+        ).pack(side='left', padx=10)
         
-        for word in words:
-            if current_length + len(word) + 1 <= max_chars:
-                current_line.append(word)
-                current_length += len(word) + 1
-            else:
-                if current_line:
-                    lines.append(' '.join(current_line))
-                current_line = [word]
-                current_length = len(word)
+        tk.Button(
+            btn_frame,
+            text="❌ Отмена",
+            command=self.cancel_clicked,
+            bg='#708499',
+            fg='white',
+            font=('Arial', 10),
+            padx=20,
+            pady=5,
+            relief='flat',
+            cursor='hand2'
+        ).pack(side='left', padx=10)
         
-        if current_line:
-            lines.append(' '.join(current_line))
+        self.apply_filter()
+        parent.wait_window(self.dialog)
+    
+    def apply_filter(self, *args):
+        """Список чатов, в названии которых есть строка фильтра"""
+        needle = self.filter_var.get().lower().strip()
+        self.shown = [entry for entry in self.chats if needle in entry.title.lower()]
+        self.listbox.delete(0, 'end')
+        for entry in self.shown:
+            left = " (покинут)" if entry.section == 'left_chats' else ""
+            self.listbox.insert('end', f"{entry.title}{left} — {entry.message_count} сообщ.")
+        if self.shown:
+            self.listbox.selection_set(0)
+    
+    def ok_clicked(self):
+        selection = self.listbox.curselection()
+        if selection:
+            self.result = self.shown[selection[0]]
+        self.dialog.destroy()
+    
+    def cancel_clicked(self):
+        self.dialog.destroy()
+
+class DateJumpDialog:
+    """Переход к дате: поле ввода и календарь активности по месяцам и дням"""
+    
+    def __init__(self, parent, index, day):
+        self.result = None
+        self.index = index
+        self.months = index.months()
+        self.month_keys = [key for key, _ in self.months]
         
-        if not lines:
-            lines = [""]
+        self.dialog = tk.Toplevel(parent)
+        self.dialog.title("Переход к дате")
+        self.dialog.geometry("600x460")
+        self.dialog.configure(bg='#17212b')
+        self.dialog.transient(parent)
+        self.dialog.grab_set()
         
-        # Размеры пузырька
-        line_height = 20
-        padding = 15
-        max_line_width = max(len(line) for line in lines) * 8
-        bubble_width = min(500, max(200, max_line_width + padding * 2))
+        x = parent.winfo_rootx() + 50
+        y = parent.winfo_rooty() + 50
+        self.dialog.geometry(f"+{x}+{y}")
         
-        name_height = 20 if (not is_my_message and from_user) else 0
-        text_height = len(lines) * line_height
-        time_height = 15
-        bubble_height = name_height + text_height + time_height + padding * 2
+        tk.Label(
+            self.dialog,
+            text=f"📅 Сообщения с {format_day(index.days[0])} по {format_day(index.days[-1])}",
+            bg='#17212b',
+            fg='white',
+            font=('Arial', 12, 'bold')
+        ).pack(pady=(15, 10))
         
-        # Позиция пузырька
-        if is_my_message:
-            bubble_x = width - bubble_width - 50
-            bubble_color = my_color
-        else:
-            bubble_x = 50
-            bubble_color = other_color
+        entry_frame = tk.Frame(self.dialog, bg='#17212b')
+        entry_frame.pack(fill='x', padx=20)
         
-        # Рисуем пузырек (простой прямоугольник)
-        draw.rectangle([bubble_x, y_pos, bubble_x + bubble_width, y_pos + bubble_height], fill=bubble_color)
+        self.date_var = tk.StringVar(value=format_day(day))
+        date_entry = tk.Entry(
+            entry_frame,
+            textvariable=self.date_var,
+            bg='#232e3c',
+            fg='white',
+            font=('Arial', 10),
+            relief='flat',
+            insertbackground='white'
+        )
+        date_entry.pack(side='left', fill='x', expand=True, ipady=4)
+        date_entry.focus_set()
+        date_entry.select_range(0, 'end')
+        
+        tk.Button(
+            entry_frame,
+            text="Перейти",
+            command=self.ok_clicked,
+            bg='#4CAF50',
+            fg='white',
+            font=('Arial', 10, 'bold'),
+            relief='flat',
+            padx=15,
+            cursor='hand2'
+        ).pack(side='left', padx=(10, 0))
+        
+        self.hint_label = tk.Label(
+            self.dialog,
+            text="ДД.ММ.ГГГГ, ДД.ММ.ГГГГ ЧЧ:ММ или ММ.ГГГГ",
+            bg='#17212b',
+            fg='#708499',
+            font=('Arial', 9)
+        )
+        self.hint_label.pack(pady=(4, 0))
         
-        # Текст внутри пузырька
-        text_x = bubble_x + padding
-        text_y = y_pos + padding
+        body = tk.Frame(self.dialog, bg='#17212b')
+        body.pack(fill='both', expand=True, padx=20, pady=10)
         
-        # Имя отправителя
-        if not is_my_message and from_user:
-            draw.text((text_x, text_y), from_user, fill=(91, 179, 240), font=font)
-            text_y += name_height
+        # Активность по месяцам
+        self.month_list = tk.Listbox(
+            body,
+            width=24,
+            bg='#0e1621',
+            fg='white',
+            selectbackground='#2b5278',
+            font=('Arial', 10),
+            relief='flat',
+            activestyle='none',
+            exportselection=False
+        )
+        scrollbar = ttk.Scrollbar(body, orient='vertical', command=self.month_list.yview)
+        self.month_list.configure(yscrollcommand=scrollbar.set)
+        self.month_list.pack(side='left', fill='y')
+        scrollbar.pack(side='left', fill='y')
+        for (year, month), count in self.months:
+            self.month_list.insert('end', f"{MONTH_NAMES[month - 1]} {year} — {count}")
+        self.month_list.bind('<<ListboxSelect>>', self.on_month_selected)
+        
+        # Календарь месяца
+        calendar_frame = tk.Frame(body, bg='#17212b')
+        calendar_frame.pack(side='left', fill='both', expand=True, padx=(15, 0))
+        
+        header = tk.Frame(calendar_frame, bg='#17212b')
+        header.pack(fill='x')
+        for text, step, side in (("◀", -1, 'left'), ("▶", 1, 'right')):
+            tk.Button(
+                header,
+                text=text,
+                command=lambda step=step: self.step_month(step),
+                bg='#182533',
+                fg='white',
+                font=('Arial', 9),
+                relief='flat',
+                padx=8,
+                cursor='hand2'
+            ).pack(side=side)
+        self.month_label = tk.Label(
+            header,
+            bg='#17212b',
+            fg='white',
+            font=('Arial', 10, 'bold')
+        )
+        self.month_label.pack(side='left', expand=True)
         
-        # Текст сообщения
-        for line in lines:
-            draw.text((text_x, text_y), line, fill=text_color, font=font)
-            text_y += line_height
+        self.days_frame = tk.Frame(calendar_frame, bg='#17212b')
+        self.days_frame.pack(pady=(10, 0))
         
-        # Время
-        time_x = bubble_x + bubble_width - padding - len(time_str) * 6
-        time_y = y_pos + bubble_height - time_height - 5
-        draw.text((time_x, time_y), time_str, fill=(112, 132, 153), font=font_small)
+        self.dialog.bind('<Return>', lambda event: self.ok_clicked())
+        self.dialog.bind('<Escape>', lambda event: self.cancel_clicked())
         
-        return y_pos + bubble_height + 15
+        current = date.fromordinal(day)
+        self.show_month(current.year, current.month)
+        parent.wait_window(self.dialog)
+    
+    def show_month(self, year, month):
+        """Сетка дней месяца: у дней с сообщениями кнопка с их числом"""
+        self.month = (year, month)
+        counts = self.index.month_days(year, month)
+        self.month_label.config(text=f"{MONTH_NAMES[month - 1]} {year}: {sum(counts.values())} сообщ.")
+        
+        for widget in self.days_frame.winfo_children():
+            widget.destroy()
+        for column, name in enumerate(WEEKDAY_NAMES):
+            tk.Label(
+                self.days_frame,
+                text=name,
+                bg='#17212b',
+                fg='#708499',
+                font=('Arial', 9)
+            ).grid(row=0, column=column)
+        
+        first = date(year, month, 1)
+        month_length = date(year + month // 12, month % 12 + 1, 1).toordinal() - first.toordinal()
+        peak = max(counts.values(), default=1)
+        for number in range(1, month_length + 1):
+            cell = first.weekday() + number - 1
+            count = counts.get(number, 0)
+            if count:
+                # Оттенок тем ярче, чем больше сообщений относительно самого активного дня
+                shade = min((count * len(ACTIVITY_COLORS) - 1) // peak, len(ACTIVITY_COLORS) - 1)
+                widget = tk.Button(
+                    self.days_frame,
+                    text=f"{number}\n{count}",
+                    command=lambda day=first.toordinal() + number - 1: self.day_clicked(day),
+                    bg=ACTIVITY_COLORS[shade],
+                    fg='white',
+                    font=('Arial', 8),
+                    width=4,
+                    relief='flat',
+                    cursor='hand2'
+                )
+            else:
+                widget = tk.Label(
+                    self.days_frame,
+                    text=f"{number}\n",
+                    bg='#17212b',
+                    fg='#4a5868',
+                    font=('Arial', 8),
+                    width=4
+                )
+            widget.grid(row=1 + cell // 7, column=cell % 7, padx=1, pady=1)
+        
+        position = bisect.bisect_left(self.month_keys, self.month)
+        self.month_list.selection_clear(0, 'end')
+        if position < len(self.month_keys) and self.month_keys[position] == self.month:
+            self.month_list.selection_set(position)
+            self.month_list.see(position)
+    
+    def step_month(self, step):
+        """Предыдущий или следующий месяц, в котором есть сообщения"""
+        if step > 0:
+            position = bisect.bisect_right(self.month_keys, self.month)
+        else:
+            position = bisect.bisect_left(self.month_keys, self.month) - 1
+        if 0 <= position < len(self.month_keys):
+            self.show_month(*self.month_keys[position])
+    
+    def on_month_selected(self, event=None):
+        selection = self.month_list.curselection()
+        if selection:
+            self.show_month(*self.month_keys[selection[0]])
+    
+    def day_clicked(self, day):
+        self.result = self.index.find(day)
+        self.dialog.destroy()
+    
+    def ok_clicked(self):
+        parsed = parse_jump_date(self.date_var.get())
+        if parsed is None:
+            self.hint_label.config(text="Не удалось разобрать дату: ДД.ММ.ГГГГ [ЧЧ:ММ] или ММ.ГГГГ", fg='#f44336')
+            return
+        self.result = self.index.find(*parsed)
+        self.dialog.destroy()
+    
+    def cancel_clicked(self):
+        self.dialog.destroy()
 
 class SimpleExportDialog:
     def __init__(self, parent, max_messages):
         self.result = None
+        self.split = False
+        self.thumbnails = False
         
         self.dialog = tk.Toplevel(parent)
         self.dialog.title("Экспорт в изображение")
-        self.dialog.geometry("400x250")
+        self.dialog.geometry("400x410")
         self.dialog.configure(bg='#17212b')
         self.dialog.transient(parent)
         self.dialog.grab_set()
@@ -977,12 +5413,13 @@ class SimpleExportDialog:
         options = [
             (20, "20 сообщений (быстро)"),
             (50, "50 сообщений (оптимально)"),
-            (100, "100 сообщений (медленно)"),
-            (min(200, max_messages), f"Максимум ({min(200, max_messages)} сообщений)")
+            (100, "100 сообщений"),
+            (1000, "1000 сообщений"),
+            (max_messages, f"Все сообщения ({max_messages})")
         ]
         
         for value, text in options:
-            if value <= max_messages:
+            if value < max_messages or (value == max_messages and text.startswith("Все")):
                 tk.Radiobutton(
                     self.dialog,
                     text=text,
@@ -996,6 +5433,34 @@ class SimpleExportDialog:
                     activeforeground='white'
                 ).pack(anchor='w', padx=50, pady=3)
         
+        # Высокое изображение неудобно открывать, поэтому его можно разбить
+        self.split_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(
+            self.dialog,
+            text="Разбить на несколько PNG",
+            variable=self.split_var,
+            bg='#17212b',
+            fg='white',
+            selectcolor='#2b5278',
+            font=('Arial', 10),
+            activebackground='#17212b',
+            activeforeground='white'
+        ).pack(anchor='w', padx=50, pady=(10, 0))
+        
+        # Картинки из папки экспорта вместо подписей «📷 Фото»
+        self.thumbnails_var = tk.BooleanVar(value=True)
+        tk.Checkbutton(
+            self.dialog,
+            text="Миниатюры фото",
+            variable=self.thumbnails_var,
+            bg='#17212b',
+            fg='white',
+            selectcolor='#2b5278',
+            font=('Arial', 10),
+            activebackground='#17212b',
+            activeforeground='white'
+        ).pack(anchor='w', padx=50, pady=(3, 0))
+        
         # Кнопки
         btn_frame = tk.Frame(self.dialog, bg='#17212b')
         btn_frame.pack(pady=30)
@@ -1025,22 +5490,36 @@ class SimpleExportDialog:
             relief='flat',
             cursor='hand2'
         ).pack(side='left', padx=10)
+        
+        parent.wait_window(self.dialog)
     
     def ok_clicked(self):
         self.result = self.var.get()
+        self.split = self.split_var.get()
+        self.thumbnails = self.thumbnails_var.get()
         self.dialog.destroy()
     
     def cancel_clicked(self):
         self.dialog.destroy()
 
 class SimpleProgressWindow:
-    def __init__(self, parent):
+    """Окно прогресса экспорта с кнопкой отмены.
+    
+    Все методы вызываются только из потока Tk (из poll_export), сам
+    экспорт идет в ExportJob.
+    """
+    
+    def __init__(self, parent, on_cancel):
+        self.on_cancel = on_cancel
+        self.started = None
+        
         self.window = tk.Toplevel(parent)
         self.window.title("Создание изображения")
-        self.window.geometry("350x120")
+        self.window.geometry("380x190")
         self.window.configure(bg='#17212b')
         self.window.transient(parent)
         self.window.grab_set()
+        self.window.protocol("WM_DELETE_WINDOW", self.cancel)
         
         # Центрируем
         x = parent.winfo_rootx() + 100
@@ -1053,7 +5532,7 @@ class SimpleProgressWindow:
             bg='#17212b',
             fg='white',
             font=('Arial', 12, 'bold')
-        ).pack(pady=20)
+        ).pack(pady=(15, 10))
         
         self.status_label = tk.Label(
             self.window,
@@ -1062,22 +5541,691 @@ class SimpleProgressWindow:
             fg='#708499',
             font=('Arial', 10)
         )
-        self.status_label.pack(pady=(0, 20))
+        self.status_label.pack()
         
-        # Простой прогресс-бар
-        self.progress = ttk.Progressbar(self.window, mode='indeterminate')
+        self.progress = ttk.Progressbar(self.window, mode='determinate', maximum=1)
         self.progress.pack(pady=10, padx=20, fill='x')
-        self.progress.start()
+        
+        # Скорость и оставшееся время
+        self.detail_label = tk.Label(
+            self.window,
+            text="",
+            bg='#17212b',
+            fg='#708499',
+            font=('Arial', 9)
+        )
+        self.detail_label.pack()
+        
+        self.cancel_btn = tk.Button(
+            self.window,
+            text="Отмена",
+            command=self.cancel,
+            bg='#f44336',
+            fg='white',
+            font=('Arial', 10),
+            relief='flat',
+            padx=20
+        )
+        self.cancel_btn.pack(pady=10)
     
     def update_status(self, message):
         """Обновление статуса"""
         self.status_label.config(text=message)
-        self.window.update()
+    
+    def show_progress(self, done, total, messages):
+        """Отрисовано done полос из total: полоса, скорость и оставшееся время"""
+        now = time.perf_counter()
+        if self.started is None:
+            self.started = now
+        
+        total = max(total, 1)
+        self.progress.config(maximum=total, value=done)
+        self.update_status(f"Отрисовано полос: {done}/{total} ({done * 100 // total}%)")
+        
+        elapsed = now - self.started
+        if done and elapsed > 0:
+            rate = done / elapsed
+            left = (total - done) / rate
+            self.detail_label.config(
+                text=f"≈{messages * done / total / elapsed:.0f} сообщ./с, осталось ~{left:.0f} с"
+            )
+    
+    def cancel(self):
+        """Отмена экспорта: окно закроется, когда поток удалит недописанные файлы"""
+        self.cancel_btn.config(state='disabled')
+        self.update_status("Отмена...")
+        self.on_cancel()
     
     def close(self):
         self.window.destroy()
 
+def read_chat(file_path, chat=None, cache=None, mapped=None):
+    """Чтение экспорта в текущем потоке, без окна: (метаданные, хранилище, индекс чатов).
+    
+    Для полного экспорта аккаунта хранилище пустое, а индекс - список
+    ChatEntry; chat (ChatEntry) читает только один его чат. С cache
+    (ChatCache) файл читается из кэша или записывается в него, mapped
+    задает чтение через mmap (None - по размеру чата).
+    """
+    loader = ChatLoader(file_path, chat, cache, mapped)
+    meta = loader.read_export()
+    store = MessageStore()
+    chats = None
+    while not loader.events.empty():
+        event = loader.events.get_nowait()
+        if event[0] == 'tail':
+            store = event[2]
+        elif event[0] == 'chats':
+            chats = event[2]
+    return meta, store, chats
+
+def read_cli_chat(file_path, selector, cache=None, mapped=None):
+    """Чат для команды: весь файл обычного экспорта или чат --chat из полного"""
+    meta, store, chats = read_chat(file_path, cache=cache, mapped=mapped)
+    if chats is None:
+        return meta, store
+    if not selector:
+        raise ValueError(f"{file_path} - полный экспорт аккаунта, укажите чат через --chat (список: команда chats)")
+    meta, store, _ = read_chat(file_path, find_chat(chats, selector), cache, mapped)
+    return meta, store
+
+def cli_cache_for(args):
+    """Кэш для команды, если он не выключен через --no-cache"""
+    return None if args.no_cache else ChatCache.open_default()
+
+def parse_cli_date(value):
+    """Дата ГГГГ-ММ-ДД из командной строки -> номер дня"""
+    try:
+        return date.fromisoformat(value).toordinal()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"ожидается дата ГГГГ-ММ-ДД: {value}")
+
+def filter_rows(store, query='', sender='', since=None, until=None, mode='text'):
+    """Строки с совпадением query (в режиме mode, см. SearchPattern), отправителем
+    sender (часть имени или from_id) и датой в диапазоне since..until
+    включительно (номера дней)"""
+    rows = range(len(store))
+    if query:
+        with PROFILER.measure('search') as measure:
+            rows = store.search(SearchPattern(query, mode))
+            measure.items = len(rows)
+    if not sender and since is None and until is None:
+        return rows
+    
+    sender = sender.lower()
+    sender_codes = None
+    if sender:
+        sender_codes = {
+            code for code, (from_id, name) in enumerate(store.senders)
+            if sender in name.lower() or sender == from_id.lower()
+        }
+    low = since if since is not None else -1
+    high = until if until is not None else 1 << 31
+    
+    day_keys = store.day_keys
+    codes = store.sender_codes
+    return array('l', (
+        row for row in rows
+        if low <= day_keys[row] <= high and (sender_codes is None or codes[row] in sender_codes)
+    ))
+
+def message_record(store, row):
+    """Сообщение в виде словаря для вывода в JSON"""
+    timestamp = store.timestamps[row]
+    return {
+        'id': store.ids[row],
+        'date': format_day(store.day_keys[row]),
+        'time': store.time_label(row),
+        'date_unixtime': timestamp if timestamp != MISSING_TIMESTAMP else None,
+        'type': 'service' if store.is_service(row) else 'message',
+        'from': store.sender_name(row),
+        'from_id': store.sender_id(row),
+        'text': store.service_text(row) if store.is_service(row) else store.display_text(row, 1 << 30)
+    }
+
+def cli_search(args, out):
+    """Команда search: найденные сообщения построчно или в JSON Lines"""
+    for file_path in args.files:
+        meta, store = read_cli_chat(file_path, args.chat, cli_cache_for(args), args.mmap or None)
+        rows = filter_rows(store, args.query, args.sender, args.since, args.until, args.mode)
+        if args.count:
+            rows = rows[-args.count:]
+        prefix = f"{file_path}: " if len(args.files) > 1 else ""
+        
+        for row in rows:
+            if args.json:
+                record = message_record(store, row)
+                record['file'] = file_path
+                out.write(json.dumps(record, ensure_ascii=False) + '\n')
+            else:
+                text = store.service_text(row) if store.is_service(row) else store.display_text(row, 1 << 30)
+                name = '' if store.is_service(row) else f"{store.sender_name(row)}: "
+                text = ' '.join(text.split())
+                out.write(f"{prefix}{format_day(store.day_keys[row])} {store.time_label(row)} {name}{text}\n")
+    return 0
+
+def cli_stats(args, out):
+    """Команда stats: количество сообщений, участники, период и активные отправители"""
+    for file_path in args.files:
+        meta, store = read_cli_chat(file_path, args.chat, cli_cache_for(args), args.mmap or None)
+        rows = filter_rows(store, args.query, args.sender, args.since, args.until, args.mode)
+        if args.count:
+            rows = rows[-args.count:]
+        stats = store.stats if rows == range(len(store)) else ChatStats.from_rows(store, rows)
+        
+        days = [store.day_keys[row] for row in (rows[0], rows[-1])] if len(rows) else []
+        top = Counter()
+        for code, count in stats.sender_counts.items():
+            top[store.senders[code][1]] += count
+        
+        result = {
+            'file': file_path,
+            'chat': chat_name(meta),
+            'messages': stats.total,
+            'service': stats.service,
+            'participants': stats.participants(store),
+            'first_date': format_day(days[0]) if days else None,
+            'last_date': format_day(days[1]) if days else None,
+            'bad_dates': store.bad_dates,
+            'top_senders': top.most_common(args.top)
+        }
+        
+        if args.json:
+            out.write(json.dumps(result, ensure_ascii=False) + '\n')
+            continue
+        
+        out.write(f"{file_path}: {result['chat']}\n")
+        out.write(f"  Сообщений: {result['messages']} (служебных: {result['service']})\n")
+        out.write(f"  Участников: {result['participants']}\n")
+        if days:
+            out.write(f"  Период: {result['first_date']} - {result['last_date']}\n")
+        if store.bad_dates:
+            out.write(f"  Без даты: {store.bad_dates}\n")
+        for name, count in result['top_senders']:
+            out.write(f"  {count:>8}  {name}\n")
+    return 0
+
+def cli_chats(args, out):
+    """Команда chats: индекс чатов полного экспорта аккаунта"""
+    meta, store, chats = read_chat(args.file, cache=cli_cache_for(args))
+    if chats is None:
+        chats = []
+    for entry in chats:
+        if args.json:
+            out.write(json.dumps({
+                'id': entry.id,
+                'name': entry.title,
+                'type': entry.type,
+                'section': entry.section,
+                'messages': entry.message_count,
+                'start': entry.start,
+                'end': entry.end
+            }, ensure_ascii=False) + '\n')
+        else:
+            out.write(f"{entry.id}\t{entry.type}\t{entry.message_count}\t{entry.title}\n")
+    if not chats:
+        print(f"{args.file} - экспорт одного чата, команда chats не нужна", file=sys.stderr)
+        return 1
+    return 0
+
+def cli_export_png(args, out):
+    """Команда export-png: отбор сообщений и экспорт в PNG без окна"""
+    if not PIL_AVAILABLE:
+        print("Ошибка: библиотека Pillow не установлена (pip install pillow)", file=sys.stderr)
+        return 1
+    
+    meta, store = read_cli_chat(args.file, args.chat, cli_cache_for(args), args.mmap or None)
+    rows = filter_rows(store, args.query, args.sender, args.since, args.until, args.mode)
+    total = len(rows)
+    if args.count:
+        rows = rows[-args.count:]
+    if not len(rows):
+        print("Ошибка: нет сообщений для экспорта", file=sys.stderr)
+        return 1
+    
+    conditions = []
+    if args.query:
+        conditions.append(search_condition(args.query))
+    if args.sender:
+        conditions.append(f"Отправитель: {args.sender}")
+    
+    name = chat_name(meta)
+    output = args.output or f"{name.replace(' ', '_')}_chat_{len(rows)}msg.png"
+    media_dir = os.path.dirname(os.path.abspath(args.file)) if args.thumbnails else None
+    thumbnail_dir = None if args.no_cache else default_thumbnail_dir()
+    renderer = ChatImageRenderer(store, rows, name, args.workers, media_dir, thumbnail_dir,
+                                 export_subtitle(store, rows, total, conditions))
+    renderer.layout()
+    
+    def on_progress(done, total):
+        if args.verbose:
+            print(f"Отрисовано полос: {done}/{total}", file=sys.stderr)
+    
+    for path in renderer.save(output, args.split, on_progress):
+        out.write(path + '\n')
+    return 0
+
+def cli_cache(args, out):
+    """Команда cache: список записей, пересборка, очистка и ограничение размера"""
+    cache = ChatCache.open_default()
+    if cache is None:
+        print("Ошибка: кэш выключен (TELEGRAM_VIEWER_CACHE) или SQLite собран без FTS5", file=sys.stderr)
+        return 1
+    
+    if args.action == 'list':
+        for path, start, count, title, data_bytes, used in cache.entries():
+            when = datetime.fromtimestamp(used).strftime('%Y-%m-%d %H:%M')
+            where = f"{path}@{start}" if start >= 0 else path
+            out.write(f"{when}\t{count}\t{data_bytes / 1048576:.1f} МБ\t{title}\t{where}\n")
+        out.write(f"Кэш: {cache.path}, {cache.size() / 1048576:.1f} МБ\n")
+    elif args.action == 'rebuild':
+        if not args.files:
+            raise ValueError("укажите файлы result.json для пересборки")
+        for file_path in args.files:
+            cache.remove(file_path)
+            if args.chat:
+                read_cli_chat(file_path, args.chat, cache)
+            else:
+                read_chat(file_path, cache=cache)
+            out.write(f"Пересобран: {file_path}\n")
+    elif args.action == 'clear':
+        out.write(f"Удалено записей: {cache.clear()}\n")
+        thumbnail_dir = default_thumbnail_dir()
+        if thumbnail_dir and os.path.isdir(thumbnail_dir):
+            shutil.rmtree(thumbnail_dir, ignore_errors=True)
+    elif args.action == 'trim':
+        removed = cache.shrink(int(args.max_size * 1048576))
+        out.write(f"Удалено записей: {removed}, размер: {cache.size() / 1048576:.1f} МБ\n")
+    return 0
+
+# Словарь синтетического экспорта (команда generate)
+SYNTHETIC_SENDERS = [
+    "Иван Петров", "Мария", "Алексей К.", "Ольга Смирнова", "Bob", "Alice Johnson",
+    "Дмитрий", "Катя 🌸", "Сергей", "Anna", "Никита", "Елена Викторовна"
+]
+SYNTHETIC_WORDS = (
+    "привет как дела что нового сегодня завтра встреча в офисе созвон "
+    "посмотри документ отправил файл спасибо хорошо договорились ёлка "
+    "погода дорога работа проект отчет выходные кино ужин фото видео "
+    "hello ok thanks meeting deploy build release link github python "
+    "😀 😂 👍 🔥 ❤️ 🎉 🤔 🙏 😅 ✅"
+).split()
+SYNTHETIC_MEDIA = [
+    ('photo', 30), ('sticker', 20), ('voice_message', 12), ('video_file', 10),
+    ('video_message', 8), ('animation', 8), ('audio_file', 4), ('file', 8)
+]
+SYNTHETIC_ACTIONS = ['joined_telegram', 'joined_chat', 'left_chat', 'created_chat', 'pin_message', 'invite_members']
+
+def synthetic_text(rng):
+    """Фраза из словаря: русские и английские слова вперемешку с эмодзи"""
+    return ' '.join(rng.choice(SYNTHETIC_WORDS) for _ in range(rng.randint(1, 24)))
+
+def synthetic_message(rng, message_id, timestamp):
+    """Одно сообщение синтетического экспорта в формате Telegram Desktop"""
+    wall = datetime.fromtimestamp(timestamp).isoformat(timespec='seconds')
+    sender = rng.randrange(len(SYNTHETIC_SENDERS))
+    message = {'id': message_id, 'type': 'message', 'date': wall, 'date_unixtime': str(timestamp)}
+    
+    if rng.random() < 0.03:
+        message['type'] = 'service'
+        message['actor'] = SYNTHETIC_SENDERS[sender]
+        message['actor_id'] = f"user{1000 + sender}"
+        message['action'] = rng.choice(SYNTHETIC_ACTIONS)
+        message['text'] = ''
+        message['text_entities'] = []
+        return message
+    
+    message['from'] = SYNTHETIC_SENDERS[sender]
+    message['from_id'] = f"user{1000 + sender}"
+    if message_id > 1 and rng.random() < 0.1:
+        message['reply_to_message_id'] = rng.randint(max(1, message_id - 50), message_id - 1)
+    
+    media = None
+    if rng.random() < 0.25:
+        media = rng.choices([kind for kind, _ in SYNTHETIC_MEDIA], [weight for _, weight in SYNTHETIC_MEDIA])[0]
+        if media == 'photo':
+            message['photo'] = f"photos/photo_{message_id}@{wall[:10]}.jpg"
+            message['width'] = rng.choice((1280, 960, 720))
+            message['height'] = rng.choice((720, 960, 1280))
+        elif media == 'file':
+            message['file'] = f"files/document_{message_id}.pdf"
+            message['file_name'] = f"Отчет {message_id}.pdf"
+            message['mime_type'] = 'application/pdf'
+        else:
+            message['file'] = f"{media}s/{media}_{message_id}"
+            message['media_type'] = media
+            if media == 'sticker':
+                message['sticker_emoji'] = rng.choice(('😀', '👍', '🔥', '❤️'))
+            elif media == 'audio_file':
+                message['file_name'] = f"track_{message_id}.mp3"
+                message['performer'] = rng.choice(SYNTHETIC_SENDERS)
+            elif media in ('voice_message', 'video_message', 'video_file'):
+                message['duration_seconds'] = rng.randint(1, 300)
+    
+    text = '' if media and rng.random() < 0.6 else synthetic_text(rng)
+    if text and rng.random() < 0.2:
+        # Форматированный текст - список кусков, как в настоящем экспорте
+        words = text.split(' ')
+        cut = rng.randint(0, len(words))
+        entity = {'type': rng.choice(('bold', 'italic', 'link', 'mention')),
+                  'text': rng.choice(('важно', 'https://t.me/example', '@username', 'смотри'))}
+        parts = [' '.join(words[:cut]) + ' ', entity, ' ' + ' '.join(words[cut:])]
+        message['text'] = parts
+        message['text_entities'] = [
+            {'type': 'plain', 'text': part} if isinstance(part, str) else part for part in parts
+        ]
+    else:
+        message['text'] = text
+        message['text_entities'] = [{'type': 'plain', 'text': text}] if text else []
+    return message
+
+def generate_export(path, count, seed=1, name="Синтетический чат"):
+    """Запись синтетического result.json из count сообщений.
+    
+    Файл похож на экспорт Telegram Desktop: тексты на русском и английском
+    с эмодзи, часть - списком кусков с форматированием, служебные
+    сообщения, фото, стикеры, голосовые, видео и документы. Сообщения
+    пишутся потоком, так что память не зависит от count, а один и тот же
+    seed дает один и тот же файл.
+    """
+    rng = random.Random(seed)
+    timestamp = int(datetime(2019, 1, 1, 9, 0).timestamp())
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{\n "name": ' + json.dumps(name, ensure_ascii=False))
+        f.write(',\n "type": "private_group",\n "id": 4200000000,\n "messages": [')
+        for message_id in range(1, count + 1):
+            # Переписка идет пачками: короткие паузы внутри дня и ночные перерывы
+            timestamp += rng.randint(5, 600) if rng.random() < 0.97 else rng.randint(3600, 86400)
+            message = synthetic_message(rng, message_id, timestamp)
+            f.write((',\n  ' if message_id > 1 else '\n  ') + json.dumps(message, ensure_ascii=False))
+        f.write('\n ]\n}\n')
+    return path
+
+def timed(action, repeat=1):
+    """(результат последнего вызова, лучшее время из repeat вызовов в секундах)"""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = action()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return result, round(best, 6)
+
+def benchmark_canvas(store, pages):
+    """Открытие чата и прокрутка страницами в настоящем окне Tk; None без экрана"""
+    load_tk()
+    try:
+        root = tk.Tk()
+    except tk.TclError:
+        return None
+    
+    try:
+        root.geometry("1000x700")
+        app = TelegramChatFinalWorking(root)
+        app.trigram_index_min_messages = float('inf')
+        root.update()
+        # Размер холста применяется отложенно (apply_resize)
+        root.after(100)
+        root.update()
+        
+        def show():
+            app.on_chat_loaded({'name': 'benchmark'}, store)
+            root.update_idletasks()
+        
+        def scroll():
+            for _ in range(pages):
+                app.prev_page()
+                root.update_idletasks()
+        
+        def jump():
+            app.go_to_first()
+            root.update_idletasks()
+            app.go_to_last()
+            root.update_idletasks()
+        
+        _, show_seconds = timed(show)
+        _, scroll_seconds = timed(scroll)
+        _, jump_seconds = timed(jump)
+        return {
+            'open_seconds': show_seconds,
+            'pages': pages,
+            'page_seconds': round(scroll_seconds / pages, 6),
+            'jump_seconds': jump_seconds,
+            'layout_cache': len(app.layout_cache)
+        }
+    finally:
+        root.destroy()
+
+def run_benchmark(file_path, queries, repeat=3, export_count=1000, canvas_pages=50, workers=None):
+    """Замеры на файле экспорта: загрузка, поиск, статистика, лента и экспорт PNG.
+    
+    Возвращает словарь для JSON; этапы, которым не хватает Pillow, экрана
+    или SQLite с FTS5, помечены ключом skipped.
+    """
+    size = os.path.getsize(file_path)
+    results = {}
+    
+    (meta, store, chats), seconds = timed(lambda: read_chat(file_path))
+    if chats is not None:
+        raise ValueError(f"{file_path} - полный экспорт аккаунта, для замеров нужен экспорт одного чата")
+    results['load'] = {
+        'seconds': seconds,
+        'messages_per_second': round(len(store) / seconds) if seconds else None,
+        'mb_per_second': round(size / 1048576 / seconds, 1) if seconds else None
+    }
+    
+    (_, mapped, _), seconds = timed(lambda: read_chat(file_path, mapped=True))
+    results['load_mmap'] = {'seconds': seconds}
+    
+    def search_all(target, index=None):
+        found = []
+        for query in queries:
+            rows, seconds = timed(lambda: target.search(SearchPattern(query), index), repeat)
+            found.append({'query': query, 'hits': len(rows), 'seconds': seconds})
+        return found
+    
+    results['search'] = search_all(store)
+    
+    index = TrigramIndex()
+    _, seconds = timed(lambda: index.build(store))
+    results['trigram_index'] = {'seconds': seconds, 'megabytes': round(index.nbytes / 1048576, 1)}
+    results['search_indexed'] = search_all(store, index)
+    results['search_mmap'] = search_all(mapped)
+    
+    # Строка статистики: счетчики по найденным строкам и число участников
+    rows = store.search(SearchPattern(queries[0])) if queries else range(len(store))
+    _, seconds = timed(lambda: ChatStats.from_rows(store, rows).participants(store), repeat)
+    results['stats'] = {'rows': len(rows), 'seconds': seconds}
+    
+    if sqlite3 is None:
+        results['cache'] = {'skipped': "нет sqlite3"}
+    else:
+        directory = tempfile.mkdtemp(prefix='telegram_viewer_bench_')
+        try:
+            cache = ChatCache(os.path.join(directory, 'cache.sqlite3'))
+            fingerprint = cache.fingerprint(file_path)
+            _, write_seconds = timed(lambda: cache.save(fingerprint, meta, store))
+            (_, cached, _), open_seconds = timed(lambda: cache.load(fingerprint), repeat)
+            results['cache'] = {
+                'write_seconds': write_seconds,
+                'open_seconds': open_seconds,
+                'megabytes': round(cache.size() / 1048576, 1),
+                'search': search_all(cached)
+            }
+            cached.db.close()
+        except sqlite3.Error as e:
+            results['cache'] = {'skipped': str(e)}
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+    
+    canvas = benchmark_canvas(store, canvas_pages) if canvas_pages else None
+    results['canvas'] = canvas if canvas is not None else {'skipped': "нет экрана или отключено"}
+    
+    if not PIL_AVAILABLE:
+        results['export'] = {'skipped': "нет Pillow"}
+    else:
+        rows = range(max(len(store) - export_count, 0), len(store))
+        renderer = ChatImageRenderer(store, rows, chat_name(meta), workers=workers)
+        _, layout_seconds = timed(renderer.layout)
+        directory = tempfile.mkdtemp(prefix='telegram_viewer_bench_')
+        try:
+            paths, save_seconds = timed(lambda: renderer.save(os.path.join(directory, 'chat.png')))
+            results['export'] = {
+                'messages': len(rows),
+                'workers': renderer.workers,
+                'height': renderer.height,
+                'layout_seconds': layout_seconds,
+                'render_seconds': save_seconds,
+                'megabytes': round(sum(os.path.getsize(path) for path in paths) / 1048576, 2)
+            }
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+    
+    return {
+        'benchmark_version': 1,
+        'file': os.path.abspath(file_path),
+        'bytes': size,
+        'messages': len(store),
+        'python': sys.version.split()[0],
+        'platform': sys.platform,
+        'cpus': os.cpu_count(),
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'peak_memory_mb': peak_memory_mb(),
+        'results': results
+    }
+
+def cli_generate(args, out):
+    """Команда generate: синтетический экспорт для замеров"""
+    generate_export(args.output, args.count, args.seed, args.name)
+    out.write(f"{args.output}: {args.count} сообщений, {os.path.getsize(args.output) / 1048576:.1f} МБ\n")
+    return 0
+
+def cli_bench(args, out):
+    """Команда bench: замеры производительности в JSON"""
+    result = run_benchmark(args.file, args.queries, args.repeat, args.export_count,
+                           0 if args.no_canvas else args.pages, args.workers)
+    text = json.dumps(result, ensure_ascii=False, indent=2) + '\n'
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        out.write(text)
+    return 0
+
+def build_cli_parser():
+    """Разбор аргументов командной строки"""
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(sys.argv[0]),
+        description="Просмотр экспорта Telegram. Без команды открывается окно."
+    )
+    parser.add_argument('--profile', metavar='FILE', help="журнал замеров по фазам в JSON Lines")
+    commands = parser.add_subparsers(dest='command', required=True)
+    
+    def add_filters(command):
+        command.add_argument('--chat', default='', help="чат полного экспорта: id или название")
+        command.add_argument('-q', '--query', default='', help="текст для поиска (без учета регистра и ё/е)")
+        mode = command.add_mutually_exclusive_group()
+        mode.add_argument('--word', dest='mode', action='store_const', const='word',
+                          help="искать запрос только целым словом")
+        mode.add_argument('--regex', dest='mode', action='store_const', const='regex',
+                          help="запрос - регулярное выражение")
+        command.set_defaults(mode='text')
+        command.add_argument('--sender', default='', help="часть имени отправителя или его from_id")
+        command.add_argument('--since', type=parse_cli_date, help="с даты ГГГГ-ММ-ДД включительно")
+        command.add_argument('--until', type=parse_cli_date, help="по дату ГГГГ-ММ-ДД включительно")
+        command.add_argument('-n', '--count', type=int, default=0, help="только последние N сообщений")
+        command.add_argument('--no-cache', action='store_true', help="читать файл заново, не используя кэш")
+        command.add_argument('--mmap', action='store_true',
+                             help="не держать тексты в памяти, читать их из файла по мере надобности")
+    
+    search = commands.add_parser('search', help="вывод найденных сообщений")
+    search.add_argument('files', nargs='+', help="файлы result.json")
+    add_filters(search)
+    search.add_argument('--json', action='store_true', help="вывод в JSON Lines")
+    search.set_defaults(handler=cli_search)
+    
+    stats = commands.add_parser('stats', help="статистика чата")
+    stats.add_argument('files', nargs='+', help="файлы result.json")
+    add_filters(stats)
+    stats.add_argument('--top', type=int, default=10, help="сколько самых активных отправителей показать")
+    stats.add_argument('--json', action='store_true', help="вывод в JSON Lines")
+    stats.set_defaults(handler=cli_stats)
+    
+    chats = commands.add_parser('chats', help="список чатов полного экспорта аккаунта")
+    chats.add_argument('file', help="файл result.json")
+    chats.add_argument('--json', action='store_true', help="вывод в JSON Lines")
+    chats.add_argument('--no-cache', action='store_true', help="читать файл заново, не используя кэш")
+    chats.set_defaults(handler=cli_chats)
+    
+    export = commands.add_parser('export-png', help="экспорт сообщений в PNG")
+    export.add_argument('file', help="файл result.json")
+    add_filters(export)
+    export.add_argument('-o', '--output', help="путь PNG (по умолчанию по имени чата)")
+    export.add_argument('--split', action='store_true', help="серия PNG вместо одного изображения")
+    export.add_argument('--thumbnails', action='store_true',
+                        help="миниатюры фото из папки экспорта вместо подписей «📷 Фото»")
+    export.add_argument('--workers', type=int, default=None, help="число процессов отрисовки")
+    export.add_argument('-v', '--verbose', action='store_true', help="прогресс в stderr")
+    export.set_defaults(handler=cli_export_png)
+    
+    cache = commands.add_parser('cache', help="кэш разобранных файлов")
+    cache.add_argument('action', choices=('list', 'rebuild', 'clear', 'trim'),
+                       help="list - записи и размер, rebuild - перечитать файлы, "
+                            "clear - удалить всё, trim - удалить старые записи до --max-size")
+    cache.add_argument('files', nargs='*', help="файлы result.json для rebuild")
+    cache.add_argument('--chat', default='', help="для rebuild: еще и чат полного экспорта")
+    cache.add_argument('--max-size', type=float, default=ChatCache.default_max_bytes / 1048576,
+                       help="для trim: размер кэша в МБ")
+    cache.set_defaults(handler=cli_cache)
+    
+    generate = commands.add_parser('generate', help="синтетический экспорт для замеров")
+    generate.add_argument('output', help="путь создаваемого result.json")
+    generate.add_argument('-n', '--count', type=int, default=100000, help="число сообщений")
+    generate.add_argument('--seed', type=int, default=1, help="зерно случайных данных")
+    generate.add_argument('--name', default="Синтетический чат", help="название чата")
+    generate.set_defaults(handler=cli_generate)
+    
+    bench = commands.add_parser('bench', help="замеры загрузки, поиска, ленты и экспорта в JSON")
+    bench.add_argument('file', help="файл result.json одного чата")
+    bench.add_argument('-q', '--queries', nargs='+', default=['привет', 'ok', 'созвон', 'ё', 'zzzz'],
+                       help="запросы для замеров поиска")
+    bench.add_argument('--repeat', type=int, default=3, help="повторы быстрых замеров (берется лучший)")
+    bench.add_argument('--export-count', type=int, default=1000, help="сколько последних сообщений экспортировать")
+    bench.add_argument('--pages', type=int, default=50, help="сколько страниц прокрутить в окне")
+    bench.add_argument('--no-canvas', action='store_true', help="не открывать окно Tk")
+    bench.add_argument('--workers', type=int, default=None, help="число процессов отрисовки экспорта")
+    bench.add_argument('-o', '--output', help="файл для JSON (по умолчанию stdout)")
+    bench.set_defaults(handler=cli_bench)
+    
+    return parser
+
+def run_cli(argv):
+    """Командный режим: tkinter не импортируется, результат идет в stdout"""
+    args = build_cli_parser().parse_args(argv)
+    if args.profile:
+        PROFILER.enable(args.profile)
+    try:
+        return args.handler(args, sys.stdout)
+    except BrokenPipeError:
+        # Вывод оборван (например, | head) - это не ошибка
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 0
+    except (OSError, ValueError, re.error) as e:
+        print(f"Ошибка: {e}", file=sys.stderr)
+        return 1
+    finally:
+        PROFILER.flush()
+
 def main():
+    # Журнал замеров для окна и команд; --profile у команд задает свой
+    trace_path = os.environ.get('TELEGRAM_VIEWER_PROFILE')
+    if trace_path:
+        PROFILER.enable(trace_path)
+    
+    if len(sys.argv) > 1:
+        sys.exit(run_cli(sys.argv[1:]))
+    
+    load_tk()
     root = tk.Tk()
     app = TelegramChatFinalWorking(root)
     
@@ -1088,7 +6236,10 @@ def main():
     root.geometry(f"+{x}+{y}")
     
     root.mainloop()
+    PROFILER.flush()
 
 if __name__ == "__main__":
+    # Нужно собранному exe для процессов отрисовки экспорта
+    multiprocessing.freeze_support()
     main()
 